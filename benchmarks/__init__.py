@@ -0,0 +1 @@
+"""Offline benchmarks of the pipeline stages on synthetic Semantic3D scans."""
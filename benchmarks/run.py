@@ -0,0 +1,262 @@
+"""Time the pipeline stages on synthetic scans and check them against a baseline.
+
+Every stage runs in a fresh process on a synthetic scan of each requested
+size (see `benchmarks/synthetic.py`), so its peak RSS is its own. The
+throughput in points per second and the peak RSS (of the stage process and
+of any workers it started) are appended to `history.json` in the results
+directory, and compared with `baseline.json`; the run fails when a stage got
+slower or bigger than the baseline by more than `--threshold`.
+
+Usage:
+    python -m benchmarks.run --sizes 1M 10M
+    python -m benchmarks.run --sizes 1M 10M --save_baseline
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import subprocess
+import multiprocessing
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor
+from benchmarks.synthetic import generate_scan, noisy_predictions
+
+# Grid size of preprocess_semantic3d.preprocess
+GRID_SIZE = 0.01
+
+# Memory budget in megabytes of process_large_file and voxel_subsample_file,
+# small enough that every scan from 1M points on is split into several parts
+LARGE_FILE_BUDGET = 50
+
+HISTORY_NAME = 'history.json'
+BASELINE_NAME = 'baseline.json'
+
+DEFAULT_THRESHOLD = 0.2
+
+SIZE_SUFFIXES = {'k': 10**3, 'M': 10**6, 'G': 10**9}
+
+
+def parse_size(size):
+    """Number of points of a size such as '500k', '1M' or '2000000'."""
+    if size[-1] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+
+def stage_preprocess_small(scan, out_dir):
+    from src.processing.preprocess_semantic3d import process_small_file
+    process_small_file(scan['cloud'], os.path.join(out_dir, os.path.basename(scan['cloud'])),
+                       GRID_SIZE)
+
+
+def stage_preprocess_large(scan, out_dir):
+    from src.processing.preprocess_semantic3d import process_large_file
+    output_prefix = os.path.join(out_dir, os.path.basename(scan['cloud']).replace('.txt', ''))
+    process_large_file(scan['cloud'], output_prefix, GRID_SIZE,
+                       memory_budget=LARGE_FILE_BUDGET)
+
+
+def stage_voxel_subsample(scan, out_dir):
+    from src.processing.voxel_subsample import voxel_subsample_file
+    voxel_subsample_file(scan['cloud'], os.path.join(out_dir, os.path.basename(scan['cloud'])),
+                         GRID_SIZE, memory_budget=LARGE_FILE_BUDGET)
+
+
+def stage_eval(scan, out_dir):
+    from src.eval import evaluate
+    evaluate(scan['dir'], scan['pred_dir'])
+
+
+def stage_convert_to_ply(scan, out_dir):
+    from src.processing.convert_to_ply import process_predictions
+    process_predictions(scan['dir'], scan['pred_dir'], out_dir)
+
+
+def stage_plot_labels_histogram(scan, out_dir):
+    from src.processing.plot_labels_histogram import process_directory
+    process_directory(scan['dir'], out_dir)
+
+
+STAGES = {
+    'preprocess_small': stage_preprocess_small,
+    'preprocess_large': stage_preprocess_large,
+    'voxel_subsample': stage_voxel_subsample,
+    'eval': stage_eval,
+    'convert_to_ply': stage_convert_to_ply,
+    'plot_labels_histogram': stage_plot_labels_histogram,
+}
+
+
+def peak_rss_mb():
+    """Peak RSS in megabytes of this process and of its finished children."""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1e6 if sys.platform == 'darwin' else 1e3
+    return max(own, children) / scale
+
+
+def run_stage(stage, scan, out_dir):
+    """Run one stage; called in a fresh process."""
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    start = time.perf_counter()
+    STAGES[stage](scan, out_dir)
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds, 'peak_rss_mb': peak_rss_mb()}
+
+
+def measure(stage, scan, out_dir, repeat=1):
+    """Best time and peak RSS of `repeat` runs of a stage, each in a new process."""
+    runs = []
+    for _ in range(repeat):
+        # Outputs of a previous run would be skipped or resumed
+        shutil.rmtree(out_dir, ignore_errors=True)
+        os.makedirs(out_dir)
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            runs.append(executor.submit(run_stage, stage, scan, out_dir).result())
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+    seconds = min(run['seconds'] for run in runs)
+    return {
+        'stage': stage,
+        'num_points': scan['num_points'],
+        'seconds': seconds,
+        'points_per_s': scan['num_points'] / seconds,
+        'peak_rss_mb': max(run['peak_rss_mb'] for run in runs)
+    }
+
+
+def prepare_scan(data_dir, num_points, seed=0):
+    """Generate (or reuse) the scan of `num_points` points and its predictions."""
+    scan_dir = os.path.join(data_dir, str(num_points))
+    cloud_path, labels_path = generate_scan(scan_dir, num_points, seed)
+    pred_dir = os.path.join(scan_dir, 'predictions')
+    noisy_predictions(labels_path, os.path.join(pred_dir, os.path.basename(labels_path)),
+                      seed=seed)
+    return {'dir': scan_dir, 'cloud': cloud_path, 'labels': labels_path,
+            'pred_dir': pred_dir, 'num_points': num_points}
+
+
+def result_key(result):
+    return f"{result['stage']}@{result['num_points']}"
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_json(data, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def find_regressions(results, baseline, threshold):
+    """Results slower or bigger than their baseline by more than `threshold`.
+
+    Returns:
+        A list of messages, one per regression.
+    """
+    regressions = []
+    for result in results:
+        base = baseline.get(result_key(result))
+        if base is None:
+            continue
+        if result['points_per_s'] < base['points_per_s'] * (1 - threshold):
+            regressions.append(f"{result_key(result)}: {result['points_per_s']:,.0f} points/s, "
+                               f"baseline {base['points_per_s']:,.0f}")
+        if result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + threshold):
+            regressions.append(f"{result_key(result)}: peak RSS {result['peak_rss_mb']:,.0f} MB, "
+                               f"baseline {base['peak_rss_mb']:,.0f} MB")
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic Semantic3D scans')
+    parser.add_argument('--sizes', nargs='+', default=['1M'],
+                        help='Numbers of points of the synthetic scans, e.g. 1M 10M 100M')
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=list(STAGES),
+                        help='Stages to time (default: all)')
+    parser.add_argument('--data_dir', default='benchmarks/data',
+                        help='Directory of the generated scans, reused across runs')
+    parser.add_argument('--results_dir', default='benchmarks/results',
+                        help='Directory of history.json and baseline.json')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Runs per stage; the fastest one is recorded')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='Allowed relative loss of throughput and growth of peak RSS')
+    parser.add_argument('--save_baseline', action='store_true',
+                        help='Store the results as the new baseline instead of checking them')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the synthetic scans')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    results = []
+    for size in args.sizes:
+        num_points = parse_size(size)
+        print(f"Preparing synthetic scan of {num_points:,} points")
+        scan = prepare_scan(args.data_dir, num_points, args.seed)
+        for stage in args.stages:
+            out_dir = os.path.join(args.data_dir, 'out', stage)
+            result = measure(stage, scan, out_dir, args.repeat)
+            print(f"{result_key(result)}: {result['seconds']:.2f} s, "
+                  f"{result['points_per_s']:,.0f} points/s, peak RSS {result['peak_rss_mb']:,.0f} MB")
+            results.append(result)
+
+    history_path = os.path.join(args.results_dir, HISTORY_NAME)
+    history = load_json(history_path, [])
+    history.append({
+        'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'results': results
+    })
+    save_json(history, history_path)
+
+    baseline_path = os.path.join(args.results_dir, BASELINE_NAME)
+    baseline = load_json(baseline_path, {})
+    if args.save_baseline:
+        baseline.update({result_key(result): {'points_per_s': result['points_per_s'],
+                                              'peak_rss_mb': result['peak_rss_mb']}
+                         for result in results})
+        save_json(baseline, baseline_path)
+        print(f"Saved baseline to {baseline_path}")
+        return
+
+    missing = [result_key(result) for result in results if result_key(result) not in baseline]
+    if missing:
+        print(f"No baseline for {', '.join(missing)}; store one with --save_baseline")
+    regressions = find_regressions(results, baseline, args.threshold)
+    if regressions:
+        print(f"Regressions beyond {args.threshold:.0%} of the baseline:")
+        for message in regressions:
+            print(f"  {message}")
+        sys.exit(1)
+    print("No regressions")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""Deterministic synthetic scans in the Semantic3D text formats.
+
+A scan is written as `<name>.txt` with one `x y z intensity r g b` row per
+point (coordinates with 3 decimals, integer intensity and colors, as in the
+raw Semantic3D files) and `<name>.labels` with one label per row. Points
+are drawn class by class with roughly the class balance of Semantic3D:
+ground classes on a gently sloped plane, buildings on vertical walls,
+vegetation in blobs around trees, cars as boxes and scanning artefacts
+scattered through the volume.
+
+The content depends only on the number of points and the seed; rows are
+generated and written in chunks, so scans of 100M points never have to be
+held in memory.
+"""
+import os
+import numpy as np
+
+# Share of the points of labels 0..8 (unlabeled, man-made terrain, natural
+# terrain, high vegetation, low vegetation, buildings, hard scape, scanning
+# artefacts, cars)
+CLASS_FRACTIONS = np.array([0.10, 0.17, 0.16, 0.20, 0.04, 0.23, 0.04, 0.03, 0.03])
+
+# Side of the square scene in meters
+SCENE_SIZE = 200.0
+
+# Trees, buildings and cars of a scene
+NUM_OBJECTS = 64
+
+# Rows generated and written at once
+CHUNK_ROWS = 2**20
+
+ROW_FORMAT = '%.3f %.3f %.3f %d %d %d %d'
+
+
+def scan_paths(out_dir, num_points, seed=0):
+    """Cloud and labels paths of the scan with `num_points` points and `seed`."""
+    name = f'synthetic_{num_points}_{seed}'
+    return os.path.join(out_dir, name + '.txt'), os.path.join(out_dir, name + '.labels')
+
+
+def scene_objects(seed):
+    """Positions and sizes of the trees, buildings and cars of a scene."""
+    rng = np.random.default_rng([seed, 0])
+    return {
+        'centers': rng.uniform(0, SCENE_SIZE, (NUM_OBJECTS, 2)),
+        'sizes': rng.uniform(0.5, 1.5, NUM_OBJECTS),
+        'angles': rng.uniform(0, np.pi, NUM_OBJECTS)
+    }
+
+
+def ground_height(x, y):
+    return 0.02 * x + 0.01 * y + 0.3 * np.sin(x / 15.0) * np.cos(y / 20.0)
+
+
+def generate_chunk(num_rows, objects, rng):
+    """Rows of one chunk.
+
+    Returns:
+        (points, labels): float64 array of shape (num_rows, 7) with xyz,
+        intensity and rgb, and int array of shape (num_rows,).
+    """
+    labels = rng.choice(len(CLASS_FRACTIONS), num_rows, p=CLASS_FRACTIONS / CLASS_FRACTIONS.sum())
+    obj = rng.integers(0, NUM_OBJECTS, num_rows)
+    cx, cy = objects['centers'][obj, 0], objects['centers'][obj, 1]
+    size = objects['sizes'][obj]
+
+    # Terrain, hard scape and unlabeled points lie on the ground
+    x = rng.uniform(0, SCENE_SIZE, num_rows)
+    y = rng.uniform(0, SCENE_SIZE, num_rows)
+    z = np.zeros(num_rows)
+
+    # Vegetation: blobs around the trees, low vegetation near the ground
+    veg = (labels == 3) | (labels == 4)
+    spread = np.where(labels == 4, 1.5, 3.0) * size
+    x = np.where(veg, cx + rng.normal(0, 1, num_rows) * spread, x)
+    y = np.where(veg, cy + rng.normal(0, 1, num_rows) * spread, y)
+    z = np.where(labels == 3, 4 + np.abs(rng.normal(0, 3, num_rows)) * size, z)
+    z = np.where(labels == 4, np.abs(rng.normal(0, 0.4, num_rows)), z)
+
+    # Buildings: walls of 20 m squares up to 15 m high
+    building = labels == 5
+    side = rng.integers(0, 4, num_rows)
+    along = rng.uniform(-10, 10, num_rows) * size
+    offset = np.where(side < 2, -10.0, 10.0) * size
+    x = np.where(building, cx + np.where(side % 2 == 0, along, offset), x)
+    y = np.where(building, cy + np.where(side % 2 == 0, offset, along), y)
+    z = np.where(building, rng.uniform(0, 15, num_rows) * size, z)
+
+    # Cars: boxes of 4.5 x 1.8 x 1.5 m, rotated
+    car = labels == 8
+    u = rng.uniform(-2.25, 2.25, num_rows)
+    v = rng.uniform(-0.9, 0.9, num_rows)
+    angle = objects['angles'][obj]
+    x = np.where(car, cx + u * np.cos(angle) - v * np.sin(angle), x)
+    y = np.where(car, cy + u * np.sin(angle) + v * np.cos(angle), y)
+    z = np.where(car, rng.uniform(0.3, 1.5, num_rows), z)
+
+    # Scanning artefacts: scattered through the volume
+    artefact = labels == 7
+    z = np.where(artefact, rng.uniform(0, 20, num_rows), z)
+
+    z = z + ground_height(x, y) + rng.normal(0, 0.01, num_rows)
+
+    # Intensity in the raw range of the scanner, colors by class
+    base_color = np.array([[128, 128, 128], [140, 140, 140], [120, 100, 70],
+                           [40, 110, 40], [90, 140, 60], [180, 160, 150],
+                           [100, 100, 110], [200, 200, 200], [30, 30, 160]])
+    intensity = rng.integers(-2048, 2048, num_rows)
+    rgb = np.clip(base_color[labels] + rng.normal(0, 20, (num_rows, 3)), 0, 255).round()
+
+    points = np.column_stack([x, y, z, intensity, rgb])
+    return points, labels
+
+
+def generate_scan(out_dir, num_points, seed=0, chunk_rows=CHUNK_ROWS):
+    """Write the scan with `num_points` points and `seed` into `out_dir`.
+
+    Existing scans are reused; files are written under a temporary name and
+    renamed when complete.
+
+    Returns:
+        (cloud_path, labels_path)
+    """
+    cloud_path, labels_path = scan_paths(out_dir, num_points, seed)
+    if os.path.exists(cloud_path) and os.path.exists(labels_path):
+        return cloud_path, labels_path
+
+    os.makedirs(out_dir, exist_ok=True)
+    objects = scene_objects(seed)
+    with open(cloud_path + '.tmp', 'w') as cloud_file, open(labels_path + '.tmp', 'w') as labels_file:
+        for chunk, start in enumerate(range(0, num_points, chunk_rows)):
+            # Each chunk has its own generator, so the content does not depend
+            # on how far earlier chunks consumed theirs
+            rng = np.random.default_rng([seed, 1, chunk])
+            points, labels = generate_chunk(min(chunk_rows, num_points - start), objects, rng)
+            np.savetxt(cloud_file, points, fmt=ROW_FORMAT)
+            np.savetxt(labels_file, labels, fmt='%d')
+    os.replace(cloud_path + '.tmp', cloud_path)
+    os.replace(labels_path + '.tmp', labels_path)
+    return cloud_path, labels_path
+
+
+def noisy_predictions(labels_path, out_path, accuracy=0.8, seed=0, chunk_rows=CHUNK_ROWS):
+    """Write predictions that agree with the labels of `labels_path` on about `accuracy` of the points."""
+    if os.path.exists(out_path):
+        return out_path
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    with open(labels_path, 'r') as src, open(out_path + '.tmp', 'w') as dst:
+        for chunk, lines in enumerate(iter(lambda: src.readlines(chunk_rows * 2), [])):
+            labels = np.array(lines, dtype=np.int64)
+            rng = np.random.default_rng([seed, 2, chunk])
+            wrong = rng.random(len(labels)) > accuracy
+            labels[wrong] = rng.integers(1, len(CLASS_FRACTIONS), int(wrong.sum()))
+            # Predictions never contain the unlabeled class
+            labels[labels == 0] = 1
+            np.savetxt(dst, labels, fmt='%d')
+    os.replace(out_path + '.tmp', out_path)
+    return out_path
@@ -1,10 +1,18 @@
 #!/bin/bash
 
-if [ "$#" -ne 1 ]; then
+if [ "$#" -lt 1 ] || [ "$#" -gt 2 ] || { [ "$#" -eq 2 ] && [ "$2" != "--no-extract" ]; }; then
     echo "Please, provide the base directory to store the dataset."
+    echo "Usage: $0 BASE_DIR [--no-extract]"
     exit 1
 fi
 
+# With --no-extract the archives are only downloaded into zip_files, for
+# src/processing/ingest_archives.py to read them without extracted text files
+EXTRACT=1
+if [ "$2" == "--no-extract" ]; then
+    EXTRACT=0
+fi
+
 if ! command -v 7z &> /dev/null
 then
     echo "Error: 7z could not be found. Please, install it to continue."
@@ -49,12 +57,14 @@ wget -c -N http://semantic3d.net/data/point-clouds/testing1/stgallencathedral_st
 wget -c -N http://semantic3d.net/data/point-clouds/testing1/stgallencathedral_station3_intensity_rgb.7z -P $BASE_DIR
 wget -c -N http://semantic3d.net/data/point-clouds/testing1/stgallencathedral_station6_intensity_rgb.7z -P $BASE_DIR
 
-for entry in "$BASE_DIR"/*.7z
-do
-  7z x "$entry" -o$(dirname "$entry") -y
-done
+if [ "$EXTRACT" -eq 1 ]; then
+  for entry in "$BASE_DIR"/*.7z
+  do
+    7z x "$entry" -o$(dirname "$entry") -y
+  done
 
-mv $BASE_DIR/station1_xyz_intensity_rgb.txt $BASE_DIR/neugasse_station1_xyz_intensity_rgb.txt
+  mv $BASE_DIR/station1_xyz_intensity_rgb.txt $BASE_DIR/neugasse_station1_xyz_intensity_rgb.txt
+fi
 
 # cleanup
 mkdir -p $BASE_DIR/zip_files
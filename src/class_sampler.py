@@ -0,0 +1,188 @@
+"""Class-balanced crop sampling for training on Semantic3D.
+
+With uniformly random crop centres most crops are centred on terrain and
+buildings, while scanning artefacts and cars (labels 7 and 8) are about 1% of
+the points. `ClassBalancedSampler` first draws the class of the crop centre,
+with probabilities following `class_weights` (the per-class point counts of
+the train split) raised to `power`, or given explicitly as
+`class_frequencies`:
+
+    p_c ~ class_weights[c] ** power     power 1: natural frequencies, 0: equal
+
+The cloud is drawn among those containing class c, in proportion to their
+points of class c (the per-cloud `class_counts` of `dataset_stats.json`).
+
+Open3D-ML passes the point sampler only the arrays of the current cloud, not
+its name, so the class of the centre is drawn again by the same
+probabilities among the classes present in that cloud, and the centre is a
+random subsampled point of that class. The point indices of every class are found once per cloud
+and worker and kept with the cloud's KD-tree, which the preprocessing cache
+holds for the whole run.
+
+Select it in the dataset config:
+
+    sampler:
+      name: ClassBalancedSampler
+      power: 0.5
+
+Splits other than training are sampled uniformly, as by SemSegRandomSampler.
+"""
+import os
+import random
+import logging
+import weakref
+import numpy as np
+from open3d._ml3d.utils import SAMPLER
+from src.processing.dataset_stats import NUM_LABELS, STATS_NAME, load_cloud_index
+
+# Exponent applied to the class weights when no frequencies are given
+DEFAULT_POWER = 0.5
+
+TRAIN_SPLITS = ('train', 'training')
+
+log = logging.getLogger(__name__)
+
+
+def class_probabilities(class_weights, power=DEFAULT_POWER, class_frequencies=None):
+    """Probabilities of drawing a crop centre of labels 0..8.
+
+    Args:
+        class_weights: Point counts of classes 1..8.
+        power: Exponent applied to `class_weights`.
+        class_frequencies: Relative frequencies of classes 1..8, used instead
+            of `class_weights ** power` if given.
+
+    Returns:
+        An array of shape (NUM_LABELS,); label 0 (unlabeled) has probability 0.
+    """
+    if class_frequencies is not None:
+        weights = np.asarray(class_frequencies, dtype=np.float64)
+    else:
+        weights = np.asarray(class_weights, dtype=np.float64) ** power
+    if weights.shape != (NUM_LABELS - 1,) or weights.min() < 0 or weights.sum() <= 0:
+        raise ValueError(f"Expected {NUM_LABELS - 1} non-negative class frequencies, "
+                         f"got {weights.tolist()}")
+    probs = np.zeros(NUM_LABELS)
+    probs[1:] = weights / weights.sum()
+    return probs
+
+
+def cloud_class_counts(path_list, dataset_path):
+    """Per-label point counts of the clouds of `path_list` from the dataset statistics.
+
+    Returns:
+        An array of shape (len(path_list), NUM_LABELS), or None if the
+        statistics do not cover every cloud.
+    """
+    clouds = load_cloud_index(dataset_path) or {}
+    counts = []
+    for path in path_list:
+        record = clouds.get(os.path.basename(path))
+        if record is None or record.get('class_counts') is None:
+            return None
+        counts.append(record['class_counts'])
+    return np.asarray(counts, dtype=np.float64).reshape(len(path_list), NUM_LABELS)
+
+
+class ClassIndex(object):
+    """Point indices of every class of a subsampled cloud, found on first use."""
+
+    def __init__(self, label):
+        self.counts = np.bincount(label, minlength=NUM_LABELS)[:NUM_LABELS]
+        self.points = {}
+
+    def points_of(self, label, c):
+        if c not in self.points:
+            self.points[c] = np.flatnonzero(label == c).astype(np.int32)
+        return self.points[c]
+
+
+class ClassBalancedSampler(object):
+    """Random sampler drawing crop centres by class frequencies."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.length = len(dataset)
+        self.split = self.dataset.split
+
+        cfg = dataset.cfg.get('sampler', {})
+        self.balanced = self.split in TRAIN_SPLITS
+        self.class_probs = class_probabilities(dataset.cfg.class_weights,
+                                               cfg.get('power', DEFAULT_POWER),
+                                               cfg.get('class_frequencies'))
+
+        self.cloud_probs = None
+        if self.balanced:
+            counts = cloud_class_counts(dataset.path_list, dataset.cfg.dataset_path)
+            if counts is None:
+                log.warning(f"{STATS_NAME} has no class counts of the {self.split} clouds, "
+                            f"drawing clouds uniformly; re-run src/processing/dataset_stats.py")
+            else:
+                # Row c: probabilities of the clouds given a centre of class c
+                totals = counts.sum(axis=0)
+                self.cloud_probs = (counts / np.where(totals > 0, totals, 1)).T
+                self.class_probs = self.class_probs * (totals > 0)
+                self.class_probs /= self.class_probs.sum()
+
+    def __len__(self):
+        return self.length
+
+    def initialize_with_dataloader(self, dataloader):
+        self.length = len(dataloader)
+
+    def get_cloud_sampler(self):
+
+        def gen():
+            num_clouds = len(self.dataset)
+            for _ in range(self.length):
+                if self.cloud_probs is None:
+                    yield np.random.randint(num_clouds)
+                else:
+                    c = np.random.choice(NUM_LABELS, p=self.class_probs)
+                    yield np.random.choice(num_clouds, p=self.cloud_probs[c])
+
+        return gen()
+
+    def get_point_sampler(self):
+        class_probs = self.class_probs if self.balanced else None
+        # Per-cloud class indices of this process, dropped with the KD-tree
+        indices = weakref.WeakKeyDictionary()
+
+        def _class_balanced_gen(**kwargs):
+            pc = kwargs.get('pc', None)
+            label = kwargs.get('label', None)
+            num_points = kwargs.get('num_points', None)
+            search_tree = kwargs.get('search_tree', None)
+            if pc is None or label is None or num_points is None or search_tree is None:
+                raise KeyError("Please provide pc, label, num_points, and search_tree "
+                               "for point_sampler in ClassBalancedSampler")
+
+            center_idx = None
+            if class_probs is not None:
+                index = indices.get(search_tree)
+                if index is None or index.counts.sum() != len(label):
+                    index = ClassIndex(label)
+                    indices[search_tree] = index
+                probs = class_probs * (index.counts > 0)
+                if probs.sum() > 0:
+                    c = np.random.choice(NUM_LABELS, p=probs / probs.sum())
+                    center_idx = np.random.choice(index.points_of(label, c))
+            if center_idx is None:
+                center_idx = np.random.randint(len(pc))
+            center_point = pc[center_idx, :].reshape(1, -1)
+
+            if (pc.shape[0] < num_points):
+                diff = num_points - pc.shape[0]
+                idxs = np.array(range(pc.shape[0]))
+                idxs = list(idxs) + list(random.choices(idxs, k=diff))
+                idxs = np.asarray(idxs)
+            else:
+                idxs = search_tree.query(center_point, k=num_points)[1][0]
+            random.shuffle(idxs)
+            pc = pc[idxs]
+            return pc, idxs, center_point
+
+        return _class_balanced_gen
+
+
+SAMPLER._register_module(ClassBalancedSampler)
@@ -1,99 +1,569 @@
 import os
+import glob
+import json
+import hashlib
+import argparse
 import numpy as np
 import logging
 from collections import defaultdict
+from src.processing.cloud_io import (BINARY_EXT, cloud_name, is_binary_cloud,
+                                     load_labels, owned_rows)
+from src.processing.text_stream import iter_labels
+from src.processing.scheduler import run_budgeted
 
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler("eval_metrics.txt", mode='w'),  # Save output to a file
-        logging.StreamHandler()  # Also print to console
-    ]
-)
-
-# Paths
-gt_dir = 'Semantic3D/processed'
-pred_dir = 'test/Semantic3D'
-
-# List prediction files
-pred_files = [f for f in os.listdir(pred_dir) if f.endswith('.labels')]
-
-# Storage for overall metrics
-all_per_class_iou = defaultdict(list)
-all_per_class_acc = defaultdict(list)
-all_total_tp = 0
-all_total_fp = 0
-all_total_fn = 0
-all_total_correct = 0
-all_total_samples = 0
-
-# Process each prediction file
-for pred_file in pred_files:
-    pred_path = os.path.join(pred_dir, pred_file)
-    gt_path = os.path.join(gt_dir, pred_file)
+# Label 0 (unlabeled) plus the 8 Semantic3D classes
+NUM_CLASSES = 9
+IGNORED_LABEL = 0
+
+# Labels streamed per chunk and ground truth file. Text is parsed in blocks
+# of about the same number of rows (one digit and a newline per label).
+CHUNK_ROWS = 2**22
+MIN_CHUNK_ROWS = 2**16
+LABEL_BYTES_PER_ROW = 2
+
+# Parsed ground truth is cached as raw uint8 labels
+LABEL_CACHE_EXT = '.u8'
+
+
+def confusion_matrix(gt_labels, pred_labels, num_classes=NUM_CLASSES):
+    """Confusion matrix of one file in a single pass over the labels.
+
+    Rows are ground truth, columns predictions. Points whose ground truth is
+    the ignored label are dropped.
+    """
+    gt_labels = np.asarray(gt_labels, dtype=np.int64)
+    pred_labels = np.asarray(pred_labels, dtype=np.int64)
+    if pred_labels.size and (pred_labels.min() < 0 or pred_labels.max() >= num_classes):
+        raise ValueError(f"Predicted labels must be in [0, {num_classes})")
+
+    cm = np.bincount(gt_labels * num_classes + pred_labels,
+                     minlength=num_classes * num_classes)
+    cm = cm.reshape(num_classes, num_classes)
+    cm[IGNORED_LABEL, :] = 0
+    return cm
+
+
+def metrics_from_confusion(cm):
+    """Per-class IoU/accuracy and global metrics of a confusion matrix.
+
+    Only classes that occur in the ground truth or the predictions are
+    reported, the ignored label never is.
+
+    Returns:
+        A dict with `iou` and `acc` (class -> value), `mean_iou`, `mean_acc`
+        and `overall_acc`.
+    """
+    tp = np.diag(cm).astype(np.float64)
+    gt_count = cm.sum(axis=1)
+    pred_count = cm.sum(axis=0)
+    union = gt_count + pred_count - tp
+
+    classes = [c for c in range(len(cm))
+               if c != IGNORED_LABEL and (gt_count[c] > 0 or pred_count[c] > 0)]
+    iou = {c: tp[c] / union[c] if union[c] > 0 else 0.0 for c in classes}
+    acc = {c: tp[c] / gt_count[c] if gt_count[c] > 0 else 0.0 for c in classes}
+
+    total = cm.sum()
+    return {
+        'iou': iou,
+        'acc': acc,
+        'mean_iou': np.mean(list(iou.values())) if iou else 0.0,
+        'mean_acc': np.mean(list(acc.values())) if acc else 0.0,
+        'overall_acc': tp.sum() / total if total > 0 else 0.0
+    }
 
+
+def file_mean_metrics(file_cms):
+    """Per-class metrics averaged over files instead of pooled over points.
+
+    Each class is averaged over the files in which it occurs, which is how
+    the numbers in the README were produced.
+    """
+    per_class_iou = defaultdict(list)
+    per_class_acc = defaultdict(list)
+    for cm in file_cms:
+        file_metrics = metrics_from_confusion(cm)
+        for c in file_metrics['iou']:
+            per_class_iou[c].append(file_metrics['iou'][c])
+            per_class_acc[c].append(file_metrics['acc'][c])
+
+    iou = {c: np.mean(per_class_iou[c]) for c in sorted(per_class_iou)}
+    acc = {c: np.mean(per_class_acc[c]) for c in sorted(per_class_acc)}
+    total_cm = np.sum(file_cms, axis=0) if file_cms else np.zeros((NUM_CLASSES, NUM_CLASSES))
+    total = total_cm.sum()
+
+    return {
+        'iou': iou,
+        'acc': acc,
+        'mean_iou': np.mean(list(iou.values())) if iou else 0.0,
+        'mean_acc': np.mean(list(acc.values())) if acc else 0.0,
+        'overall_acc': np.trace(total_cm) / total if total > 0 else 0.0
+    }
+
+
+def find_gt_path(gt_dir, pred_file):
+    """Ground truth of a prediction file: a .labels file or a binary container."""
+    gt_path = os.path.join(gt_dir, pred_file)
     if not os.path.exists(gt_path):
-        logging.warning(f"Ground truth file not found for {pred_file}, skipping...")
-        continue
-
-    # Load labels
-    gt_labels = np.loadtxt(gt_path, dtype=np.int32)
-    pred_labels = np.loadtxt(pred_path, dtype=np.int32)
-
-    assert gt_labels.shape == pred_labels.shape, f"Shape mismatch for {pred_file}"
-
-    # Mask to skip invalid labels (gt == 0)
-    valid_mask = gt_labels != 0
-    gt_labels = gt_labels[valid_mask]
-    pred_labels = pred_labels[valid_mask]
-
-    classes = np.unique(np.concatenate((gt_labels, pred_labels)))
-
-    file_total_tp = 0
-    file_total_fp = 0
-    file_total_fn = 0
-
-    for cls in classes:
-        tp = np.sum((gt_labels == cls) & (pred_labels == cls))
-        fp = np.sum((gt_labels != cls) & (pred_labels == cls))
-        fn = np.sum((gt_labels == cls) & (pred_labels != cls))
-
-        intersection = tp
-        union = tp + fp + fn
-        iou = intersection / union if union > 0 else 0.0
-        acc = tp / (tp + fn) if (tp + fn) > 0 else 0.0
-
-        all_per_class_iou[cls].append(iou)
-        all_per_class_acc[cls].append(acc)
-
-        file_total_tp += tp
-        file_total_fp += fp
-        file_total_fn += fn
-
-    all_total_tp += file_total_tp
-    all_total_fp += file_total_fp
-    all_total_fn += file_total_fn
-    all_total_correct += np.sum(gt_labels == pred_labels)
-    all_total_samples += len(gt_labels)
-# Calculate final metrics
-logging.info("Average Per-class IoU:")
-per_class_ious = []
-for cls in sorted(all_per_class_iou.keys()):
-    avg_iou = np.mean(all_per_class_iou[cls])
-    per_class_ious.append(avg_iou)  # Store for mIoU calculation
-    logging.info(f"Class {cls}: {avg_iou:.4f}")
-
-logging.info("Average Per-class Accuracy:")
-per_class_accs = []
-for cls in sorted(all_per_class_acc.keys()):
-    avg_acc = np.mean(all_per_class_acc[cls])
-    per_class_accs.append(avg_acc)  # Store for mean accuracy calculation
-    logging.info(f"Class {cls}: {avg_acc:.4f}")
-
-mean_acc = np.mean(per_class_accs) if per_class_accs else 0.0  # Mean of per-class accuracies
-mean_iou = np.mean(per_class_ious) if per_class_ious else 0.0  # Mean of per-class IoUs (mIoU)
-
-logging.info(f"Mean Accuracy: {mean_acc:.4f}")
-logging.info(f"Mean IoU (mIoU): {mean_iou:.4f}")
\ No newline at end of file
+        gt_path = os.path.join(gt_dir, pred_file.replace('.labels', BINARY_EXT))
+    return gt_path if os.path.exists(gt_path) else None
+
+
+def label_cache_path(cache_dir, gt_path):
+    """Cache file of a text ground truth file.
+
+    The name contains a hash of the absolute path and one of size and mtime,
+    so a modified ground truth file gets a new cache entry.
+    """
+    stat = os.stat(gt_path)
+    path_key = hashlib.sha1(os.path.abspath(gt_path).encode('utf-8')).hexdigest()[:8]
+    state_key = hashlib.sha1(f"{stat.st_size}:{stat.st_mtime_ns}".encode('utf-8')).hexdigest()[:8]
+    return os.path.join(cache_dir, f"{cloud_name(gt_path)}-{path_key}-{state_key}{LABEL_CACHE_EXT}")
+
+
+def owned_count(start, length, owned):
+    """Number of leading rows of a chunk at row `start` that are owned.
+
+    `owned` is the number of owned leading rows of the cloud (see
+    `cloud_io.owned_rows`), None if all rows are owned.
+    """
+    if owned is None:
+        return length
+    return max(0, min(length, owned - start))
+
+
+def _iter_slices(labels, chunk_rows):
+    for start in range(0, len(labels), chunk_rows):
+        yield labels[start:start + chunk_rows]
+
+
+def iter_gt_chunks(gt_path, chunk_rows=CHUNK_ROWS, cache_dir=None):
+    """Stream ground truth labels in chunks of `chunk_rows`.
+
+    Binary containers and cached files are memory-mapped. Text files are
+    parsed in blocks; with a `cache_dir`, the parsed labels are written to
+    the cache on the way, so the next evaluation skips the parsing.
+    """
+    if is_binary_cloud(gt_path):
+        yield from _iter_slices(load_labels(gt_path), chunk_rows)
+        return
+    if cache_dir is None:
+        yield from iter_labels(gt_path, chunk_rows, LABEL_BYTES_PER_ROW * chunk_rows)
+        return
+
+    cache_path = label_cache_path(cache_dir, gt_path)
+    if os.path.exists(cache_path):
+        if os.path.getsize(cache_path) == 0:
+            return
+        yield from _iter_slices(np.memmap(cache_path, dtype=np.uint8, mode='r'), chunk_rows)
+        return
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    complete = False
+    try:
+        with open(tmp_path, 'wb') as f:
+            for chunk in iter_labels(gt_path, chunk_rows, LABEL_BYTES_PER_ROW * chunk_rows):
+                if chunk.min() < 0 or chunk.max() > np.iinfo(np.uint8).max:
+                    raise ValueError(f"Labels of {gt_path} do not fit into uint8")
+                f.write(chunk.astype(np.uint8).tobytes())
+                yield chunk
+        complete = True
+    finally:
+        if not complete:
+            os.remove(tmp_path)
+
+    # Replace the entry of an older version of the same file
+    file_prefix = cache_path[:cache_path.rindex('-')]
+    for stale_path in glob.glob(glob.escape(file_prefix) + '-*' + LABEL_CACHE_EXT):
+        os.remove(stale_path)
+    os.replace(tmp_path, cache_path)
+
+
+def evaluate_file_runs(gt_path, pred_paths, chunk_rows=CHUNK_ROWS, cache_dir=None):
+    """Confusion matrices of several predictions of one ground truth file.
+
+    The ground truth is streamed once and every chunk of it is counted
+    against the matching chunk of each prediction file. The runs share the
+    `chunk_rows` budget, so memory does not grow with the number of runs.
+    Of a tile only the points it owns are counted; its margin is counted
+    with the tile that owns it.
+
+    Returns:
+        A list with one confusion matrix per prediction file, None for a
+        prediction whose length does not match the ground truth.
+    """
+    chunk_rows = max(MIN_CHUNK_ROWS, chunk_rows // max(1, len(pred_paths)))
+    cms = [np.zeros((NUM_CLASSES, NUM_CLASSES), dtype=np.int64) for _ in pred_paths]
+    readers = [iter_labels(pred_path, chunk_rows, LABEL_BYTES_PER_ROW * chunk_rows)
+               for pred_path in pred_paths]
+
+    def drop_run(i):
+        readers[i].close()
+        readers[i] = None
+        cms[i] = None
+
+    owned = owned_rows(gt_path)
+    start = 0
+    gt_chunks = iter_gt_chunks(gt_path, chunk_rows, cache_dir)
+    try:
+        for gt_chunk in gt_chunks:
+            keep = owned_count(start, len(gt_chunk), owned)
+            start += len(gt_chunk)
+            for i, reader in enumerate(readers):
+                if reader is None:
+                    continue
+                pred_chunk = next(reader, None)
+                if pred_chunk is None or len(pred_chunk) != len(gt_chunk):
+                    drop_run(i)
+                    continue
+                cms[i] += confusion_matrix(gt_chunk[:keep], pred_chunk[:keep])
+
+        for i, reader in enumerate(readers):
+            if reader is not None and next(reader, None) is not None:
+                drop_run(i)
+    finally:
+        gt_chunks.close()
+        for reader in readers:
+            if reader is not None:
+                reader.close()
+    return cms
+
+
+def evaluate_file(gt_path, pred_path, chunk_rows=CHUNK_ROWS, cache_dir=None):
+    """Confusion matrix of one prediction file, streamed chunk by chunk."""
+    cm = evaluate_file_runs(gt_path, [pred_path], chunk_rows, cache_dir)[0]
+    if cm is None:
+        raise ValueError(f"Shape mismatch for {os.path.basename(pred_path)}")
+    return cm
+
+
+def metrics_from_files(file_cms, mode='global'):
+    """Metrics of a run given the confusion matrix of each of its files.
+
+    Returns:
+        The metrics dict of `metrics_from_confusion`, plus `confusion` (the
+        summed matrix) and `files` (file name -> confusion matrix).
+    """
+    total_cm = np.zeros((NUM_CLASSES, NUM_CLASSES), dtype=np.int64)
+    for cm in file_cms.values():
+        total_cm += cm
+
+    if mode == 'file_mean':
+        metrics = file_mean_metrics(list(file_cms.values()))
+    else:
+        metrics = metrics_from_confusion(total_cm)
+
+    metrics['confusion'] = total_cm
+    metrics['files'] = file_cms
+    return metrics
+
+
+class StreamingMetrics(object):
+    """Running confusion matrices of predictions, per file and in total.
+
+    Predictions are counted against their ground truth as they are produced,
+    so metrics are available without writing and re-parsing .labels files.
+    The state is saved in the JSON format of `save_metrics_json` and can be
+    restored from it, so an interrupted run keeps the files it counted.
+    """
+
+    def __init__(self, gt_dir, mode='global', cache_dir=None, chunk_rows=CHUNK_ROWS):
+        """Initialize.
+
+        Args:
+            gt_dir: Directory with ground truth .labels files or binary containers.
+            mode: 'global' or 'file_mean', see `evaluate_runs`.
+            cache_dir: Directory caching parsed ground truth labels, no
+                caching if None.
+            chunk_rows: Number of ground truth labels held in memory at once.
+        """
+        self.gt_dir = gt_dir
+        self.mode = mode
+        self.cache_dir = cache_dir
+        self.chunk_rows = chunk_rows
+        self.file_cms = {}
+
+    def gt_path(self, name):
+        """Ground truth of cloud `name`, None if there is none."""
+        return find_gt_path(self.gt_dir, name + '.labels')
+
+    def update(self, name, pred_labels):
+        """Count the predicted labels of a whole cloud against its ground truth.
+
+        Of a tile only the points it owns are counted.
+
+        Returns:
+            The confusion matrix of the cloud.
+        """
+        gt_path = self.gt_path(name)
+        if gt_path is None:
+            raise FileNotFoundError(f"Ground truth file not found for {name}")
+
+        cm = np.zeros((NUM_CLASSES, NUM_CLASSES), dtype=np.int64)
+        owned = owned_rows(gt_path)
+        start = 0
+        for gt_chunk in iter_gt_chunks(gt_path, self.chunk_rows, self.cache_dir):
+            pred_chunk = pred_labels[start:start + len(gt_chunk)]
+            if len(pred_chunk) != len(gt_chunk):
+                raise ValueError(f"Shape mismatch for {name}: fewer predictions than labels")
+            keep = owned_count(start, len(gt_chunk), owned)
+            cm += confusion_matrix(gt_chunk[:keep], pred_chunk[:keep])
+            start += len(gt_chunk)
+        if start != len(pred_labels):
+            raise ValueError(f"Shape mismatch for {name}: more predictions than labels")
+
+        self.file_cms[name + '.labels'] = cm
+        return cm
+
+    def __contains__(self, name):
+        return name + '.labels' in self.file_cms
+
+    def metrics(self):
+        """Metrics of the files counted so far, as `metrics_from_files`."""
+        return metrics_from_files(dict(self.file_cms), self.mode)
+
+    def summary(self, name=None):
+        """One line with the metrics of cloud `name` and of all files so far."""
+        total = self.metrics()
+        line = (f"{len(self.file_cms)} files: OA {total['overall_acc']:.4f}, "
+                f"mIoU {total['mean_iou']:.4f}")
+        if name is not None:
+            cloud = metrics_from_confusion(self.file_cms[name + '.labels'])
+            line = (f"{name}: OA {cloud['overall_acc']:.4f}, mIoU {cloud['mean_iou']:.4f}; "
+                    + line)
+        return line
+
+    def save(self, path, run):
+        """Save the metrics of the files counted so far as JSON, atomically."""
+        tmp_path = path + '.tmp'
+        save_metrics_json(self.metrics(), tmp_path, run, self.mode)
+        os.replace(tmp_path, path)
+
+    def restore(self, path):
+        """Restore the files counted by a previous run from its JSON.
+
+        Returns:
+            The number of restored files, 0 if the file is missing or was
+            saved with another mode.
+        """
+        if not os.path.exists(path):
+            return 0
+        with open(path, 'r') as f:
+            saved = json.load(f)
+        if saved.get('mode') != self.mode:
+            return 0
+        self.file_cms = {name: np.asarray(cm, dtype=np.int64)
+                         for name, cm in saved['files'].items()}
+        return len(self.file_cms)
+
+
+def expand_pred_dirs(patterns):
+    """Expand glob patterns into prediction directories, keeping the order."""
+    pred_dirs = []
+    for pattern in patterns:
+        if any(c in pattern for c in '*?['):
+            matches = sorted(path for path in glob.glob(pattern) if os.path.isdir(path))
+            if not matches:
+                logging.warning(f"No prediction directory matches {pattern}")
+        else:
+            matches = [pattern]
+        pred_dirs.extend(path for path in matches if path not in pred_dirs)
+    return pred_dirs
+
+
+def evaluate_runs(gt_dir, pred_dirs, mode='global', workers=1, cache_dir=None,
+                  chunk_rows=CHUNK_ROWS, strict=False):
+    """Evaluate several prediction directories against one ground truth.
+
+    Each ground truth file is read once and streamed against the matching
+    prediction file of every run, so a sweep over many checkpoints costs one
+    ground truth read plus one read per prediction file.
+
+    Args:
+        gt_dir: Directory with ground truth .labels files or binary containers.
+        pred_dirs: Directories with predicted .labels files, one per run.
+        mode: 'global' derives all metrics from the confusion matrix summed
+            over files, 'file_mean' averages per-file metrics.
+        workers: Number of ground truth files evaluated in parallel.
+        cache_dir: Directory caching parsed ground truth labels, no caching
+            if None.
+        chunk_rows: Number of labels held in memory per ground truth file,
+            shared by all runs.
+        strict: Raise if a prediction does not have one label per ground
+            truth point, instead of leaving it out of its run.
+
+    Returns:
+        A dict mapping each prediction directory to the metrics of
+        `metrics_from_files`, plus `dropped`: the files left out because
+        their length does not match the ground truth.
+
+    Raises:
+        ValueError: With `strict`, if the length of a prediction does not
+            match its ground truth.
+    """
+    pred_files = {pred_dir: {f for f in os.listdir(pred_dir) if f.endswith('.labels')}
+                  for pred_dir in pred_dirs}
+
+    jobs = []
+    file_runs = {}
+    for name in sorted(set().union(*pred_files.values())):
+        gt_path = find_gt_path(gt_dir, name)
+        if gt_path is None:
+            logging.warning(f"Ground truth file not found for {name}, skipping...")
+            continue
+
+        file_runs[name] = [pred_dir for pred_dir in pred_dirs if name in pred_files[pred_dir]]
+        pred_paths = [os.path.join(pred_dir, name) for pred_dir in file_runs[name]]
+        # Largest files first, so that workers finish at about the same time
+        size = sum(os.path.getsize(pred_path) for pred_path in pred_paths) / 1e6
+        jobs.append((name, size, evaluate_file_runs,
+                     (gt_path, pred_paths, chunk_rows, cache_dir)))
+
+    results = run_budgeted(jobs, workers, desc='evaluate')
+
+    run_cms = {pred_dir: {} for pred_dir in pred_dirs}
+    dropped = {pred_dir: [] for pred_dir in pred_dirs}
+    for name in sorted(results):
+        for pred_dir, cm in zip(file_runs[name], results[name]):
+            if cm is not None:
+                run_cms[pred_dir][name] = cm
+            else:
+                dropped[pred_dir].append(name)
+
+    mismatched = [os.path.join(pred_dir, name) for pred_dir in pred_dirs
+                  for name in dropped[pred_dir]]
+    if strict and mismatched:
+        raise ValueError(f"Shape mismatch for {', '.join(mismatched)}")
+
+    run_metrics = {}
+    for pred_dir in pred_dirs:
+        run_metrics[pred_dir] = metrics_from_files(run_cms[pred_dir], mode)
+        run_metrics[pred_dir]['dropped'] = dropped[pred_dir]
+        if dropped[pred_dir]:
+            logging.warning(f"{pred_dir} is incomplete, predictions of another length than "
+                            f"the ground truth are left out: {', '.join(dropped[pred_dir])}")
+    return run_metrics
+
+
+def evaluate(gt_dir, pred_dir, mode='global', workers=1, cache_dir=None,
+             chunk_rows=CHUNK_ROWS, strict=True):
+    """Evaluate every .labels prediction in pred_dir against gt_dir.
+
+    See `evaluate_runs` for the arguments.
+
+    Returns:
+        The metrics dict of `evaluate_runs`.
+    """
+    return evaluate_runs(gt_dir, [pred_dir], mode, workers, cache_dir, chunk_rows,
+                         strict)[pred_dir]
+
+
+def log_metrics(metrics, mode='global'):
+    prefix = 'Average ' if mode == 'file_mean' else ''
+
+    logging.info(f"{prefix}Per-class IoU:")
+    for cls, iou in metrics['iou'].items():
+        logging.info(f"Class {cls}: {iou:.4f}")
+
+    logging.info(f"{prefix}Per-class Accuracy:")
+    for cls, acc in metrics['acc'].items():
+        logging.info(f"Class {cls}: {acc:.4f}")
+
+    logging.info(f"Overall Accuracy: {metrics['overall_acc']:.4f}")
+    logging.info(f"Mean Accuracy: {metrics['mean_acc']:.4f}")
+    logging.info(f"Mean IoU (mIoU): {metrics['mean_iou']:.4f}")
+
+
+def comparison_table(run_metrics):
+    """Markdown table comparing the global and per-class IoU of several runs."""
+    classes = range(1, NUM_CLASSES)
+    lines = [
+        '| Run | Files | Dropped | Overall Acc | Mean Acc | mIoU | ' + ' | '.join(f'IoU {c}' for c in classes) + ' |',
+        '|---|---|---|---|---|---|' + '---|' * len(classes)
+    ]
+    for run, metrics in run_metrics.items():
+        ious = ' | '.join(f"{metrics['iou'][c]:.4f}" if c in metrics['iou'] else '-' for c in classes)
+        dropped = ', '.join(metrics.get('dropped', [])) or '-'
+        lines.append(f"| {run} | {len(metrics['files'])} | {dropped} | {metrics['overall_acc']:.4f} | "
+                     f"{metrics['mean_acc']:.4f} | {metrics['mean_iou']:.4f} | {ious} |")
+    return lines
+
+
+def save_metrics_json(metrics, path, run, mode='global'):
+    """Save the metrics and confusion matrices of one run as JSON."""
+    with open(path, 'w') as f:
+        json.dump({
+            'run': run,
+            'mode': mode,
+            'overall_acc': float(metrics['overall_acc']),
+            'mean_acc': float(metrics['mean_acc']),
+            'mean_iou': float(metrics['mean_iou']),
+            'iou': {str(c): float(v) for c, v in metrics['iou'].items()},
+            'acc': {str(c): float(v) for c, v in metrics['acc'].items()},
+            'confusion': metrics['confusion'].tolist(),
+            'files': {name: cm.tolist() for name, cm in metrics['files'].items()},
+            # Files left out because their length does not match the ground truth
+            'complete': not metrics.get('dropped'),
+            'dropped': list(metrics.get('dropped', []))
+        }, f, indent=2)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Evaluate Semantic3D predictions against ground truth')
+    parser.add_argument('--gt_dir', help='Directory containing ground truth .labels files or binary containers', default='Semantic3D/processed')
+    parser.add_argument('--pred_dir', help='Directories (or glob patterns) containing predicted .labels files, one per run', nargs='+', default=['test/Semantic3D'])
+    parser.add_argument('--mode', help='global: metrics of the summed confusion matrix; file_mean: per-file metrics averaged over files',
+                        choices=['global', 'file_mean'], default='global')
+    parser.add_argument('--workers', help='Number of files evaluated in parallel', type=int, default=1)
+    parser.add_argument('--cache_dir', help='Directory caching parsed ground truth labels (default: <gt_dir>/.label_cache)', default=None)
+    parser.add_argument('--no_cache', help='Parse ground truth text files without caching them', action='store_true')
+    parser.add_argument('--json_dir', help='Directory for the per-run JSON metrics (default: eval_metrics.json in each prediction directory)', default=None)
+    parser.add_argument('--log_file', help='File to save the metrics to', default='eval_metrics.txt')
+    parser.add_argument('--allow_mismatch', help='Leave out predictions whose length does not match the ground truth and mark '
+                        'their run incomplete, instead of failing (the default for a single prediction directory)',
+                        action='store_true')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+
+    # Setup logging
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        handlers=[
+            logging.FileHandler(args.log_file, mode='w'),  # Save output to a file
+            logging.StreamHandler()  # Also print to console
+        ]
+    )
+
+    cache_dir = None
+    if not args.no_cache:
+        cache_dir = args.cache_dir or os.path.join(args.gt_dir, '.label_cache')
+
+    pred_dirs = expand_pred_dirs(args.pred_dir)
+    strict = len(pred_dirs) == 1 and not args.allow_mismatch
+    run_metrics = evaluate_runs(args.gt_dir, pred_dirs, args.mode, args.workers, cache_dir,
+                                strict=strict)
+
+    if len(run_metrics) == 1:
+        log_metrics(next(iter(run_metrics.values())), args.mode)
+    else:
+        for line in comparison_table(run_metrics):
+            logging.info(line)
+
+    if args.json_dir is not None:
+        os.makedirs(args.json_dir, exist_ok=True)
+    for pred_dir, metrics in run_metrics.items():
+        if args.json_dir is None:
+            json_path = os.path.join(pred_dir, 'eval_metrics.json')
+        else:
+            run_name = os.path.normpath(pred_dir).strip(os.sep).replace(os.sep, '_')
+            json_path = os.path.join(args.json_dir, f'{run_name}.json')
+        save_metrics_json(metrics, json_path, pred_dir, args.mode)
+
+
+if __name__ == "__main__":
+    main()
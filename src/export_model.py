@@ -0,0 +1,319 @@
+"""Export a trained RandLANet for CPU inference.
+
+The checkpoint is loaded into the model built from the config and traced
+with a batch of synthetic crops into a TorchScript module (frozen, with
+batch norms folded into the convolutions) or an ONNX graph, optionally with
+dynamic int8 quantization. The crop preparation (sampling, KNN,
+subsampling) stays in Python; `src/test_inference.py --model_path` runs it
+in a background thread and feeds the exported model.
+
+A `<artifact>.json` sidecar records the format and the model config the
+artifact was traced with. After exporting, the eager model and the artifact
+are timed on the same crops and their points per second are reported.
+"""
+import os
+import json
+import time
+import argparse
+import logging
+import numpy as np
+import torch
+import open3d.ml as _ml3d
+import open3d.ml.torch as ml3d
+
+EXPORT_FORMATS = ('torchscript', 'onnx')
+
+# Per-layer inputs of RandLANet.forward, flattened in this order after
+# `features` so the exported graph takes plain tensors
+LAYER_INPUTS = ('coords', 'neighbor_indices', 'sub_idx', 'interp_idx')
+
+ONNX_OPSET = 17
+
+log = logging.getLogger(__name__)
+
+
+def configure_logging():
+    """Configure logging format and level"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(levelname)s - %(asctime)s - %(module)s - %(message)s',
+    )
+
+def parse_arguments():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description='Export a trained RandLANet to TorchScript or ONNX for CPU inference')
+    parser.add_argument(
+        '--config',
+        type=str,
+        default='configs/randlanet_semantic3d.yml',
+        help='Path to config file (default: randlanet_semantic3d.yml)'
+    )
+    parser.add_argument(
+        '--ckpt_path',
+        type=str,
+        required=True,
+        help='Checkpoint to export'
+    )
+    parser.add_argument(
+        '--format',
+        type=str,
+        default='torchscript',
+        choices=EXPORT_FORMATS,
+        help='Artifact format (onnx requires the onnx and onnxruntime packages)'
+    )
+    parser.add_argument(
+        '--quantize',
+        action='store_true',
+        help='Apply dynamic int8 quantization (weights of linear layers / MatMuls)'
+    )
+    parser.add_argument(
+        '--out_path',
+        type=str,
+        default=None,
+        help='Artifact path (default: next to the checkpoint)'
+    )
+    parser.add_argument(
+        '--batch_size',
+        type=int,
+        default=4,
+        help='Number of crops per batch used for tracing and benchmarking'
+    )
+    parser.add_argument(
+        '--benchmark_batches',
+        type=int,
+        default=5,
+        help='Batches timed with the eager model and the artifact (0 to skip)'
+    )
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=None,
+        help='Number of CPU threads used by torch (default: torch default)'
+    )
+    return parser.parse_args()
+
+
+def input_names(num_layers):
+    return ['features'] + [f'{key}_{i}' for key in LAYER_INPUTS for i in range(num_layers)]
+
+
+def flatten_inputs(data, num_layers):
+    """Collated RandLANet inputs as a flat tuple of tensors."""
+    tensors = [data['features']]
+    for key in LAYER_INPUTS:
+        tensors += list(data[key][:num_layers])
+    return tuple(tensors)
+
+
+class FlatRandLANet(torch.nn.Module):
+    """RandLANet taking the tensors of `flatten_inputs` as arguments."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.num_layers = model.cfg.num_layers
+
+    def forward(self, features, *tensors):
+        n = self.num_layers
+        inputs = {'features': features}
+        for k, key in enumerate(LAYER_INPUTS):
+            inputs[key] = list(tensors[k * n:(k + 1) * n])
+        return self.model(inputs)
+
+
+def meta_path(artifact_path):
+    return artifact_path + '.json'
+
+
+def load_meta(artifact_path):
+    with open(meta_path(artifact_path), 'r') as f:
+        return json.load(f)
+
+
+class ExportedModel(object):
+    """An exported artifact, called like the model on collated `inputs['data']`."""
+
+    def __init__(self, artifact_path, threads=None):
+        self.meta = load_meta(artifact_path)
+        self.format = self.meta['format']
+        self.num_layers = self.meta['num_layers']
+        self.names = input_names(self.num_layers)
+
+        if self.format == 'torchscript':
+            self.module = torch.jit.load(artifact_path, map_location='cpu')
+        elif self.format == 'onnx':
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            if threads:
+                options.intra_op_num_threads = threads
+            self.session = onnxruntime.InferenceSession(
+                artifact_path, options, providers=['CPUExecutionProvider'])
+        else:
+            raise ValueError(f"Unknown export format {self.format} in {meta_path(artifact_path)}")
+
+    def __call__(self, data):
+        tensors = flatten_inputs(data, self.num_layers)
+        if self.format == 'torchscript':
+            return self.module(*tensors)
+        feeds = {name: tensor.numpy() for name, tensor in zip(self.names, tensors)}
+        return torch.from_numpy(self.session.run(None, feeds)[0])
+
+
+def random_crop_sampler(rng):
+    """Point sampler taking random crops, for synthetic tracing inputs."""
+    def sample(pc=None, num_points=None, **kwargs):
+        idxs = rng.choice(len(pc), num_points, replace=len(pc) < num_points)
+        return pc[idxs], idxs, pc[idxs[:1]]
+    return sample
+
+
+def synthetic_batches(model, batcher, batch_size, num_batches, seed=0):
+    """Collated batches of crops of a random cloud with the model's input layout."""
+    rng = np.random.default_rng(seed)
+    num_points = 2 * model.cfg.num_points
+    data = {
+        'point': (rng.random((num_points, 3)) * 20).astype(np.float32),
+        'feat': rng.integers(0, 256, (num_points, model.cfg.in_channels - 3)).astype(np.float32),
+        'label': np.zeros(num_points, dtype=np.int32)
+    }
+    attr = {'split': 'test', 'name': 'synthetic'}
+    proc = model.preprocess(data, attr)
+    model.trans_point_sampler = random_crop_sampler(rng)
+    return [batcher.collate_fn([{'data': model.transform(proc, attr), 'attr': attr}
+                                for _ in range(batch_size)])
+            for _ in range(num_batches)]
+
+
+def export_torchscript(flat_model, example, out_path, quantize=False):
+    if quantize:
+        flat_model = torch.ao.quantization.quantize_dynamic(
+            flat_model, {torch.nn.Linear}, dtype=torch.qint8)
+    with torch.no_grad():
+        traced = torch.jit.trace(flat_model, example, check_trace=False)
+        traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+    tmp_path = out_path + '.tmp'
+    torch.jit.save(traced, tmp_path)
+    os.replace(tmp_path, out_path)
+
+
+def export_onnx(flat_model, example, out_path, num_layers, quantize=False):
+    names = input_names(num_layers)
+    dynamic_axes = {name: {0: 'batch'} for name in names}
+    dynamic_axes['scores'] = {0: 'batch'}
+    tmp_path = out_path + '.tmp'
+    with torch.no_grad():
+        torch.onnx.export(flat_model, example, tmp_path,
+                          input_names=names,
+                          output_names=['scores'],
+                          dynamic_axes=dynamic_axes,
+                          opset_version=ONNX_OPSET)
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(tmp_path, out_path, weight_type=QuantType.QInt8)
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, out_path)
+
+
+def export_model(cfg, ckpt_path, out_path, export_format='torchscript', quantize=False,
+                 batch_size=4):
+    """Export the model of `cfg` with the weights of `ckpt_path`.
+
+    Returns:
+        (model, artifact_path): the eager model, on cpu in eval mode, and the
+        written artifact.
+    """
+    Model = _ml3d.utils.get_module("model", cfg.model.name, "torch")
+    model = Model(**cfg.model)
+    ckpt = torch.load(ckpt_path, map_location='cpu')
+    model.load_state_dict(ckpt['model_state_dict'])
+    model.device = torch.device('cpu')
+    model.to(model.device)
+    model.eval()
+
+    batcher = ml3d.dataloaders.DefaultBatcher()
+    example = flatten_inputs(synthetic_batches(model, batcher, batch_size, 1)[0]['data'],
+                             model.cfg.num_layers)
+    flat_model = FlatRandLANet(model).eval()
+
+    if export_format == 'torchscript':
+        export_torchscript(flat_model, example, out_path, quantize)
+    elif export_format == 'onnx':
+        export_onnx(flat_model, example, out_path, model.cfg.num_layers, quantize)
+    else:
+        raise ValueError(f"Unknown export format {export_format}, expected one of {EXPORT_FORMATS}")
+
+    meta = {
+        'format': export_format,
+        'quantized': quantize,
+        'ckpt_path': os.path.abspath(ckpt_path),
+        'num_layers': model.cfg.num_layers,
+        'num_classes': model.cfg.num_classes,
+        'num_points': model.cfg.num_points,
+        'batch_size': batch_size,
+        'model': dict(cfg.model)
+    }
+    with open(meta_path(out_path), 'w') as f:
+        json.dump(meta, f, indent=2, default=str)
+    return model, out_path
+
+
+def points_per_second(forward, batches):
+    """Throughput of `forward` on collated `batches`, after one warm-up batch."""
+    with torch.no_grad():
+        forward(batches[0]['data'])
+        start = time.perf_counter()
+        num_points = 0
+        for inputs in batches:
+            forward(inputs['data'])
+            num_points += inputs['data']['features'].shape[0] * inputs['data']['features'].shape[1]
+    return num_points / (time.perf_counter() - start)
+
+
+def benchmark(model, artifact_path, batch_size, num_batches, threads=None):
+    """Points per second of the eager model and of the artifact on the same crops.
+
+    Returns:
+        A dict with both throughputs and the share of points whose predicted
+        class agrees between the two.
+    """
+    batcher = ml3d.dataloaders.DefaultBatcher()
+    batches = synthetic_batches(model, batcher, batch_size, num_batches, seed=1)
+    exported = ExportedModel(artifact_path, threads)
+
+    with torch.no_grad():
+        eager_labels = model(batches[0]['data']).argmax(-1)
+        exported_labels = exported(batches[0]['data']).argmax(-1)
+    return {
+        'eager_points_per_s': points_per_second(model, batches),
+        'exported_points_per_s': points_per_second(exported, batches),
+        'label_agreement': float((eager_labels == exported_labels).float().mean())
+    }
+
+
+def main():
+    configure_logging()
+    args = parse_arguments()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    cfg = _ml3d.utils.Config.load_from_file(args.config)
+    out_path = args.out_path
+    if out_path is None:
+        suffix = ('_int8' if args.quantize else '') + ('.pt' if args.format == 'torchscript' else '.onnx')
+        out_path = os.path.splitext(args.ckpt_path)[0] + suffix
+
+    model, out_path = export_model(cfg, args.ckpt_path, out_path, args.format,
+                                   args.quantize, args.batch_size)
+    log.info(f"Saved {args.format} model to {out_path}")
+
+    if args.benchmark_batches:
+        result = benchmark(model, out_path, args.batch_size, args.benchmark_batches, args.threads)
+        log.info(f"Eager:    {result['eager_points_per_s']:,.0f} points/s")
+        log.info(f"Exported: {result['exported_points_per_s']:,.0f} points/s "
+                 f"({result['exported_points_per_s'] / result['eager_points_per_s']:.2f}x), "
+                 f"{result['label_agreement']:.2%} of predicted labels agree")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,452 @@
+"""Persistent cache of preprocessed clouds, shared between runs.
+
+Open3D-ML caches the output of `model.preprocess` as one pickled `.npy` per
+cloud name, in a directory keyed by the repr of the model. Nothing records
+the `grid_size` or the input files an entry was made from, so a changed
+config or a re-run preprocessing silently reuses stale entries.
+
+`PreprocessCache` is a drop-in replacement for Open3D-ML's `Cache`:
+
+- entries live under `<cache_dir>/v<version>-<config hash>/`, where the
+  config hash covers the model fields `preprocess` depends on and the
+  scikit-learn version (the KD-tree layout),
+- an entry `<name>-<content hash>/` is keyed by the content of the cloud and
+  its labels, and holds every array as a `.npy` file that is memory-mapped
+  on load, including the arrays of the KD-tree,
+- entries are written to a temporary directory and renamed into place, with
+  a lock per entry so concurrent runs preprocess a cloud only once,
+- with a size cap, the least recently used entries are evicted.
+
+`install_preprocess_cache` makes Open3D-ML's dataloaders use it. Run this
+module to print cache statistics or evict entries.
+"""
+import os
+import json
+import time
+import glob
+import shutil
+import pickle
+import fcntl
+import hashlib
+import argparse
+import functools
+from contextlib import contextmanager
+import numpy as np
+from src.processing.cloud_io import (cloud_name, find_cloud, station_name,
+                                     tile_index_path)
+from src.processing.dataset_stats import labels_path_of
+
+# Bump when the layout of an entry or the preprocessing changes
+CACHE_VERSION = 2
+
+# Model config fields the output of `preprocess` depends on
+CONFIG_FIELDS = ('name', 'grid_size')
+
+META_NAME = 'meta.json'
+CONFIG_NAME = 'config.json'
+LOCK_NAME = '.lock'
+TREE_STATE_NAME = 'search_tree.pkl'
+
+# Bytes hashed per read when computing content hashes
+HASH_BLOCK_SIZE = 16 * 2**20
+CONTENT_HASH_LENGTH = 16
+
+# Seconds between refreshes of the last use of an entry that stays loaded
+TOUCH_INTERVAL = 60
+
+
+def config_key(model_cfg):
+    """Hash of the config fields (and versions) an entry depends on.
+
+    Returns:
+        (key, fields) with the 16 hex digit key and the hashed fields.
+    """
+    import sklearn
+    fields = {field: model_cfg.get(field) for field in CONFIG_FIELDS}
+    fields['sklearn'] = sklearn.__version__
+    fields['version'] = CACHE_VERSION
+    digest = hashlib.sha1(json.dumps(fields, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()[:16], fields
+
+
+def input_paths(cloud_path):
+    """The files a preprocessed cloud is made from: the cloud, its labels
+    and, of a tile, the tile index recording which of its points it owns."""
+    paths = [os.path.abspath(cloud_path)]
+    labels_path = labels_path_of(str(cloud_path))
+    if labels_path is not None:
+        paths.append(os.path.abspath(labels_path))
+    if '_tile_' in cloud_name(cloud_path):
+        paths.append(tile_index_path(os.path.dirname(paths[0]), station_name(cloud_path)))
+    return paths
+
+
+def input_state(paths):
+    """(path, size, mtime) of input files, a cheap stand-in for their content."""
+    state = []
+    for path in paths:
+        stat = os.stat(path)
+        state.append([path, stat.st_size, stat.st_mtime_ns])
+    return state
+
+
+def content_hash(paths):
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+    return digest.hexdigest()[:CONTENT_HASH_LENGTH]
+
+
+@contextmanager
+def file_lock(path):
+    """Exclusive flock on `path`, created if needed."""
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def is_entry_of(entry_dir, name):
+    """Whether `entry_dir` is a complete entry of cloud `name` (not of `<name>-...`)."""
+    key = os.path.basename(entry_dir)[len(name) + 1:]
+    return (len(key) == CONTENT_HASH_LENGTH and '.' not in key and
+            os.path.exists(os.path.join(entry_dir, META_NAME)))
+
+
+def touch(entry_dir):
+    """Mark an entry as recently used for eviction."""
+    try:
+        os.utime(entry_dir)
+    except FileNotFoundError:
+        pass
+
+
+def entry_size(entry_dir):
+    return sum(os.path.getsize(path) for path in glob.glob(os.path.join(entry_dir, '*')))
+
+
+def list_entries(cache_dir):
+    """All complete entries in a cache directory, of every config.
+
+    Returns:
+        A list of dicts with `path`, `config`, `name`, `size` and
+        `last_used` (the entry's mtime, refreshed whenever it is loaded).
+    """
+    entries = []
+    for meta_file in glob.glob(os.path.join(cache_dir, 'v*-*', '*', META_NAME)):
+        entry_dir = os.path.dirname(meta_file)
+        if '.tmp-' in os.path.basename(entry_dir):
+            continue
+        try:
+            with open(meta_file, 'r') as f:
+                meta = json.load(f)
+            entries.append({
+                'path': entry_dir,
+                'config': os.path.basename(os.path.dirname(entry_dir)),
+                'name': meta['name'],
+                'size': entry_size(entry_dir),
+                'last_used': os.path.getmtime(entry_dir)
+            })
+        except (OSError, ValueError, KeyError):
+            # Removed by a concurrent eviction
+            continue
+    return entries
+
+
+def evict(cache_dir, max_bytes, keep=()):
+    """Remove least recently used entries until the cache fits `max_bytes`.
+
+    Entries in `keep` are never removed. Processes that have memory-mapped
+    a removed entry keep reading it until they close it.
+
+    Returns:
+        The removed entry directories.
+    """
+    removed = []
+    with file_lock(os.path.join(cache_dir, LOCK_NAME)):
+        entries = sorted(list_entries(cache_dir), key=lambda entry: entry['last_used'])
+        total = sum(entry['size'] for entry in entries)
+        for entry in entries:
+            if total <= max_bytes:
+                break
+            if entry['path'] in keep:
+                continue
+            shutil.rmtree(entry['path'], ignore_errors=True)
+            total -= entry['size']
+            removed.append(entry['path'])
+    return removed
+
+
+class CachedIds(object):
+    """`name in cached_ids` for Open3D-ML's dataloader, checked against the inputs."""
+
+    def __init__(self, cache):
+        self._cache = cache
+
+    def __contains__(self, name):
+        return self._cache.find(name) is not None
+
+
+class PreprocessCache(object):
+    """Cache converter for preprocessed data, with Open3D-ML's `Cache` interface."""
+
+    def __init__(self, func, cache_dir, cache_key=None, dataset_path=None, max_bytes=None):
+        """Initialize.
+
+        Args:
+            func: preprocess function of a model, `func(data, attr)`.
+            cache_dir: Directory shared by all configs and runs.
+            cache_key: Key of Open3D-ML's cache, unused; entries are keyed by
+                config and content instead.
+            dataset_path: Directory of the processed clouds, used to find
+                the input files of a cloud name.
+            max_bytes: Size cap of the whole cache directory, None for none.
+        """
+        self.func = func
+        self.cache_dir = cache_dir
+        self.dataset_path = dataset_path
+        self.max_bytes = max_bytes
+
+        model = getattr(func, '__self__', None)
+        model_cfg = getattr(model, 'cfg', None) or {}
+        # Entries made from a pyramid (see src/pyramid.py) also depend on it
+        self.pyramids = getattr(model, 'pyramids', None)
+        key, fields = config_key(model_cfg)
+        self.entries_dir = os.path.join(cache_dir, f'v{CACHE_VERSION}-{key}')
+        os.makedirs(self.entries_dir, exist_ok=True)
+        config_path = os.path.join(self.entries_dir, CONFIG_NAME)
+        if not os.path.exists(config_path):
+            tmp_path = f'{config_path}.tmp-{os.getpid()}'
+            with open(tmp_path, 'w') as f:
+                json.dump(fields, f, indent=2, default=str)
+            os.replace(tmp_path, config_path)
+
+        self.cached_ids = CachedIds(self)
+        self._entries = {}
+        self._loaded = {}
+        self._touched = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, unique_id, *data):
+        """Load the entry of `unique_id`, preprocessing and storing it if needed.
+
+        Args:
+            unique_id: Name of the cloud.
+            data: `(data, attr)` to preprocess, only needed for a missing entry.
+
+        Returns:
+            The preprocessed dict, with memory-mapped arrays.
+        """
+        if unique_id in self._loaded:
+            self.hits += 1
+            entry_dir = self._entries[unique_id]
+            if time.time() - self._touched.get(entry_dir, 0) > TOUCH_INTERVAL:
+                touch(entry_dir)
+                self._touched[entry_dir] = time.time()
+            return self._loaded[unique_id]
+
+        source = data[1].get('path') if len(data) > 1 else None
+        entry_dir = self.find(unique_id, source)
+        if entry_dir is not None:
+            try:
+                output = self._read(entry_dir)
+                self.hits += 1
+            except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+                # Evicted while being read
+                entry_dir = None
+        if entry_dir is None:
+            if not data:
+                raise KeyError(f"{unique_id} is not cached and no data was given to preprocess")
+            output = self._write(unique_id, source, data)
+            self.misses += 1
+
+        self._loaded[unique_id] = output
+        return output
+
+    def source_of(self, name, source=None):
+        if source is not None:
+            return str(source)
+        if self.dataset_path is not None:
+            return find_cloud(self.dataset_path, name)
+        return None
+
+    def find(self, name, source=None):
+        """Entry directory of cloud `name` made from its current inputs, None if missing."""
+        if name in self._entries:
+            return self._entries[name]
+        source = self.source_of(name, source)
+        candidates = [path for path in glob.glob(os.path.join(self.entries_dir, glob.escape(name) + '-*'))
+                      if is_entry_of(path, name)]
+        if not candidates:
+            return None
+
+        if source is None:
+            # Without the inputs at hand, trust an entry whose recorded
+            # inputs are unchanged
+            for entry_dir in candidates:
+                meta = self._meta(entry_dir)
+                paths = [state[0] for state in meta['inputs']]
+                if all(os.path.exists(path) for path in paths) and input_state(paths) == meta['inputs']:
+                    return self._remember(name, entry_dir)
+            return None
+
+        paths = self.input_paths(name, source)
+        state = input_state(paths)
+        for entry_dir in candidates:
+            if self._meta(entry_dir)['inputs'] == state:
+                return self._remember(name, entry_dir)
+        entry_dir = os.path.join(self.entries_dir, f'{name}-{content_hash(paths)}')
+        if entry_dir in candidates:
+            return self._remember(name, entry_dir)
+        return None
+
+    def input_paths(self, name, source):
+        paths = input_paths(source)
+        if self.pyramids is not None:
+            paths += self.pyramids.input_paths(name)
+        return paths
+
+    def _remember(self, name, entry_dir):
+        self._entries[name] = entry_dir
+        return entry_dir
+
+    def _meta(self, entry_dir):
+        with open(os.path.join(entry_dir, META_NAME), 'r') as f:
+            return json.load(f)
+
+    def _write(self, name, source, data):
+        source = self.source_of(name, source)
+        if source is None:
+            raise FileNotFoundError(f"Input files of {name} not found, cannot key its cache entry")
+        paths = self.input_paths(name, source)
+        state = input_state(paths)
+        entry_dir = os.path.join(self.entries_dir, f'{name}-{content_hash(paths)}')
+
+        # Concurrent runs wait for the first one to preprocess the cloud
+        with file_lock(entry_dir + LOCK_NAME):
+            if not os.path.exists(os.path.join(entry_dir, META_NAME)):
+                output = self.func(*data)
+                tmp_dir = f'{entry_dir}.tmp-{os.getpid()}'
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                os.makedirs(tmp_dir)
+                self._write_arrays(output, tmp_dir)
+                with open(os.path.join(tmp_dir, META_NAME), 'w') as f:
+                    json.dump({'name': name, 'inputs': state, 'created': time.time()}, f)
+                os.rename(tmp_dir, entry_dir)
+        if os.path.exists(entry_dir + LOCK_NAME):
+            try:
+                os.remove(entry_dir + LOCK_NAME)
+            except FileNotFoundError:
+                pass
+
+        if self.max_bytes is not None:
+            evict(self.cache_dir, self.max_bytes, keep=(entry_dir,))
+        self._remember(name, entry_dir)
+        return self._read(entry_dir)
+
+    @staticmethod
+    def _write_arrays(output, entry_dir):
+        """Save every array of a preprocessed dict as .npy, the rest pickled."""
+        other = {}
+        for key, value in output.items():
+            if isinstance(value, np.ndarray):
+                np.save(os.path.join(entry_dir, key + '.npy'), value)
+            elif key == 'search_tree' and hasattr(value, '__getstate__'):
+                # The tree arrays are saved like the others; the pickle keeps
+                # their position in the state next to its scalars
+                state = list(value.__getstate__())
+                for i, item in enumerate(state):
+                    if isinstance(item, np.ndarray):
+                        np.save(os.path.join(entry_dir, f'search_tree_{i}.npy'), item)
+                        state[i] = ('npy', i)
+                with open(os.path.join(entry_dir, TREE_STATE_NAME), 'wb') as f:
+                    pickle.dump((type(value), state), f)
+            else:
+                other[key] = value
+        with open(os.path.join(entry_dir, 'other.pkl'), 'wb') as f:
+            pickle.dump(other, f)
+
+    @staticmethod
+    def _read(entry_dir):
+        output = {}
+        with open(os.path.join(entry_dir, 'other.pkl'), 'rb') as f:
+            output.update(pickle.load(f))
+        for path in glob.glob(os.path.join(entry_dir, '*.npy')):
+            key = os.path.basename(path)[:-len('.npy')]
+            if not key.startswith('search_tree_'):
+                output[key] = np.load(path, mmap_mode='r')
+
+        tree_path = os.path.join(entry_dir, TREE_STATE_NAME)
+        if os.path.exists(tree_path):
+            with open(tree_path, 'rb') as f:
+                tree_type, state = pickle.load(f)
+            for i, item in enumerate(state):
+                if isinstance(item, tuple) and item[:1] == ('npy',):
+                    # Copy-on-write: the tree needs writable buffers
+                    state[i] = np.load(os.path.join(entry_dir, f'search_tree_{i}.npy'), mmap_mode='c')
+            tree = tree_type.__new__(tree_type)
+            tree.__setstate__(tuple(state))
+            output['search_tree'] = tree
+
+        touch(entry_dir)
+        return output
+
+
+def install_preprocess_cache(dataset_path=None, max_bytes=None):
+    """Make Open3D-ML's dataloaders cache preprocessed clouds with `PreprocessCache`.
+
+    Open3D-ML builds its cache converter inside `TorchDataloader`, so the
+    class it refers to is replaced.
+    """
+    from open3d._ml3d.torch.dataloaders import torch_dataloader
+    torch_dataloader.Cache = functools.partial(PreprocessCache, dataset_path=dataset_path,
+                                               max_bytes=max_bytes)
+
+
+def max_bytes_of(cache_max_gb):
+    return None if cache_max_gb is None else int(float(cache_max_gb) * 1e9)
+
+
+def cache_stats(cache_dir):
+    """Number of entries, size and last use per config of a cache directory."""
+    stats = {}
+    for entry in list_entries(cache_dir):
+        config = stats.setdefault(entry['config'], {'entries': 0, 'size': 0, 'last_used': 0,
+                                                    'fields': None})
+        config['entries'] += 1
+        config['size'] += entry['size']
+        config['last_used'] = max(config['last_used'], entry['last_used'])
+    for name, config in stats.items():
+        config_path = os.path.join(cache_dir, name, CONFIG_NAME)
+        if os.path.exists(config_path):
+            with open(config_path, 'r') as f:
+                config['fields'] = json.load(f)
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Statistics and eviction of the preprocessing cache')
+    parser.add_argument('--cache_dir', help='Cache directory', default='./logs/cache_small3d')
+    parser.add_argument('command', choices=['stats', 'evict'], nargs='?', default='stats')
+    parser.add_argument('--max_gb', help='Size to evict down to (evict)', type=float, default=None)
+
+    args = parser.parse_args()
+
+    if args.command == 'evict':
+        if args.max_gb is None:
+            parser.error('evict requires --max_gb')
+        removed = evict(args.cache_dir, max_bytes_of(args.max_gb))
+        print(f"Removed {len(removed)} entries")
+
+    total = 0
+    for name, config in sorted(cache_stats(args.cache_dir).items()):
+        total += config['size']
+        last_used = time.strftime('%Y-%m-%d %H:%M', time.localtime(config['last_used']))
+        print(f"{name}: {config['entries']} entries, {config['size'] / 1e9:.2f} GB, "
+              f"last used {last_used}, {config['fields']}")
+    print(f"Total: {total / 1e9:.2f} GB in {args.cache_dir}")
@@ -0,0 +1,186 @@
+"""Compact per-point class probabilities for test-time voting.
+
+During inference every crop's softmax output is blended into the
+probabilities of the points it covers (`p = s * p + (1 - s) * probs`, as in
+`RandLANet.update_probs`). `ProbabilityAccumulator` holds these probabilities
+as float16 or as uint8 (quantized to 1/255), optionally in an `np.memmap`
+file instead of RAM, and counts how often each point was visited.
+
+After v visits the blended probabilities of a point sum to 1 - s**v, so for
+the few visits most points get they are small and would lose most of their
+uint8 steps. The accumulator therefore stores them divided by 1 - s**v, which
+sums to 1 and has the same argmax.
+
+Memmapped probabilities keep changing while a checkpoint of the visit
+counts ages, so `state` copies them to a snapshot file tagged like the
+checkpoint and `restore` reads that snapshot back.
+"""
+import os
+import glob
+import shutil
+import numpy as np
+
+# Smoothing of RandLANet.update_probs
+TEST_SMOOTH = 0.95
+
+# Steps of a uint8-quantized probability
+UINT8_SCALE = 255
+
+DTYPES = ('float16', 'uint8')
+
+# Visit counts saturate instead of wrapping around
+MAX_VISITS = np.iinfo(np.uint16).max
+
+
+class ProbabilityAccumulator(object):
+    """Smoothed class probabilities and visit counts of the points of a cloud."""
+
+    def __init__(self, num_points, num_classes, dtype='float16', path=None,
+                 smoothing=TEST_SMOOTH, seed=None):
+        """Initialize the accumulator.
+
+        Args:
+            num_points: Number of points of the cloud.
+            num_classes: Number of predicted classes.
+            dtype: 'float16' or 'uint8' storage of the probabilities.
+            path: If given, the probabilities live in this `np.memmap` file.
+            smoothing: Weight of the previous probabilities in an update.
+            seed: Seed of the stochastic rounding of uint8 probabilities.
+        """
+        if dtype not in DTYPES:
+            raise ValueError(f"dtype must be one of {DTYPES}, got {dtype}")
+        self.num_points = num_points
+        self.num_classes = num_classes
+        self.dtype = np.dtype(dtype)
+        self.path = path
+        self.smoothing = smoothing
+        self.rng = np.random.default_rng(seed)
+
+        shape = (num_points, num_classes)
+        if path is None:
+            self.probs = np.zeros(shape, dtype=self.dtype)
+        else:
+            self.probs = np.memmap(path, dtype=self.dtype, shape=shape, mode='w+')
+        self.visits = np.zeros(num_points, dtype=np.uint16)
+
+    @property
+    def nbytes(self):
+        """Bytes held in RAM, excluding memmapped probabilities."""
+        probs = 0 if self.path is not None else self.probs.nbytes
+        return probs + self.visits.nbytes
+
+    def decode(self, stored):
+        if self.dtype == np.uint8:
+            return stored.astype(np.float32) / UINT8_SCALE
+        return stored.astype(np.float32)
+
+    def encode(self, probs):
+        if self.dtype == np.uint8:
+            # Stochastic rounding keeps the smoothed value unbiased; rounding
+            # to nearest would stall it up to 10 steps short of the target
+            scaled = probs * UINT8_SCALE
+            return np.floor(scaled + self.rng.random(scaled.shape, dtype=np.float32)).clip(
+                0, UINT8_SCALE).astype(np.uint8)
+        return probs.astype(self.dtype)
+
+    def update(self, inds, probs):
+        """Blend the probabilities of one crop into its points.
+
+        Args:
+            inds: Point indices of the crop, shape (m,).
+            probs: Softmax probabilities of the crop, shape (m, num_classes).
+        """
+        inds = np.asarray(inds)
+        visits = self.visits[inds]
+        # Total weight of the blended probabilities before and after the update
+        weight = 1 - self.smoothing ** visits.astype(np.float32)
+        new_weight = 1 - self.smoothing ** (visits.astype(np.float32) + 1)
+        blended = (self.smoothing * weight[:, None] * self.decode(self.probs[inds]) +
+                   (1 - self.smoothing) * np.asarray(probs, dtype=np.float32))
+        self.probs[inds] = self.encode(blended / new_weight[:, None])
+        self.visits[inds] = np.where(visits < MAX_VISITS, visits + 1, visits)
+
+    def min_visits(self):
+        return int(self.visits.min()) if self.num_points else 0
+
+    def converged(self, min_visits):
+        """Whether every point was visited at least `min_visits` times."""
+        return self.min_visits() >= min_visits
+
+    def labels(self, inds=None, chunk_rows=2**20):
+        """Index of the most likely class of the points `inds` (all if None).
+
+        Rows are gathered in chunks so memmapped probabilities are never
+        loaded at once.
+        """
+        if inds is None:
+            inds = np.arange(self.num_points)
+        labels = np.empty(len(inds), dtype=np.int64)
+        for start in range(0, len(inds), chunk_rows):
+            end = start + chunk_rows
+            labels[start:end] = np.argmax(self.probs[inds[start:end]], axis=1)
+        return labels
+
+    def flush(self):
+        if isinstance(self.probs, np.memmap):
+            self.probs.flush()
+
+    def snapshot_path(self, tag):
+        return f"{self.path}.{tag}"
+
+    def state(self, tag=0):
+        """Arrays to save for resuming.
+
+        Memmapped probabilities are copied to the snapshot file
+        `<path>.<tag>`, written atomically; the state only records the tag.
+        """
+        state = {'visits': self.visits}
+        if self.path is None:
+            state['probs'] = self.probs
+        else:
+            self.flush()
+            snapshot = self.snapshot_path(tag)
+            tmp_path = snapshot + '.tmp'
+            shutil.copyfile(self.path, tmp_path)
+            os.replace(tmp_path, snapshot)
+            state['snapshot'] = tag
+        return state
+
+    def remove_snapshots(self, keep=None):
+        """Delete the snapshot files of the memmap, except the one tagged `keep`."""
+        if self.path is None:
+            return
+        kept = None if keep is None else self.snapshot_path(keep)
+        for path in glob.glob(glob.escape(self.path) + '.*'):
+            if path != kept:
+                os.remove(path)
+
+    def restore(self, state, chunk_rows=2**20):
+        """Restore the arrays returned by `state`."""
+        if state['visits'].shape != self.visits.shape:
+            raise ValueError("Saved visit counts do not match the cloud")
+        if self.path is None:
+            if state['probs'].shape != self.probs.shape or state['probs'].dtype != self.dtype:
+                raise ValueError("Saved probabilities do not match the accumulator")
+            self.probs[:] = state['probs']
+        else:
+            snapshot = self.snapshot_path(int(state['snapshot']))
+            if (not os.path.exists(snapshot) or
+                    os.path.getsize(snapshot) != self.probs.nbytes):
+                raise ValueError(f"Snapshot {snapshot} of the probabilities is missing "
+                                 f"or does not match the accumulator")
+            saved = np.memmap(snapshot, dtype=self.dtype, shape=self.probs.shape, mode='r')
+            for start in range(0, self.num_points, chunk_rows):
+                self.probs[start:start + chunk_rows] = saved[start:start + chunk_rows]
+            del saved
+        self.visits[:] = state['visits']
+
+    def close(self, remove=False):
+        """Release a memmap file, deleting it and its snapshots if `remove`."""
+        if isinstance(self.probs, np.memmap):
+            self.probs.flush()
+            self.probs = None
+            if remove:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                self.remove_snapshots()
@@ -0,0 +1,372 @@
+"""Binary container for processed Semantic3D clouds.
+
+A container is a single file laid out as:
+
+    8 byte magic | uint32 header length | JSON header | column blocks
+
+Every column (xyz, intensity, rgb and optionally labels) is stored as one
+contiguous little-endian block aligned to 64 bytes. The JSON header lists
+dtype, shape and offset of each block, so readers can `np.memmap` exactly
+the columns they need without parsing or copying anything.
+"""
+import os
+import json
+import struct
+import argparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from src.processing.text_stream import TextColumnReader
+
+BINARY_EXT = '.s3d'
+MAGIC = b'S3DCLOUD'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+# Column name -> (dtype, number of components per point)
+COLUMNS = {
+    'xyz': (np.dtype('<f4'), 3),
+    'intensity': (np.dtype('<i2'), 1),
+    'rgb': (np.dtype('u1'), 3),
+    'labels': (np.dtype('u1'), 1),
+}
+
+_PREFIX = struct.Struct('<8sI')
+
+# Tile index written next to the tiles of a station, `<station>_tiles.json`.
+# From version 2 on, every tile cloud stores the points it owns first.
+TILE_INDEX_SUFFIX = '_tiles.json'
+TILE_INDEX_VERSION = 2
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def is_binary_cloud(path):
+    """Check whether a path points to a binary cloud container."""
+    return str(path).endswith(BINARY_EXT)
+
+
+def cloud_name(path):
+    """Return the cloud name of a text or binary cloud path (no extension)."""
+    name = Path(path).name
+    for ext in (BINARY_EXT, '.txt', '.labels'):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def station_name(path):
+    """Return the station a processed cloud belongs to (no part or tile suffix)."""
+    name = cloud_name(path)
+    for separator in ('_part_', '_tile_'):
+        if separator in name:
+            return name.split(separator)[0]
+    return name
+
+
+def find_cloud(directory, name):
+    """Return the path of cloud `name` in `directory`, preferring the binary container."""
+    binary_path = os.path.join(directory, name + BINARY_EXT)
+    if os.path.exists(binary_path):
+        return binary_path
+    txt_path = os.path.join(directory, name + '.txt')
+    if os.path.exists(txt_path):
+        return txt_path
+    return None
+
+
+def tile_index_path(directory, station):
+    """Path of the tile index of a tiled station."""
+    return os.path.join(directory, station + TILE_INDEX_SUFFIX)
+
+
+def owned_rows(cloud_path):
+    """Number of leading points of a processed cloud that the cloud owns.
+
+    Tile clouds store the points of their core square first and the overlap
+    margin after them, so only their first `num_owned` points (as recorded
+    in the tile index next to them) count towards class counts, losses and
+    metrics. All other clouds own every point.
+
+    Returns:
+        The number of owned points of a tile, None for any other cloud.
+    """
+    name = cloud_name(cloud_path)
+    if '_tile_' not in name:
+        return None
+    index_path = tile_index_path(os.path.dirname(os.path.abspath(cloud_path)),
+                                 station_name(name))
+    if not os.path.exists(index_path):
+        raise FileNotFoundError(f"Tile index {index_path} of {name} not found")
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+    if index.get('version', 1) < TILE_INDEX_VERSION:
+        raise ValueError(f"{index_path} predates tiles that store their owned points first, "
+                         f"re-run the preprocessing with --force")
+    for entry in index['tiles']:
+        if entry['name'] == name:
+            return entry['num_owned']
+    raise ValueError(f"Tile {name} is not listed in {index_path}")
+
+
+def write_cloud(path, xyz, intensity, rgb, labels=None):
+    """Write a cloud into a binary container.
+
+    Values are cast the same way `np.savetxt(fmt='%i')` truncates them, so a
+    container holds exactly what the text format would. The file is written
+    under a temporary name and moved into place once complete.
+    """
+    write_cloud_chunks(path, len(xyz), [(xyz, intensity, rgb, labels)],
+                       with_labels=labels is not None)
+
+
+def write_cloud_chunks(path, num_points, chunks, with_labels=False):
+    """Write a cloud into a binary container from consecutive chunks of points.
+
+    Only one chunk is held in memory at a time; see `write_cloud`.
+
+    Args:
+        path: Path of the container.
+        num_points: Total number of points of all chunks.
+        chunks: Iterable of (xyz, intensity, rgb, labels) arrays; labels are
+            ignored unless `with_labels`.
+        with_labels: Whether the container stores labels.
+    """
+    names = ['xyz', 'intensity', 'rgb'] + (['labels'] if with_labels else [])
+    columns = {}
+    offset = 0
+    for name in names:
+        dtype, width = COLUMNS[name]
+        columns[name] = {
+            'dtype': dtype.str,
+            'shape': [num_points, width] if width > 1 else [num_points],
+            'offset': offset
+        }
+        offset = _align(offset + num_points * width * dtype.itemsize)
+
+    header = json.dumps({
+        'version': FORMAT_VERSION,
+        'num_points': num_points,
+        'columns': columns
+    }).encode('utf-8')
+    data_start = _align(_PREFIX.size + len(header))
+
+    tmp_path = str(path) + '.tmp'
+    written = 0
+    with open(tmp_path, 'wb') as f:
+        f.write(_PREFIX.pack(MAGIC, len(header)))
+        f.write(header)
+        for chunk in chunks:
+            n = len(chunk[0])
+            for name, array in zip(names, chunk):
+                dtype, width = COLUMNS[name]
+                array = np.asarray(array).reshape((n, width) if width > 1 else (n,))
+                f.seek(data_start + columns[name]['offset'] + written * width * dtype.itemsize)
+                f.write(np.ascontiguousarray(array.astype(dtype, copy=False)).tobytes())
+            written += n
+        if written != num_points:
+            raise ValueError(f"Expected {num_points} points for {path}, got {written}")
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def read_header(path):
+    """Read the header of a binary container.
+
+    Returns:
+        The decoded header with an extra `data_start` entry.
+    """
+    with open(path, 'rb') as f:
+        magic, header_len = _PREFIX.unpack(f.read(_PREFIX.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a binary Semantic3D cloud")
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    if header['version'] > FORMAT_VERSION:
+        raise ValueError(
+            f"{path} has format version {header['version']}, "
+            f"only versions up to {FORMAT_VERSION} are supported")
+    header['data_start'] = _align(_PREFIX.size + header_len)
+    return header
+
+
+def read_cloud(path, columns=None):
+    """Memory-map the columns of a binary container.
+
+    Args:
+        path: Path to the container.
+        columns: Column names to map, all stored columns if None.
+
+    Returns:
+        A dict of read-only `np.memmap` arrays keyed by column name.
+    """
+    header = read_header(path)
+    stored = header['columns']
+    if columns is None:
+        columns = list(stored)
+
+    cloud = {}
+    for name in columns:
+        if name not in stored:
+            raise KeyError(f"Column '{name}' not stored in {path}")
+        column = stored[name]
+        shape = tuple(column['shape'])
+        if shape[0] == 0:
+            cloud[name] = np.zeros(shape, dtype=column['dtype'])
+            continue
+        cloud[name] = np.memmap(path,
+                                dtype=column['dtype'],
+                                mode='r',
+                                offset=header['data_start'] + column['offset'],
+                                shape=shape)
+    return cloud
+
+
+def has_labels(path):
+    """Check whether a binary container stores labels."""
+    return 'labels' in read_header(path)['columns']
+
+
+def read_text_cloud(txt_path):
+    """Parse a Semantic3D text cloud into a float32 (N, 7) array."""
+    return pd.read_csv(txt_path,
+                       header=None,
+                       delim_whitespace=True,
+                       dtype=np.float32).values
+
+
+def read_text_labels(labels_path):
+    """Parse a Semantic3D .labels text file into an int32 array."""
+    return pd.read_csv(labels_path,
+                       header=None,
+                       delim_whitespace=True,
+                       dtype=np.int32).values.reshape((-1,))
+
+
+def load_xyz(path):
+    """Return the xyz coordinates of a text or binary cloud."""
+    if is_binary_cloud(path):
+        return read_cloud(path, ['xyz'])['xyz']
+    return read_text_cloud(path)[:, :3]
+
+
+def iter_xyz(path, chunk_rows):
+    """Stream the xyz coordinates of a text or binary cloud.
+
+    Text clouds are parsed in blocks and only their first three columns are
+    converted. Every chunk but the last holds `chunk_rows` points; chunks of
+    text clouds are views into a reused buffer.
+
+    Yields:
+        float32 arrays of shape (n, 3).
+    """
+    if is_binary_cloud(path):
+        xyz = read_cloud(path, ['xyz'])['xyz']
+        for start in range(0, len(xyz), chunk_rows):
+            yield xyz[start:start + chunk_rows]
+        return
+
+    buffer = np.empty((chunk_rows, 3), dtype=np.float32)
+    with open(path, 'rb') as f:
+        reader = TextColumnReader(f, 3, np.float32, usecols=[0, 1, 2])
+        while True:
+            num_rows = reader.read_into(buffer)
+            if num_rows:
+                yield buffer[:num_rows]
+            if num_rows < chunk_rows:
+                break
+
+
+def load_labels(path):
+    """Return the labels of a .labels text file or of a binary container."""
+    if is_binary_cloud(path):
+        return read_cloud(path, ['labels'])['labels']
+    return read_text_labels(path)
+
+
+def savetxt_atomic(path, array, fmt):
+    """np.savetxt into a temporary file that is moved into place once complete."""
+    tmp_path = str(path) + '.tmp'
+    np.savetxt(tmp_path, array, fmt=fmt)
+    os.replace(tmp_path, path)
+
+
+def save_processed(output_path, pc, labels, out_format='txt'):
+    """Save a processed cloud as text or as a binary container.
+
+    Returns:
+        The list of written files.
+    """
+    if out_format == 'binary':
+        binary_path = output_path.replace('.txt', BINARY_EXT)
+        write_cloud(binary_path, pc[:, :3], pc[:, 3], pc[:, 4:7], labels)
+        return [binary_path]
+
+    labels_path = output_path.replace('.txt', '.labels')
+    savetxt_atomic(output_path, pc, '%.3f %.3f %.3f %i %i %i %i')
+    savetxt_atomic(labels_path, labels, '%i')
+    return [output_path, labels_path]
+
+
+def save_processed_chunks(output_path, num_points, chunks, out_format='txt'):
+    """Save a processed cloud given as consecutive (pc, labels) chunks.
+
+    The chunked counterpart of `save_processed`, writing the same files.
+
+    Returns:
+        The list of written files.
+    """
+    if out_format == 'binary':
+        binary_path = output_path.replace('.txt', BINARY_EXT)
+        write_cloud_chunks(binary_path, num_points,
+                           ((pc[:, :3], pc[:, 3], pc[:, 4:7], labels) for pc, labels in chunks),
+                           with_labels=True)
+        return [binary_path]
+
+    labels_path = output_path.replace('.txt', '.labels')
+    with open(output_path + '.tmp', 'wb') as pc_f, open(labels_path + '.tmp', 'wb') as labels_f:
+        for pc, labels in chunks:
+            np.savetxt(pc_f, pc, fmt='%.3f %.3f %.3f %i %i %i %i')
+            np.savetxt(labels_f, labels, fmt='%i')
+    os.replace(output_path + '.tmp', output_path)
+    os.replace(labels_path + '.tmp', labels_path)
+    return [output_path, labels_path]
+
+
+def convert_text_cloud(txt_path, out_path=None, remove_text=False):
+    """Convert a processed text cloud (and its .labels sibling) to a container."""
+    txt_path = str(txt_path)
+    if out_path is None:
+        out_path = txt_path[:-len('.txt')] + BINARY_EXT
+    labels_path = txt_path[:-len('.txt')] + '.labels'
+
+    pc = read_text_cloud(txt_path)
+    labels = read_text_labels(labels_path) if os.path.exists(labels_path) else None
+    if labels is not None and len(labels) != len(pc):
+        raise ValueError(f"Mismatch: {txt_path} (points: {len(pc)}, labels: {len(labels)})")
+
+    write_cloud(out_path, pc[:, :3], pc[:, 3], pc[:, 4:7], labels)
+
+    if remove_text:
+        os.remove(txt_path)
+        if labels is not None:
+            os.remove(labels_path)
+    return out_path
+
+
+if __name__ == '__main__':
+    from tqdm import tqdm
+
+    parser = argparse.ArgumentParser(
+        description='Convert processed Semantic3D text clouds to binary containers')
+    parser.add_argument('input_dir', help='Directory containing processed .txt clouds')
+    parser.add_argument('--remove_text', action='store_true',
+                        help='Delete the .txt/.labels files after conversion')
+
+    args = parser.parse_args()
+
+    txt_files = sorted(Path(args.input_dir).glob('*.txt'))
+    for txt_file in tqdm(txt_files):
+        convert_text_cloud(txt_file, remove_text=args.remove_text)
+    print(f"Converted {len(txt_files)} clouds.")
@@ -1,6 +1,8 @@
 import os
 import numpy as np
-import open3d as o3d
+from src.processing.cloud_io import find_cloud, iter_xyz
+from src.processing.text_stream import iter_labels
+from src.processing.scheduler import run_budgeted
 
 # Label to color mapping (same as Semantic3D)
 label_to_color = {
@@ -15,67 +17,131 @@ label_to_color = {
     8: [0, 0, 255]       # cars - blue
 }
 
-def read_point_cloud(txt_file):
-    """Read XYZ points from Semantic3D txt file"""
-    points = np.loadtxt(txt_file)
-    xyz = points[:, :3]
-    return xyz
-
-def read_labels(labels_file):
-    """Read labels"""
-    return np.loadtxt(labels_file, dtype=np.int32)
-
-def create_colored_pcd(xyz, labels):
-    """Create a colored point cloud based on labels"""
-    colors = np.zeros((len(labels), 3))
-    for label, color in label_to_color.items():
-        colors[labels == label] = np.array(color) / 255.0
-
-    pcd = o3d.geometry.PointCloud()
-    pcd.points = o3d.utility.Vector3dVector(xyz)
-    pcd.colors = o3d.utility.Vector3dVector(colors)
-    return pcd
-
-def process_predictions(txt_dir, labels_dir, output_dir):
+# Label -> uint8 color lookup table
+color_lut = np.array([label_to_color[label] for label in range(len(label_to_color))],
+                     dtype=np.uint8)
+
+# One binary little-endian PLY vertex: float xyz and uchar colors
+ply_vertex = np.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4'),
+                       ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+
+# Points converted per chunk; a .labels line is one digit and a newline
+CHUNK_ROWS = 2**21
+LABEL_BYTES_PER_ROW = 2
+
+# The vertex count is only known once a text cloud has been streamed, so the
+# header reserves a zero-padded field that is filled in at the end
+VERTEX_COUNT_WIDTH = 12
+
+def label_colors(labels):
+    """uint8 colors of labels, gathered from the color lookup table"""
+    labels = np.asarray(labels)
+    if labels.size and (labels.min() < 0 or labels.max() >= len(color_lut)):
+        raise ValueError(f"Labels must be in [0, {len(color_lut)})")
+    return color_lut[labels]
+
+def ply_header(num_vertices):
+    return (
+        "ply\n"
+        "format binary_little_endian 1.0\n"
+        f"element vertex {num_vertices:0{VERTEX_COUNT_WIDTH}d}\n"
+        "property float x\n"
+        "property float y\n"
+        "property float z\n"
+        "property uchar red\n"
+        "property uchar green\n"
+        "property uchar blue\n"
+        "end_header\n"
+    ).encode('ascii')
+
+def iter_predictions(cloud_path, labels_path, chunk_rows=CHUNK_ROWS):
+    """Stream the xyz coordinates of a cloud together with its predicted labels
+
+    Yields:
+        (xyz, labels) chunks of the same length.
+    """
+    labels_chunks = iter_labels(labels_path, chunk_rows, LABEL_BYTES_PER_ROW * chunk_rows)
+    for xyz in iter_xyz(cloud_path, chunk_rows):
+        labels = next(labels_chunks, None)
+        if labels is None or len(labels) != len(xyz):
+            raise ValueError(f"Mismatch: {cloud_path} and {labels_path} differ in length")
+        yield xyz, labels
+    if next(labels_chunks, None) is not None:
+        raise ValueError(f"Mismatch: {cloud_path} and {labels_path} differ in length")
+
+def write_colored_ply(cloud_path, labels_path, output_file, chunk_rows=CHUNK_ROWS):
+    """Stream a cloud and its predicted labels into a colored binary PLY.
+
+    Only the xyz columns of the cloud are read, chunk by chunk, and written
+    as they are converted, so memory does not depend on the cloud size. The
+    file is written under a temporary name and moved into place once complete.
+
+    Returns:
+        The number of written points.
+    """
+    header = ply_header(0)
+    count_offset = header.index(b'element vertex ') + len(b'element vertex ')
+    vertices = np.empty(chunk_rows, dtype=ply_vertex)
+    num_points = 0
+
+    tmp_file = output_file + '.tmp'
+    try:
+        with open(tmp_file, 'wb') as f:
+            f.write(header)
+            for xyz, labels in iter_predictions(cloud_path, labels_path, chunk_rows):
+                chunk = vertices[:len(xyz)]
+                chunk['x'], chunk['y'], chunk['z'] = xyz[:, 0], xyz[:, 1], xyz[:, 2]
+                colors = label_colors(labels)
+                chunk['red'], chunk['green'], chunk['blue'] = colors[:, 0], colors[:, 1], colors[:, 2]
+                f.write(chunk.tobytes())
+                num_points += len(xyz)
+
+            f.seek(count_offset)
+            f.write(f"{num_points:0{VERTEX_COUNT_WIDTH}d}".encode('ascii'))
+        os.replace(tmp_file, output_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return num_points
+
+def process_predictions(txt_dir, labels_dir, output_dir, workers=1):
     """For each prediction label file, create colored PLY"""
 
     os.makedirs(output_dir, exist_ok=True)
 
     label_files = [f for f in os.listdir(labels_dir) if f.endswith('.labels')]
 
+    jobs = []
     for label_file in label_files:
         base_name = label_file.replace('.labels', '')
 
-        txt_path = os.path.join(txt_dir, f"{base_name}.txt")
+        cloud_path = find_cloud(txt_dir, base_name)
         labels_path = os.path.join(labels_dir, label_file)
 
-        if not os.path.exists(txt_path):
-            print(f"TXT file {txt_path} not found, skipping...")
+        if cloud_path is None:
+            print(f"Cloud file for {base_name} not found in {txt_dir}, skipping...")
             continue
 
-        # Load data
-        xyz = read_point_cloud(txt_path)
-        labels = read_labels(labels_path)
-
-        assert len(xyz) == len(labels), f"Mismatch: {base_name} (points: {len(xyz)}, labels: {len(labels)})"
+        output_file = os.path.join(output_dir, f"{base_name}_pred.ply")
+        # Largest clouds first, so that workers finish at about the same time
+        size = os.path.getsize(cloud_path) / 1e6
+        jobs.append((output_file, size, write_colored_ply, (cloud_path, labels_path, output_file)))
 
-        # Create colored point cloud
-        pcd = create_colored_pcd(xyz, labels)
+    def report(output_file, num_points):
+        print(f"Saved prediction PLY: {output_file} ({num_points:,} points)")
 
-        # Save
-        output_file = os.path.join(output_dir, f"{base_name}_pred.ply")
-        o3d.io.write_point_cloud(output_file, pcd)
-        print(f"Saved prediction PLY: {output_file}")
+    run_budgeted(jobs, workers, desc='export', on_done=report)
 
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description='Color predicted Semantic3D labels and save as PLY')
-    parser.add_argument('--txt_dir', help='Directory containing original .txt clouds', default='Semantic3D/processed')
+    parser.add_argument('--txt_dir', help='Directory containing original .txt clouds or binary containers', default='Semantic3D/processed')
     parser.add_argument('--labels_dir', help='Directory containing .labels prediction files', default='test/Semantic3D')
     parser.add_argument('--output_dir', help='Directory to save colored prediction PLY files', default='test/Semantic3D/clouds')
+    parser.add_argument('--workers', help='Number of files exported in parallel', type=int, default=1)
 
     args = parser.parse_args()
 
-    process_predictions(args.txt_dir, args.labels_dir, args.output_dir)
+    process_predictions(args.txt_dir, args.labels_dir, args.output_dir, args.workers)
     print("All prediction PLYs created.")
@@ -0,0 +1,393 @@
+"""Statistics of a processed Semantic3D dataset.
+
+A single streaming pass over every processed cloud computes per-class point
+counts of the train, val and test splits, bounding box and point density of
+every station, mean/std of the features, and the station, labeling, point
+count and class counts of every cloud. The result is written to `dataset_stats.json` in the
+dataset directory; configs reference that file for `class_weights` instead
+of hardcoding the counts, so re-running this pass after preprocessing or
+after changing `val_files` keeps them current. `Semantic3DForEval` indexes
+the dataset from its cloud records instead of scanning the directory.
+"""
+import os
+import json
+import glob
+import argparse
+import logging
+import yaml
+import numpy as np
+from pathlib import Path
+from src.processing.cloud_io import (BINARY_EXT, cloud_name, has_labels,
+                                     is_binary_cloud, owned_rows, read_cloud,
+                                     station_name)
+from src.processing.text_stream import iter_cloud_parts
+from src.processing.scheduler import run_budgeted
+from src.processing.manifest import input_record, input_matches
+
+STATS_NAME = 'dataset_stats.json'
+STATS_VERSION = 1
+
+# Label 0 (unlabeled) plus the 8 Semantic3D classes
+NUM_LABELS = 9
+FEATURES = ['intensity', 'red', 'green', 'blue']
+
+# Points held in memory per file while streaming
+CHUNK_ROWS = 2**20
+
+# Train split point counts of classes 1..8 that were hardcoded before the
+# statistics pass existed
+LEGACY_CLASS_WEIGHTS = [
+    5181602, 5012952, 6830086, 1311528, 10476365, 946982, 334860, 269353
+]
+
+log = logging.getLogger(__name__)
+
+
+def list_clouds(dataset_path):
+    """Processed clouds of a dataset directory, one path per cloud name.
+
+    A binary container is preferred over a text cloud of the same name.
+    """
+    clouds = {}
+    for path in sorted(glob.glob(str(Path(dataset_path) / '*.txt'))):
+        clouds[cloud_name(path)] = path
+    for path in sorted(glob.glob(str(Path(dataset_path) / ('*' + BINARY_EXT)))):
+        clouds[cloud_name(path)] = path
+    return [clouds[name] for name in sorted(clouds)]
+
+
+def scan_clouds(dataset_path):
+    """Cloud records of a dataset directory, from a single directory listing.
+
+    Whether a text cloud is labeled is read from the listing; binary
+    containers are opened to read their header.
+
+    Returns:
+        A dict of cloud file name -> {'station', 'labeled', 'num_points'}
+        with None point counts.
+    """
+    listing = set(os.listdir(dataset_path))
+    clouds = {}
+    for file_name in sorted(listing):
+        name = cloud_name(file_name)
+        if file_name.endswith(BINARY_EXT):
+            labeled = has_labels(os.path.join(dataset_path, file_name))
+        elif file_name.endswith('.txt') and name + BINARY_EXT not in listing:
+            labeled = name + '.labels' in listing
+        else:
+            continue
+        clouds[file_name] = {'station': station_name(file_name),
+                             'labeled': labeled,
+                             'num_points': None}
+    return clouds
+
+
+def cloud_files(file_names):
+    """The cloud files in a directory listing, as `list_clouds` picks them."""
+    names = set(file_names)
+    return {file_name for file_name in names
+            if file_name.endswith(BINARY_EXT) or
+            (file_name.endswith('.txt') and cloud_name(file_name) + BINARY_EXT not in names)}
+
+
+def load_cloud_index(dataset_path):
+    """Cloud records saved in the statistics file of a dataset, None if there are none.
+
+    Returns:
+        The records of `scan_clouds`, with point counts.
+    """
+    stats_path = os.path.join(dataset_path, STATS_NAME)
+    if not os.path.exists(stats_path):
+        return None
+    try:
+        stats = load_stats(stats_path)
+    except ValueError as e:
+        log.warning(str(e))
+        return None
+    return stats.get('clouds')
+
+
+def labels_path_of(cloud_path):
+    """The .labels sibling of a text cloud, None if there is none."""
+    if is_binary_cloud(cloud_path):
+        return None
+    labels_path = cloud_path[:-len('.txt')] + '.labels'
+    return labels_path if os.path.exists(labels_path) else None
+
+
+def iter_cloud_chunks(cloud_path, chunk_rows=CHUNK_ROWS):
+    """Stream a processed cloud in chunks of at most `chunk_rows` points.
+
+    Yields:
+        (xyz, features, labels) with float64 features in the order of
+        `FEATURES` and None labels for unlabeled clouds.
+    """
+    if is_binary_cloud(cloud_path):
+        cloud = read_cloud(cloud_path)
+        labels = cloud.get('labels')
+        for start in range(0, len(cloud['xyz']), chunk_rows):
+            end = start + chunk_rows
+            features = np.column_stack([cloud['intensity'][start:end],
+                                        cloud['rgb'][start:end]])
+            yield (cloud['xyz'][start:end], features.astype(np.float64),
+                   None if labels is None else labels[start:end])
+        return
+
+    for pc, labels in iter_cloud_parts(cloud_path, labels_path_of(cloud_path), chunk_rows):
+        yield pc[:, :3], pc[:, 3:7].astype(np.float64), labels
+
+
+def merge_moments(a, b):
+    """Merge two (count, mean, m2) feature moments (Chan et al.)."""
+    count_a, mean_a, m2_a = a
+    count_b, mean_b, m2_b = b
+    count = count_a + count_b
+    if count == 0:
+        return a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / count
+    m2 = m2_a + m2_b + delta ** 2 * count_a * count_b / count
+    return count, mean, m2
+
+
+def empty_moments():
+    return 0, np.zeros(len(FEATURES)), np.zeros(len(FEATURES))
+
+
+def file_stats(cloud_path, chunk_rows=CHUNK_ROWS):
+    """Statistics of one processed cloud, computed in a single streaming pass.
+
+    Of a tile only the points it owns are counted, so the overlap margins
+    shared with neighbouring tiles do not count twice.
+
+    Returns:
+        A dict with `num_points`, `class_counts` (None for unlabeled clouds),
+        `bbox_min`, `bbox_max` and feature `moments`.
+    """
+    labeled = (has_labels(cloud_path) if is_binary_cloud(cloud_path)
+               else labels_path_of(cloud_path) is not None)
+    num_points = 0
+    class_counts = np.zeros(NUM_LABELS, dtype=np.int64) if labeled else None
+    bbox_min = np.full(3, np.inf)
+    bbox_max = np.full(3, -np.inf)
+    moments = empty_moments()
+    owned = owned_rows(cloud_path)
+
+    for xyz, features, labels in iter_cloud_chunks(cloud_path, chunk_rows):
+        if owned is not None:
+            if num_points >= owned:
+                break
+            keep = owned - num_points
+            xyz, features = xyz[:keep], features[:keep]
+            labels = None if labels is None else labels[:keep]
+        num_points += len(xyz)
+        bbox_min = np.minimum(bbox_min, xyz.min(axis=0))
+        bbox_max = np.maximum(bbox_max, xyz.max(axis=0))
+
+        mean = features.mean(axis=0)
+        moments = merge_moments(moments, (len(features), mean,
+                                          ((features - mean) ** 2).sum(axis=0)))
+
+        if labels is not None:
+            if labels.min() < 0 or labels.max() >= NUM_LABELS:
+                raise ValueError(f"{cloud_path} contains labels outside of 0..{NUM_LABELS - 1}")
+            class_counts += np.bincount(labels, minlength=NUM_LABELS)
+
+    return {
+        'num_points': num_points,
+        'class_counts': class_counts,
+        'bbox_min': bbox_min,
+        'bbox_max': bbox_max,
+        'moments': moments
+    }
+
+
+def split_of(name, labeled, val_files):
+    """Split of a processed cloud: val if its station is one of `val_files`."""
+    if not labeled:
+        return 'test'
+    return 'val' if station_name(name) in set(val_files) else 'train'
+
+
+def feature_summary(moments):
+    count, mean, m2 = moments
+    std = np.sqrt(m2 / count) if count else np.zeros(len(FEATURES))
+    return {feature: {'mean': float(mean[i]), 'std': float(std[i])}
+            for i, feature in enumerate(FEATURES)}
+
+
+def compute_stats(dataset_path, val_files, workers=1, chunk_rows=CHUNK_ROWS):
+    """Statistics of all processed clouds in `dataset_path`.
+
+    Args:
+        dataset_path: Directory with the processed clouds.
+        val_files: Cloud name fragments assigned to the val split.
+        workers: Number of clouds processed in parallel.
+        chunk_rows: Points held in memory per cloud.
+
+    Returns:
+        The JSON-serializable statistics written by `save_stats`.
+    """
+    cloud_paths = list_clouds(dataset_path)
+    jobs = [(cloud_name(path), os.path.getsize(path) / 1e6, file_stats, (path, chunk_rows))
+            for path in cloud_paths]
+    results = run_budgeted(jobs, workers, desc='dataset stats')
+
+    splits = {split: {'files': 0,
+                      'num_points': 0,
+                      'class_counts': np.zeros(NUM_LABELS, dtype=np.int64),
+                      'moments': empty_moments()}
+              for split in ('train', 'val', 'test')}
+    stations = {}
+    clouds = {}
+    inputs = []
+
+    for path in cloud_paths:
+        name = cloud_name(path)
+        result = results[name]
+        labeled = result['class_counts'] is not None
+        split_name = split_of(name, labeled, val_files)
+        split = splits[split_name]
+        split['files'] += 1
+        split['num_points'] += result['num_points']
+        split['moments'] = merge_moments(split['moments'], result['moments'])
+        if labeled:
+            split['class_counts'] += result['class_counts']
+
+        station = stations.setdefault(station_name(path), {
+            'split': split_name,
+            'files': [],
+            'num_points': 0,
+            'bbox_min': np.full(3, np.inf),
+            'bbox_max': np.full(3, -np.inf)
+        })
+        station['files'].append(os.path.basename(path))
+        clouds[os.path.basename(path)] = {
+            'station': station_name(path),
+            'labeled': labeled,
+            'num_points': result['num_points'],
+            # Per-label point counts, used by ClassBalancedSampler to pick clouds
+            'class_counts': result['class_counts'].tolist() if labeled else None
+        }
+        station['num_points'] += result['num_points']
+        station['bbox_min'] = np.minimum(station['bbox_min'], result['bbox_min'])
+        station['bbox_max'] = np.maximum(station['bbox_max'], result['bbox_max'])
+
+        inputs.append(input_record(os.path.abspath(path)))
+        if labels_path_of(path) is not None:
+            inputs.append(input_record(os.path.abspath(labels_path_of(path))))
+
+    for station in stations.values():
+        if station['num_points']:
+            extent = station['bbox_max'] - station['bbox_min']
+            area = float(extent[0] * extent[1])
+            station['bbox_min'] = station['bbox_min'].tolist()
+            station['bbox_max'] = station['bbox_max'].tolist()
+        else:
+            area = 0.0
+            station['bbox_min'] = station['bbox_max'] = None
+        # Points per square meter of the XY bounding box
+        station['density'] = station['num_points'] / area if area > 0 else None
+
+    return {
+        'version': STATS_VERSION,
+        'dataset_path': os.path.abspath(dataset_path),
+        'val_files': list(val_files),
+        # Point counts of classes 1..8 in the train split, as used by SemSegLoss
+        'class_weights': splits['train']['class_counts'][1:].tolist(),
+        'splits': {
+            name: {
+                'files': split['files'],
+                'num_points': split['num_points'],
+                'class_counts': split['class_counts'].tolist(),
+                'features': feature_summary(split['moments'])
+            } for name, split in splits.items()
+        },
+        'stations': stations,
+        'clouds': clouds,
+        'inputs': inputs
+    }
+
+
+def save_stats(stats, path):
+    tmp_path = str(path) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(stats, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def load_stats(path):
+    with open(path, 'r') as f:
+        stats = json.load(f)
+    if stats.get('version') != STATS_VERSION:
+        raise ValueError(f"{path} has statistics version {stats.get('version')}, "
+                         f"expected {STATS_VERSION}")
+    return stats
+
+
+def resolve_class_weights(class_weights, dataset_path, val_files=None):
+    """Turn a `class_weights` config entry into per-class point counts.
+
+    A list is returned as is. A string names a statistics file, either as
+    given or relative to `dataset_path`. When the file does not exist yet the
+    legacy hardcoded counts are used with a warning; when it no longer
+    matches the dataset or `val_files`, a warning asks to re-run this pass.
+    """
+    if not isinstance(class_weights, str):
+        return class_weights
+
+    stats_path = class_weights
+    if not os.path.exists(stats_path):
+        stats_path = os.path.join(dataset_path, class_weights)
+    if not os.path.exists(stats_path):
+        log.warning(f"Dataset statistics {class_weights} not found, using the legacy "
+                    f"class weights; run src/processing/dataset_stats.py to compute them")
+        return list(LEGACY_CLASS_WEIGHTS)
+
+    stats = load_stats(stats_path)
+    if val_files is not None and sorted(val_files) != sorted(stats['val_files']):
+        log.warning(f"{stats_path} was computed for val_files {stats['val_files']}, "
+                    f"not {list(val_files)}; re-run src/processing/dataset_stats.py")
+    recorded = {record['path'] for record in stats['inputs']}
+    current = {os.path.abspath(path) for path in list_clouds(dataset_path)}
+    if (not current <= recorded or
+            not all(input_matches(record) for record in stats['inputs'])):
+        log.warning(f"The processed dataset changed since {stats_path} was computed; "
+                    f"re-run src/processing/dataset_stats.py")
+    return stats['class_weights']
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(levelname)s - %(asctime)s - %(module)s - %(message)s',
+    )
+
+    parser = argparse.ArgumentParser(
+        description='Compute class counts and feature statistics of a processed Semantic3D dataset')
+    parser.add_argument('--dataset_path', help='Directory with the processed clouds',
+                        default='Semantic3D/processed')
+    parser.add_argument('--config', help='Config providing val_files',
+                        default='configs/randlanet_semantic3d.yml')
+    parser.add_argument('--val_files', help='Cloud names of the val split (overrides the config)',
+                        nargs='+', default=None)
+    parser.add_argument('--workers', help='Number of files processed in parallel',
+                        type=int, default=1)
+    parser.add_argument('--out_path', help=f'Output file (default: <dataset_path>/{STATS_NAME})',
+                        default=None)
+
+    args = parser.parse_args()
+
+    val_files = args.val_files
+    if val_files is None:
+        with open(args.config, 'r') as f:
+            val_files = yaml.safe_load(f)['dataset'].get('val_files', [])
+
+    stats = compute_stats(args.dataset_path, val_files, args.workers)
+    out_path = args.out_path or os.path.join(args.dataset_path, STATS_NAME)
+    save_stats(stats, out_path)
+
+    for name, split in stats['splits'].items():
+        log.info(f"{name}: {split['files']} files, {split['num_points']:,} points")
+    log.info(f"class_weights: {stats['class_weights']}")
+    log.info(f"Saved dataset statistics to {out_path}")
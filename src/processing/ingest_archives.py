@@ -0,0 +1,288 @@
+"""Preprocess Semantic3D straight from the downloaded `.7z` archives.
+
+`download_semantic3d.sh` extracts every archive into text files of several
+gigabytes that `preprocess_semantic3d.py` then reads again. Here each cloud
+archive and its member of `sem8_labels_training.7z` are decompressed with
+`7z x -so` into pipes that are parsed as they arrive, and the subsampled
+cloud is written directly, in text or binary format: clouds up to
+`--size_limit` MB are subsampled in memory, larger ones out of core (see
+`voxel_subsample.py`). No extracted text ever touches the disk.
+
+Outputs are named after the archive, not after its member, so
+`neugasse_station1_xyz_intensity_rgb.7z` (which contains
+`station1_xyz_intensity_rgb.txt`) yields `neugasse_station1_xyz_intensity_rgb`
+as the download script's rename did. Only archives with labels are ingested,
+like `preprocess_semantic3d.py` only processes clouds with labels. Outputs
+are recorded in the same `manifest.json`, so re-runs skip archives whose
+outputs are up to date.
+
+Works offline on local archives, e.g. the `zip_files` directory left by the
+download script:
+
+    python src/processing/ingest_archives.py --archive_path Semantic3D/zip_files
+"""
+import os
+import glob
+import shutil
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+from contextlib import contextmanager, ExitStack
+from src.processing.text_stream import BYTES_PER_POINT, TEXT_BYTES_PER_POINT
+from src.processing.scheduler import run_budgeted, available_memory
+from src.processing.manifest import Manifest, input_record, output_record
+from src.processing.voxel_subsample import voxel_subsample_file
+from src.processing.preprocess_semantic3d import (process_small_file,
+                                                  DEFAULT_MEMORY_BUDGET)
+
+LABELS_ARCHIVE = 'sem8_labels_training.7z'
+
+# Grid size of preprocess_semantic3d.preprocess
+SUB_GRID_SIZE = 0.01
+
+# Memory in megabytes of one 7z process decompressing an archive
+DECOMPRESS_MEMORY = 100
+
+
+def find_7z():
+    """Path of the 7z executable (7z, 7za or 7zr)."""
+    for name in ('7z', '7za', '7zr'):
+        path = shutil.which(name)
+        if path is not None:
+            return path
+    raise RuntimeError("7z could not be found, please install it (p7zip) to continue")
+
+
+def archive_members(archive_path, seven_zip='7z'):
+    """Files of an archive.
+
+    Returns:
+        A dict mapping the path of every file in the archive to its
+        uncompressed size in bytes.
+    """
+    listing = subprocess.run([seven_zip, 'l', '-slt', str(archive_path)],
+                             capture_output=True, text=True)
+    if listing.returncode != 0:
+        raise RuntimeError(f"Cannot list {archive_path}: {listing.stderr.strip()}")
+
+    # Technical listing: blocks of "Key = value" lines separated by blank
+    # lines; the blocks after the "----------" line describe the files
+    members = {}
+    _, _, entries = listing.stdout.partition('\n----------\n')
+    for block in entries.split('\n\n'):
+        fields = dict(line.split(' = ', 1) for line in block.splitlines() if ' = ' in line)
+        if 'Path' in fields and fields.get('Folder') != '+' and 'D' not in fields.get('Attributes', ''):
+            members[fields['Path']] = int(fields.get('Size') or 0)
+    return members
+
+
+@contextmanager
+def archive_stream(archive_path, member=None, seven_zip='7z'):
+    """Binary pipe of the decompressed content of one archive member.
+
+    Args:
+        archive_path: Path of the `.7z` archive.
+        member: Path of the file in the archive, all files if None.
+        seven_zip: 7z executable.
+
+    Raises:
+        RuntimeError: If 7z fails after the stream was read completely.
+    """
+    command = [seven_zip, 'x', '-so', str(archive_path)]
+    if member is not None:
+        command.append(member)
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr)
+        try:
+            yield process.stdout
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+        if returncode != 0:
+            stderr.seek(0)
+            raise RuntimeError(f"Extracting {member or archive_path} failed: "
+                               f"{stderr.read().decode(errors='replace').strip()}")
+
+
+def cloud_member(archive_path, seven_zip='7z'):
+    """The `.txt` cloud of a cloud archive and its uncompressed size."""
+    clouds = [(path, size) for path, size in archive_members(archive_path, seven_zip).items()
+              if path.endswith('.txt')]
+    if len(clouds) != 1:
+        raise ValueError(f"Expected one .txt cloud in {archive_path}, found {len(clouds)}")
+    return clouds[0]
+
+
+def labels_members(labels_archive, seven_zip='7z'):
+    """Members of the labels archive by their file name without `.labels`."""
+    return {Path(path).name[:-len('.labels')]: path
+            for path in archive_members(labels_archive, seven_zip)
+            if path.endswith('.labels')}
+
+
+def ingest_archive(archive_path, labels_archive, labels_member, out_path, sub_grid_size,
+                   args, seven_zip='7z'):
+    """Subsample the cloud of one archive without extracting it.
+
+    Returns:
+        Manifest records of the written files.
+    """
+    name = Path(archive_path).stem
+    member, size = cloud_member(archive_path, seven_zip)
+    output_path = os.path.join(out_path, name + '.txt')
+
+    with ExitStack() as stack:
+        pc_f = stack.enter_context(archive_stream(archive_path, member, seven_zip))
+        labels_f = stack.enter_context(archive_stream(labels_archive, labels_member, seven_zip))
+        if size / 1e6 <= args.size_limit:
+            outputs = process_small_file(pc_f, output_path, sub_grid_size, args.format,
+                                         labels_path=labels_f)
+        else:
+            print(f"Subsampling {name} out of core")
+            spill_dir = None
+            if args.spill_dir is not None:
+                spill_dir = os.path.join(args.spill_dir, name + '_voxels.tmp')
+            outputs = voxel_subsample_file(pc_f, output_path, sub_grid_size, args.format,
+                                           args.memory_budget, args.voxel_workers,
+                                           spill_dir, labels_path=labels_f,
+                                           num_points=size / TEXT_BYTES_PER_POINT)
+
+    return [output_record(p, out_path) for p in outputs]
+
+
+def archive_params(size, sub_grid_size, args):
+    """Parameters that determine the outputs of one archive, as in
+    `preprocess_semantic3d.file_params` with the voxel split mode."""
+    split = 'none' if size / 1e6 <= args.size_limit else 'voxel'
+    return {'sub_grid_size': sub_grid_size, 'format': args.format, 'split': split}
+
+
+def estimate_peak_memory(size, args):
+    """Rough peak memory in megabytes needed to ingest a cloud of `size` bytes."""
+    num_points = size / TEXT_BYTES_PER_POINT
+    if size / 1e6 <= args.size_limit:
+        # pandas keeps its parse buffers alive next to the float32 array
+        peak = 2 * num_points * BYTES_PER_POINT / 1e6
+    else:
+        peak = args.memory_budget
+    return peak + 2 * DECOMPRESS_MEMORY
+
+
+def ingest(args):
+    """Main ingestion function."""
+    seven_zip = find_7z()
+    archive_path = Path(args.archive_path)
+    out_path = args.out_path
+    sub_grid_size = SUB_GRID_SIZE
+
+    if out_path is None:
+        out_path = archive_path.parent / 'processed'
+        print("out_path not given, Saving output in {}".format(out_path))
+    out_path = str(out_path)
+
+    labels_archive = args.labels_archive or str(archive_path / LABELS_ARCHIVE)
+    labels = labels_members(labels_archive, seven_zip)
+
+    archives = sorted(p for p in glob.glob(str(archive_path / '*.7z'))
+                      if Path(p).name != Path(labels_archive).name)
+    unlabeled = [p for p in archives if Path(p).stem not in labels]
+    if unlabeled:
+        print(f"Skipping {len(unlabeled)} archives without labels: "
+              f"{', '.join(Path(p).stem for p in unlabeled)}")
+
+    os.makedirs(out_path, exist_ok=True)
+
+    manifest = Manifest(out_path)
+    jobs = []
+    pending = {}
+    for path in archives:
+        name = Path(path).stem
+        if name not in labels:
+            continue
+        key = name + '.txt'
+        _, size = cloud_member(path, seven_zip)
+        params = archive_params(size, sub_grid_size, args)
+        if not args.force and manifest.is_up_to_date(key, params):
+            continue
+
+        # The labels archive is shared by all clouds, so its fingerprint
+        # only decides together with the cloud archive
+        inputs = [input_record(path), input_record(labels_archive)]
+        pending[key] = (inputs, params)
+        jobs.append((key, estimate_peak_memory(size, args), ingest_archive,
+                     (path, labels_archive, labels[name], out_path, sub_grid_size,
+                      args, seven_zip)))
+
+    num_labeled = len(archives) - len(unlabeled)
+    print(f"{num_labeled - len(jobs)} of {num_labeled} archives are up to date")
+
+    def record(key, outputs):
+        inputs, params = pending[key]
+        manifest.record(key, inputs, params, outputs)
+
+    run_budgeted(jobs, args.workers, args.max_memory, desc='ingest', on_done=record)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Subsample Semantic3D directly from its .7z archives.')
+    parser.add_argument('--archive_path',
+                        help='Directory of the downloaded .7z archives',
+                        required=True)
+    parser.add_argument('--labels_archive',
+                        help='Path of the labels archive (default: {} in '
+                        'archive_path).'.format(LABELS_ARCHIVE),
+                        default=None)
+    parser.add_argument('--out_path',
+                        help='Output path (default: processed next to archive_path)',
+                        default=None)
+    parser.add_argument(
+        '--size_limit',
+        help='Uncompressed size in Megabytes above which a cloud is '
+        'subsampled out of core.',
+        default=2000,
+        type=int)
+    parser.add_argument(
+        '--memory_budget',
+        help='Memory budget in Megabytes for subsampling one large pointcloud.',
+        default=DEFAULT_MEMORY_BUDGET,
+        type=int)
+    parser.add_argument(
+        '--voxel_workers',
+        help='Number of voxel partitions of a large pointcloud reduced in parallel.',
+        default=1,
+        type=int)
+    parser.add_argument(
+        '--spill_dir',
+        help='Directory of the temporary voxel partitions (default: out_path).',
+        default=None)
+    parser.add_argument(
+        '--workers',
+        help='Number of archives processed in parallel.',
+        default=1,
+        type=int)
+    parser.add_argument(
+        '--max_memory',
+        help='Total memory budget in Megabytes shared by all workers '
+        '(default: 80%% of the physical memory).',
+        default=int(0.8 * available_memory()),
+        type=int)
+    parser.add_argument(
+        '--force',
+        help='Reprocess every archive, even if the manifest says it is up to date.',
+        action='store_true')
+    parser.add_argument(
+        '--format',
+        help='Output format of the processed clouds.',
+        choices=['txt', 'binary'],
+        default='txt')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    ingest(parse_args())
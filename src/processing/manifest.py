@@ -0,0 +1,131 @@
+"""Manifest of preprocessing outputs for incremental re-runs.
+
+The manifest lives in the output directory as `manifest.json`. For every raw
+cloud it records the fingerprint of the inputs (path, size, mtime and
+optionally a content hash), the parameters that shaped the outputs, and the
+size and checksum of every output file. A raw cloud is only reprocessed when
+one of those no longer matches.
+"""
+import os
+import json
+import hashlib
+
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+
+
+def file_checksum(path, block_size=2**20):
+    """SHA-256 of a file's content."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def input_record(path, use_hash=False):
+    """Fingerprint of an input file."""
+    stat = os.stat(path)
+    record = {'path': str(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+    if use_hash:
+        record['sha256'] = file_checksum(path)
+    return record
+
+
+def output_record(path, out_path):
+    """Size and checksum of an output file, with its path relative to out_path."""
+    return {
+        'path': os.path.relpath(path, out_path),
+        'size': os.path.getsize(path),
+        'sha256': file_checksum(path)
+    }
+
+
+def input_matches(record, use_hash=False):
+    """Check whether an input still matches its recorded fingerprint.
+
+    Size and mtime are compared first. With `use_hash`, a changed mtime is
+    tolerated as long as the content hash is unchanged (e.g. after a copy).
+    """
+    path = record['path']
+    if not os.path.exists(path):
+        return False
+    stat = os.stat(path)
+    if stat.st_size != record['size']:
+        return False
+    if stat.st_mtime == record['mtime']:
+        return True
+    return use_hash and record.get('sha256') == file_checksum(path)
+
+
+class Manifest(object):
+    """Records which outputs were produced from which inputs and parameters."""
+
+    def __init__(self, out_path):
+        self.out_path = str(out_path)
+        self.path = os.path.join(self.out_path, MANIFEST_NAME)
+        self.files = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                manifest = json.load(f)
+            if manifest.get('version') == MANIFEST_VERSION:
+                self.files = manifest['files']
+
+    def is_up_to_date(self, key, params, use_hash=False, verify=False):
+        """Check whether the outputs of `key` are complete and still current.
+
+        Args:
+            key: Name of the raw cloud.
+            params: Parameters the outputs must have been produced with.
+            use_hash: Fall back to content hashes when input mtimes changed.
+            verify: Also re-checksum every output instead of comparing sizes.
+        """
+        entry = self.files.get(key)
+        if entry is None or entry['params'] != params:
+            return False
+        if not all(input_matches(record, use_hash) for record in entry['inputs']):
+            return False
+        for record in entry['outputs']:
+            path = os.path.join(self.out_path, record['path'])
+            if not os.path.exists(path) or os.path.getsize(path) != record['size']:
+                return False
+            if verify and file_checksum(path) != record['sha256']:
+                return False
+        return True
+
+    def outputs(self, key):
+        """Absolute paths of the outputs recorded for `key`."""
+        entry = self.files.get(key, {'outputs': []})
+        return [os.path.join(self.out_path, record['path'])
+                for record in entry['outputs']]
+
+    def record(self, key, inputs, params, outputs):
+        """Record the outputs of `key` and remove outputs it no longer produces.
+
+        Args:
+            key: Name of the raw cloud.
+            inputs: Input records from `input_record`.
+            params: Parameters the outputs were produced with.
+            outputs: Output records from `output_record`.
+        """
+        new_paths = {record['path'] for record in outputs}
+        for old_path in self.outputs(key):
+            if (os.path.relpath(old_path, self.out_path) not in new_paths and
+                    os.path.exists(old_path)):
+                os.remove(old_path)
+
+        self.files[key] = {
+            'inputs': inputs,
+            'params': params,
+            'outputs': outputs
+        }
+        self.save()
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'version': MANIFEST_VERSION,
+                'files': self.files
+            }, f, indent=2)
+        os.replace(tmp_path, self.path)
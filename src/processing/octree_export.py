@@ -0,0 +1,388 @@
+"""Level-of-detail octree export of predicted clouds.
+
+Every point is assigned a random level of detail: about 7/8 of the points go
+to the deepest level, 7/64 to the one above, and so on, so each level holds
+roughly eight times the points of its parent and the union of the levels up
+to L is a uniform subsample of the cloud. A point is stored in the node of its
+level that contains it. Nodes are small binary chunks (float32 xyz and uint8
+label) next to a JSON index:
+
+    <name>_octree/index.json
+    <name>_octree/nodes/r.bin, r0.bin, r07.bin, ...
+
+Node names follow the path from the root, one octant digit per level
+(bit 2: x, bit 1: y, bit 0: z).
+
+The build streams the cloud twice (bounding box, then levels), spills the
+points of every subtree below `SUBTREE_LEVEL` into its own file, and builds
+the subtrees in parallel. A subtree whose spill exceeds the memory budget is
+split into its children again, so clouds larger than RAM are handled.
+"""
+import os
+import json
+import shutil
+import argparse
+import numpy as np
+from src.processing.cloud_io import find_cloud, iter_xyz
+from src.processing.scheduler import run_budgeted
+from src.processing.convert_to_ply import (color_lut, iter_predictions, ply_header,
+                                           ply_vertex)
+
+INDEX_NAME = 'index.json'
+INDEX_VERSION = 1
+
+# Record of a node chunk, and of a spill file (which also carries the level)
+NODE_DTYPE = np.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4'), ('label', 'u1')])
+SPILL_DTYPE = np.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4'),
+                        ('label', 'u1'), ('level', 'u1')])
+
+# Average number of points per node aimed for at the deepest level
+DEFAULT_NODE_POINTS = 50000
+
+# Depth of the subtrees that are built in parallel (up to 64 subtrees)
+SUBTREE_LEVEL = 2
+
+# Points streamed per chunk
+CHUNK_ROWS = 2**21
+
+# Memory in megabytes one worker may use to build a subtree in memory, and
+# the peak bytes held per spilled byte while doing so (records, keys, order)
+DEFAULT_MEMORY_BUDGET = 2000
+IN_MEMORY_FACTOR = 4
+
+
+def node_name(level, cell):
+    """Name of the node of `level` at integer cell coordinates `cell`."""
+    digits = []
+    for depth in range(level - 1, -1, -1):
+        digits.append(str(((cell[0] >> depth) & 1) << 2 |
+                          ((cell[1] >> depth) & 1) << 1 |
+                          ((cell[2] >> depth) & 1)))
+    return 'r' + ''.join(digits)
+
+
+def node_cell(name):
+    """Level and integer cell coordinates of a node name."""
+    cell = [0, 0, 0]
+    for digit in name[1:]:
+        octant = int(digit)
+        cell = [cell[0] * 2 + (octant >> 2 & 1),
+                cell[1] * 2 + (octant >> 1 & 1),
+                cell[2] * 2 + (octant & 1)]
+    return len(name) - 1, cell
+
+
+def cells_at(xyz, level, origin, size):
+    """Integer cell coordinates of points at a level of the octree."""
+    resolution = 2 ** level
+    cells = np.floor((np.asarray(xyz, dtype=np.float64) - origin) / size * resolution)
+    return np.clip(cells, 0, resolution - 1).astype(np.int64)
+
+
+def _linear(cells, level):
+    resolution = 2 ** level
+    return (cells[:, 0] * resolution + cells[:, 1]) * resolution + cells[:, 2]
+
+
+def _append(path, records):
+    with open(path, 'ab') as f:
+        f.write(records.tobytes())
+
+
+def _to_nodes(records):
+    nodes = np.empty(len(records), dtype=NODE_DTYPE)
+    for field in NODE_DTYPE.names:
+        nodes[field] = records[field]
+    return nodes
+
+
+def write_node_groups(records, nodes_dir, origin, size):
+    """Append spill records to the node files of their level and cell."""
+    xyz = np.column_stack([records['x'], records['y'], records['z']])
+    for level in np.unique(records['level']):
+        selected = records['level'] == level
+        cells = cells_at(xyz[selected], int(level), origin, size)
+        keys = _linear(cells, int(level))
+        order = np.argsort(keys, kind='stable')
+        keys, level_records, cells = keys[order], records[selected][order], cells[order]
+
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        ends = np.r_[starts[1:], len(keys)]
+        for start, end in zip(starts, ends):
+            name = node_name(int(level), cells[start])
+            _append(os.path.join(nodes_dir, name + '.bin'), _to_nodes(level_records[start:end]))
+
+
+def build_subtree(spill_path, level, cell, nodes_dir, origin, size,
+                  memory_budget=DEFAULT_MEMORY_BUDGET, chunk_rows=CHUNK_ROWS):
+    """Write the nodes of the subtree rooted at (level, cell) from its spill file.
+
+    A spill that fits the memory budget is grouped in memory. A larger one is
+    streamed: points of the subtree root go to its node, the others to the
+    spill files of the eight children, which are then built one by one.
+
+    Returns:
+        The number of points written.
+    """
+    spill_size = os.path.getsize(spill_path)
+    num_records = spill_size // SPILL_DTYPE.itemsize
+    if not num_records:
+        os.remove(spill_path)
+        return 0
+
+    if spill_size * IN_MEMORY_FACTOR <= memory_budget * 1e6:
+        write_node_groups(np.fromfile(spill_path, dtype=SPILL_DTYPE), nodes_dir, origin, size)
+        os.remove(spill_path)
+        return num_records
+
+    records = np.memmap(spill_path, dtype=SPILL_DTYPE, mode='r')
+    root_path = os.path.join(nodes_dir, node_name(level, cell) + '.bin')
+    child_paths = {}
+    for start in range(0, num_records, chunk_rows):
+        chunk = np.array(records[start:start + chunk_rows])
+        own = chunk['level'] == level
+        if own.any():
+            _append(root_path, _to_nodes(chunk[own]))
+
+        rest = chunk[~own]
+        if not len(rest):
+            continue
+        xyz = np.column_stack([rest['x'], rest['y'], rest['z']])
+        octants = cells_at(xyz, level + 1, origin, size) - 2 * np.asarray(cell)
+        octants = (octants[:, 0] << 2) | (octants[:, 1] << 1) | octants[:, 2]
+        for octant in np.unique(octants):
+            path = child_paths.setdefault(int(octant), f"{spill_path[:-len('.spill')]}_{octant}.spill")
+            _append(path, rest[octants == octant])
+    del records
+    os.remove(spill_path)
+
+    for octant, path in sorted(child_paths.items()):
+        child = [cell[0] * 2 + (octant >> 2 & 1),
+                 cell[1] * 2 + (octant >> 1 & 1),
+                 cell[2] * 2 + (octant & 1)]
+        build_subtree(path, level + 1, child, nodes_dir, origin, size,
+                      memory_budget, chunk_rows)
+    return num_records
+
+
+def export_octree(cloud_path, labels_path, out_dir, node_points=DEFAULT_NODE_POINTS,
+                  workers=1, memory_budget=DEFAULT_MEMORY_BUDGET, seed=0,
+                  chunk_rows=CHUNK_ROWS):
+    """Build the level-of-detail octree of a cloud and its predicted labels.
+
+    Args:
+        cloud_path: Text cloud or binary container.
+        labels_path: Predicted .labels file.
+        out_dir: Output directory of the octree, replaced if it exists.
+        node_points: Average number of points per node at the deepest level.
+        workers: Number of subtrees built in parallel.
+        memory_budget: Memory in megabytes one worker may use.
+        seed: Seed of the level assignment, the output does not depend on
+            the number of workers.
+
+    Returns:
+        The octree index.
+    """
+    # Pass 1: bounding cube
+    num_points = 0
+    bbox_min = np.full(3, np.inf)
+    bbox_max = np.full(3, -np.inf)
+    for xyz in iter_xyz(cloud_path, chunk_rows):
+        num_points += len(xyz)
+        bbox_min = np.minimum(bbox_min, xyz.min(axis=0))
+        bbox_max = np.maximum(bbox_max, xyz.max(axis=0))
+    if not num_points:
+        bbox_min = bbox_max = np.zeros(3)
+    origin = bbox_min
+    size = max(float((bbox_max - bbox_min).max()), 1e-3) * (1 + 1e-6)
+
+    max_level = 0
+    while num_points > node_points * 8 ** max_level and max_level < 20:
+        max_level += 1
+    subtree_level = min(SUBTREE_LEVEL, max_level)
+
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    nodes_dir = os.path.join(out_dir, 'nodes')
+    spill_dir = os.path.join(out_dir, 'spill.tmp')
+    os.makedirs(nodes_dir)
+    os.makedirs(spill_dir)
+
+    try:
+        # Pass 2: assign levels and spill the points of every subtree
+        rng = np.random.default_rng(seed)
+        top_path = os.path.join(spill_dir, 'top.spill')
+        subtree_cells = {}
+        for xyz, labels in iter_predictions(cloud_path, labels_path, chunk_rows):
+            if labels.size and (labels.min() < 0 or labels.max() >= len(color_lut)):
+                raise ValueError(f"Labels of {labels_path} must be in [0, {len(color_lut)})")
+            records = np.empty(len(xyz), dtype=SPILL_DTYPE)
+            records['x'], records['y'], records['z'] = xyz[:, 0], xyz[:, 1], xyz[:, 2]
+            records['label'] = labels
+            depth = np.floor(-np.log(1.0 - rng.random(len(xyz))) / np.log(8))
+            records['level'] = max_level - np.minimum(depth, max_level)
+
+            top = records['level'] < subtree_level
+            if top.any():
+                _append(top_path, records[top])
+            rest = records[~top]
+            if not len(rest):
+                continue
+            cells = cells_at(xyz[~top], subtree_level, origin, size)
+            keys = _linear(cells, subtree_level)
+            for key in np.unique(keys):
+                selected = keys == key
+                subtree_cells.setdefault(int(key), cells[selected][0].tolist())
+                _append(os.path.join(spill_dir, f'{key}.spill'), rest[selected])
+
+        # Levels above the subtrees are small and built in this process
+        if os.path.exists(top_path):
+            write_node_groups(np.fromfile(top_path, dtype=SPILL_DTYPE), nodes_dir, origin, size)
+            os.remove(top_path)
+
+        jobs = []
+        for key, cell in subtree_cells.items():
+            spill_path = os.path.join(spill_dir, f'{key}.spill')
+            estimate = min(os.path.getsize(spill_path) * IN_MEMORY_FACTOR / 1e6, memory_budget)
+            jobs.append((key, estimate, build_subtree,
+                         (spill_path, subtree_level, cell, nodes_dir, origin, size,
+                          memory_budget, chunk_rows)))
+        run_budgeted(jobs, workers, desc='octree')
+        shutil.rmtree(spill_dir)
+    except BaseException:
+        # Leave no partial octree behind
+        shutil.rmtree(out_dir)
+        raise
+
+    return build_index(out_dir, origin, size, max_level, num_points)
+
+
+def build_index(out_dir, origin, size, max_level, num_points):
+    """Write the JSON index of the nodes found in `out_dir`."""
+    nodes = {}
+    nodes_dir = os.path.join(out_dir, 'nodes')
+    for filename in sorted(os.listdir(nodes_dir), key=lambda f: (len(f), f)):
+        name = filename[:-len('.bin')]
+        level, cell = node_cell(name)
+        node_size = size / 2 ** level
+        node_min = np.asarray(origin) + np.asarray(cell) * node_size
+        nodes[name] = {
+            'level': level,
+            'num_points': os.path.getsize(os.path.join(nodes_dir, filename)) // NODE_DTYPE.itemsize,
+            'bounds': [node_min.tolist(), (node_min + node_size).tolist()]
+        }
+
+    index = {
+        'version': INDEX_VERSION,
+        'origin': np.asarray(origin).tolist(),
+        'size': size,
+        'max_level': max_level,
+        'num_points': num_points,
+        'dtype': [[name, NODE_DTYPE[name].str] for name in NODE_DTYPE.names],
+        'nodes': nodes
+    }
+    tmp_path = os.path.join(out_dir, INDEX_NAME + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_path, os.path.join(out_dir, INDEX_NAME))
+    return index
+
+
+def load_index(octree_dir):
+    with open(os.path.join(octree_dir, INDEX_NAME), 'r') as f:
+        index = json.load(f)
+    if index.get('version') != INDEX_VERSION:
+        raise ValueError(f"{octree_dir} has octree version {index.get('version')}, "
+                         f"expected {INDEX_VERSION}")
+    return index
+
+
+def visible_nodes(index, level, bounds=None):
+    """Names of the nodes up to `level` that intersect `bounds`, coarse first.
+
+    Args:
+        index: Octree index from `load_index`.
+        level: Level of detail; every level holds ~8x the points of its parent.
+        bounds: Optional ((xmin, ymin, zmin), (xmax, ymax, zmax)) view box.
+    """
+    names = []
+    for name, node in index['nodes'].items():
+        if node['level'] > level:
+            continue
+        if bounds is not None:
+            node_min, node_max = node['bounds']
+            if any(node_min[i] > bounds[1][i] or node_max[i] < bounds[0][i] for i in range(3)):
+                continue
+        names.append(name)
+    return sorted(names, key=lambda name: (len(name), name))
+
+
+def iter_nodes(octree_dir, level, bounds=None, index=None):
+    """Stream the nodes visible at a level of detail, one node at a time.
+
+    Yields:
+        (name, xyz, labels) with float32 xyz of shape (n, 3) and uint8 labels.
+        Points of a node may lie slightly outside `bounds`.
+    """
+    if index is None:
+        index = load_index(octree_dir)
+    for name in visible_nodes(index, level, bounds):
+        records = np.fromfile(os.path.join(octree_dir, 'nodes', name + '.bin'), dtype=NODE_DTYPE)
+        xyz = np.column_stack([records['x'], records['y'], records['z']])
+        yield name, xyz, records['label']
+
+
+def write_lod_ply(octree_dir, level, output_file, bounds=None):
+    """Write the points visible at a level of detail into a colored binary PLY."""
+    index = load_index(octree_dir)
+    names = visible_nodes(index, level, bounds)
+    num_points = sum(index['nodes'][name]['num_points'] for name in names)
+    with open(output_file, 'wb') as f:
+        f.write(ply_header(num_points))
+        for _, xyz, labels in iter_nodes(octree_dir, level, bounds, index):
+            vertices = np.empty(len(xyz), dtype=ply_vertex)
+            vertices['x'], vertices['y'], vertices['z'] = xyz[:, 0], xyz[:, 1], xyz[:, 2]
+            colors = color_lut[labels]
+            vertices['red'], vertices['green'], vertices['blue'] = colors[:, 0], colors[:, 1], colors[:, 2]
+            f.write(vertices.tobytes())
+    return num_points
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Level-of-detail octree export of predicted Semantic3D clouds')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='Build octrees of all prediction files')
+    build_parser.add_argument('--txt_dir', help='Directory containing original .txt clouds or binary containers', default='Semantic3D/processed')
+    build_parser.add_argument('--labels_dir', help='Directory containing .labels prediction files', default='test/Semantic3D')
+    build_parser.add_argument('--output_dir', help='Directory to save the octrees', default='test/Semantic3D/octrees')
+    build_parser.add_argument('--node_points', help='Average number of points per node at the deepest level', type=int, default=DEFAULT_NODE_POINTS)
+    build_parser.add_argument('--workers', help='Number of subtrees built in parallel', type=int, default=1)
+    build_parser.add_argument('--memory_budget', help='Memory in Megabytes one worker may use', type=int, default=DEFAULT_MEMORY_BUDGET)
+
+    load_parser = subparsers.add_parser('load', help='Write the points of one level of detail as PLY')
+    load_parser.add_argument('octree_dir', help='Octree directory (<name>_octree)')
+    load_parser.add_argument('output_file', help='PLY file to write')
+    load_parser.add_argument('--level', help='Level of detail (0 is the coarse root)', type=int, default=0)
+    load_parser.add_argument('--bounds', help='View box: xmin ymin zmin xmax ymax zmax', type=float, nargs=6, default=None)
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        os.makedirs(args.output_dir, exist_ok=True)
+        for label_file in sorted(f for f in os.listdir(args.labels_dir) if f.endswith('.labels')):
+            base_name = label_file.replace('.labels', '')
+            cloud_path = find_cloud(args.txt_dir, base_name)
+            if cloud_path is None:
+                print(f"Cloud file for {base_name} not found in {args.txt_dir}, skipping...")
+                continue
+
+            out_dir = os.path.join(args.output_dir, f"{base_name}_octree")
+            index = export_octree(cloud_path, os.path.join(args.labels_dir, label_file), out_dir,
+                                  args.node_points, args.workers, args.memory_budget)
+            print(f"Saved octree: {out_dir} ({index['num_points']:,} points, "
+                  f"{len(index['nodes'])} nodes, {index['max_level'] + 1} levels)")
+    else:
+        bounds = None if args.bounds is None else (args.bounds[:3], args.bounds[3:])
+        num_points = write_lod_ply(args.octree_dir, args.level, args.output_file, bounds)
+        print(f"Saved level {args.level}: {args.output_file} ({num_points:,} points)")
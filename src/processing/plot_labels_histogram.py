@@ -1,7 +1,17 @@
 import os
+import csv
+import json
 import matplotlib.pyplot as plt
-from collections import defaultdict, Counter
+from collections import defaultdict
 import numpy as np
+from src.processing.cloud_io import (BINARY_EXT, has_labels, is_binary_cloud,
+                                     load_labels)
+from src.processing.text_stream import iter_labels
+from src.processing.scheduler import run_budgeted
+
+# Labels counted per chunk; a .labels line is one digit and a newline
+CHUNK_ROWS = 2**22
+LABEL_BYTES_PER_ROW = 2
 
 # Label to names mapping
 label_to_names = {
@@ -21,10 +31,11 @@ label_order = sorted(label_to_names.keys())
 label_names = [label_to_names[label] for label in label_order]
 
 def get_station_name(filename):
-    """Extract station name from filename (removing part numbers)"""
-    parts = filename.split('_part_')
-    if len(parts) > 1:
-        return parts[0]
+    """Extract station name from filename (removing part and tile numbers)"""
+    for separator in ('_part_', '_tile_'):
+        parts = filename.split(separator)
+        if len(parts) > 1:
+            return parts[0]
     return filename.split('.')[0]
 
 def plot_histogram(counts, title, output_path, total_points=None):
@@ -56,59 +67,103 @@ def plot_histogram(counts, title, output_path, total_points=None):
     plt.close()
     print(f"Saved histogram to {output_path}")
 
-def process_directory(input_dir, output_dir=None):
+def count_labels(file_path, chunk_rows=CHUNK_ROWS):
+    """Count the occurrences of every label in a .labels file or binary container.
+
+    Labels are reduced chunk by chunk, so memory does not depend on the file size.
+
+    Returns:
+        An int64 array with one count per label in `label_order`.
+    """
+    if is_binary_cloud(file_path):
+        labels = load_labels(file_path)
+        chunks = (labels[start:start + chunk_rows]
+                  for start in range(0, len(labels), chunk_rows))
+    else:
+        chunks = iter_labels(file_path, chunk_rows, LABEL_BYTES_PER_ROW * chunk_rows)
+
+    counts = np.zeros(len(label_order), dtype=np.int64)
+    for chunk in chunks:
+        if chunk.min() < 0 or chunk.max() >= len(label_order):
+            raise ValueError(f"{file_path} contains labels outside of 0..{len(label_order) - 1}")
+        counts += np.bincount(chunk, minlength=len(label_order))
+    return counts
+
+def save_counts(station_counts, total_counts, output_dir):
+    """Write the label counts per station and for the dataset to JSON and CSV"""
+    json_path = os.path.join(output_dir, "label_counts.json")
+    with open(json_path, 'w') as f:
+        json.dump({
+            'labels': label_names,
+            'stations': {name: counts.tolist() for name, counts in station_counts.items()},
+            'total': total_counts.tolist()
+        }, f, indent=2)
+
+    csv_path = os.path.join(output_dir, "label_counts.csv")
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['station', 'total'] + label_names)
+        for name, counts in list(station_counts.items()) + [('all', total_counts)]:
+            writer.writerow([name, int(counts.sum())] + counts.tolist())
+    print(f"Saved label counts to {json_path} and {csv_path}")
+
+def process_directory(input_dir, output_dir=None, workers=1):
     """Process all .labels files in a directory"""
     if output_dir is None:
         output_dir = os.path.join(input_dir, "label_histograms")
     os.makedirs(output_dir, exist_ok=True)
 
-    # Collect all labels by station and for the entire dataset
-    station_labels = defaultdict(list)
-    all_labels = []
+    # Count labels of every file, largest files first
+    jobs = []
+    filenames = set(os.listdir(input_dir))
+    for filename in sorted(filenames):
+        file_path = os.path.join(input_dir, filename)
+
+        # Binary containers only count when there is no text .labels sibling
+        is_container = (filename.endswith(BINARY_EXT) and
+                        filename.replace(BINARY_EXT, '.labels') not in filenames and
+                        has_labels(file_path))
+        if not (filename.endswith('.labels') or is_container):
+            continue
+
+        jobs.append((filename, os.path.getsize(file_path) / 1e6, count_labels, (file_path,)))
 
-    for filename in os.listdir(input_dir):
-        if filename.endswith('.labels'):
-            file_path = os.path.join(input_dir, filename)
-            station_name = get_station_name(filename)
+    file_counts = run_budgeted(jobs, workers, desc='count labels')
 
-            # Read labels from file
-            with open(file_path, 'r') as f:
-                labels = [int(line.strip()) for line in f.readlines() if line.strip()]
+    # Sum the counts by station and for the entire dataset
+    station_counts = defaultdict(lambda: np.zeros(len(label_order), dtype=np.int64))
+    for filename in sorted(file_counts):
+        station_counts[get_station_name(filename)] += file_counts[filename]
+    station_counts = dict(station_counts)
+    total_counts = sum(station_counts.values(), np.zeros(len(label_order), dtype=np.int64))
 
-            station_labels[station_name].extend(labels)
-            all_labels.extend(labels)
+    save_counts(station_counts, total_counts, output_dir)
 
     # 1. Plot histograms for each station
-    for station_name, labels in station_labels.items():
-        if not labels:
+    for station_name, counts in station_counts.items():
+        if not counts.sum():
             print(f"No labels found for {station_name}")
             continue
 
-        # Count label occurrences
-        label_counts = Counter(labels)
-        counts = [label_counts.get(label, 0) for label in label_order]
-
         output_path = os.path.join(output_dir, f"{station_name}_histogram.png")
-        plot_histogram(counts, f'Label Distribution: {station_name}',
-                      output_path, len(labels))
+        plot_histogram(counts.tolist(), f'Label Distribution: {station_name}',
+                      output_path, int(counts.sum()))
 
     # 2. Plot combined histogram for entire dataset
-    if all_labels:
-        total_counts = Counter(all_labels)
-        combined_counts = [total_counts.get(label, 0) for label in label_order]
-
+    if total_counts.sum():
         output_path = os.path.join(output_dir, "00_combined_dataset_histogram.png")
-        plot_histogram(combined_counts, 'Label Distribution: Entire Dataset',
-                      output_path, len(all_labels))
+        plot_histogram(total_counts.tolist(), 'Label Distribution: Entire Dataset',
+                      output_path, int(total_counts.sum()))
 
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description='Plot label histograms for .labels files')
-    parser.add_argument('input_dir', help='Directory containing .labels files')
+    parser.add_argument('input_dir', help='Directory containing .labels files or binary containers')
     parser.add_argument('--output_dir', help='Directory to save histograms (default: input_dir/label_histograms)')
+    parser.add_argument('--workers', help='Number of files counted in parallel', type=int, default=1)
 
     args = parser.parse_args()
 
-    process_directory(args.input_dir, args.output_dir)
+    process_directory(args.input_dir, args.output_dir, args.workers)
     print("Finished processing all files")
\ No newline at end of file
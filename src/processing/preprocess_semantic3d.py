@@ -1,12 +1,25 @@
 import logging
+import json
 import numpy as np
 import pandas as pd
 import os, glob
 import argparse
 from pathlib import Path
 from os.path import join, exists
-from tqdm import tqdm
+import open3d.ml as _ml3d
 from open3d.ml.datasets import utils
+from src.processing.cloud_io import save_processed, BINARY_EXT, TILE_INDEX_VERSION
+from src.processing.text_stream import (iter_cloud_parts, rows_for_budget,
+                                        BYTES_PER_POINT, TEXT_BYTES_PER_POINT)
+from src.processing.scheduler import run_budgeted, available_memory
+from src.processing.manifest import (Manifest, input_record, input_matches,
+                                     output_record)
+from src.processing.tiling import (process_tiled_file, DEFAULT_TILE_SIZE,
+                                   DEFAULT_TILE_OVERLAP)
+from src.processing.voxel_subsample import voxel_subsample_file
+
+# Memory budget in megabytes for one part of a large file
+DEFAULT_MEMORY_BUDGET = 4000
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -20,6 +33,70 @@ def parse_args():
         help='Maximum size of processed pointcloud in Megabytes.',
         default=2000,
         type=int)
+    parser.add_argument(
+        '--memory_budget',
+        help='Memory budget in Megabytes for streaming one part of a large '
+        'pointcloud.',
+        default=DEFAULT_MEMORY_BUDGET,
+        type=int)
+    parser.add_argument(
+        '--workers',
+        help='Number of files processed in parallel.',
+        default=1,
+        type=int)
+    parser.add_argument(
+        '--max_memory',
+        help='Total memory budget in Megabytes shared by all workers '
+        '(default: 80%% of the physical memory).',
+        default=int(0.8 * available_memory()),
+        type=int)
+    parser.add_argument(
+        '--force',
+        help='Reprocess every file, even if the manifest says it is up to date.',
+        action='store_true')
+    parser.add_argument(
+        '--hash_inputs',
+        help='Record input content hashes, so touched but unchanged inputs '
+        'are not reprocessed.',
+        action='store_true')
+    parser.add_argument(
+        '--verify_outputs',
+        help='Re-checksum outputs instead of only comparing their sizes.',
+        action='store_true')
+    parser.add_argument(
+        '--split_mode',
+        help='How large pointclouds are processed: subsampled as a whole '
+        'out of core (voxel), or split into consecutive rows or overlapping '
+        'XY tiles.',
+        choices=['voxel', 'rows', 'tiles'],
+        default='voxel')
+    parser.add_argument(
+        '--voxel_workers',
+        help='Number of voxel partitions of a large pointcloud reduced in '
+        'parallel (split_mode voxel).',
+        default=1,
+        type=int)
+    parser.add_argument(
+        '--tile_size',
+        help='Edge length of a tile in meters (split_mode tiles).',
+        default=DEFAULT_TILE_SIZE,
+        type=float)
+    parser.add_argument(
+        '--tile_overlap',
+        help='Overlap margin around each tile in meters (split_mode tiles).',
+        default=DEFAULT_TILE_OVERLAP,
+        type=float)
+    parser.add_argument(
+        '--pyramid_config',
+        help='Model config to build the point pyramids of the processed '
+        'clouds for (see src/pyramid.py), none are built if not given.',
+        default=None)
+    parser.add_argument(
+        '--format',
+        help='Output format of the processed clouds: text (.txt/.labels) or '
+        'binary memory-mappable containers ({}).'.format(BINARY_EXT),
+        choices=['txt', 'binary'],
+        default='txt')
 
     args = parser.parse_args()
 
@@ -31,14 +108,21 @@ def parse_args():
 
     return args
 
-def process_small_file(input_path, output_path, sub_grid_size):
-    """Process a small file that fits in memory."""
+def process_small_file(input_path, output_path, sub_grid_size, out_format='txt',
+                       labels_path=None):
+    """Process a small file that fits in memory.
+
+    `input_path` and `labels_path` may also be binary file objects such as
+    pipes; `labels_path` defaults to the `.labels` sibling of `input_path`.
+    """
+    if labels_path is None:
+        labels_path = input_path.replace(".txt", ".labels")
     pc = pd.read_csv(input_path,
                      header=None,
                      delim_whitespace=True,
                      dtype=np.float32).values
 
-    labels = pd.read_csv(input_path.replace(".txt", ".labels"),
+    labels = pd.read_csv(labels_path,
                          header=None,
                          delim_whitespace=True,
                          dtype=np.int32).values
@@ -51,41 +135,51 @@ def process_small_file(input_path, output_path, sub_grid_size):
         grid_size=sub_grid_size)
     pc = np.concatenate([points, feat], 1)
 
-    np.savetxt(output_path, pc, fmt='%.3f %.3f %.3f %i %i %i %i')
-    np.savetxt(output_path.replace('.txt', '.labels'), labels, fmt='%i')
-
-import itertools
+    return save_processed(output_path, pc, labels, out_format)
 
-def process_large_file(input_path, output_prefix, parts, sub_grid_size):
-    """Process a large file by splitting it into parts and processing each part separately."""
-    # First determine the split points by scanning through the file once
-    with open(input_path, 'r') as f:
-        total_rows = sum(1 for _ in f)
+def process_large_file(input_path, output_prefix, sub_grid_size, out_format='txt',
+                       memory_budget=DEFAULT_MEMORY_BUDGET):
+    """Process a large file in one streaming pass over the cloud and its labels.
 
-    rows_per_part = total_rows // parts
-    split_points = [i * rows_per_part for i in range(parts + 1)]
-    split_points[-1] = total_rows  # Ensure last part includes all remaining rows
+    Points are parsed block by block into preallocated buffers; every time a
+    part of `rows_for_budget(memory_budget)` points is full it is subsampled
+    and saved as `<output_prefix>_part_<N>`. Finished parts are journaled in
+    `<output_prefix>.progress.json` with the byte offsets of the cloud and
+    labels after them, so an interrupted run seeks past the complete parts
+    instead of parsing them again.
 
-    # Process each part
-    for part_num in range(parts):
-        start_row = split_points[part_num]
-        end_row = split_points[part_num + 1]
+    Returns:
+        The list of written files.
+    """
+    rows_per_part = rows_for_budget(memory_budget)
+    labels_path = input_path.replace(".txt", ".labels")
 
-        # Read the chunk for this part using islice
-        with open(input_path, 'r') as pc_file:
-            pc_chunk = [list(map(float, line.strip().split()))
-                        for line in itertools.islice(pc_file, start_row, end_row)]
-
-        # Read corresponding labels using islice
-        labels_path = input_path.replace(".txt", ".labels")
-        with open(labels_path, 'r') as labels_file:
-            labels_chunk = [int(line.strip())
-                          for line in itertools.islice(labels_file, start_row, end_row)]
-
-        # Convert to numpy arrays
-        pc_chunk = np.array(pc_chunk, dtype=np.float32)
-        labels_chunk = np.array(labels_chunk, dtype=np.int32)
+    journal_path = f"{output_prefix}.progress.json"
+    journal = {
+        'inputs': [input_record(input_path), input_record(labels_path)],
+        'params': [sub_grid_size, out_format, rows_per_part],
+        'parts': [],
+        'offsets': []
+    }
+    if exists(journal_path):
+        with open(journal_path, 'r') as f:
+            previous = json.load(f)
+        if (previous['params'] == journal['params'] and 'offsets' in previous and
+                all(input_matches(record) for record in previous['inputs'])):
+            # Parts finished by an interrupted run, up to the first one missing
+            for part_outputs, offsets in zip(previous['parts'], previous['offsets']):
+                if not all(exists(p) for p in part_outputs):
+                    break
+                journal['parts'].append(part_outputs)
+                journal['offsets'].append(offsets)
 
+    outputs = [p for part_outputs in journal['parts'] for p in part_outputs]
+    start = tuple(journal['offsets'][-1]) if journal['offsets'] else None
+    if start is not None:
+        print(f"Resuming {Path(input_path).name} after {len(journal['parts'])} parts")
+    parts = iter_cloud_parts(input_path, labels_path, rows_per_part, start=start,
+                             with_offsets=True)
+    for part_num, (pc_chunk, labels_chunk, offsets) in enumerate(parts, len(journal['parts'])):
         # Process this chunk
         points, feat, labels = utils.DataProcessing.grid_subsampling(
             pc_chunk[:, :3],
@@ -96,14 +190,87 @@ def process_large_file(input_path, output_prefix, parts, sub_grid_size):
 
         # Save this part
         output_path = f"{output_prefix}_part_{part_num}.txt"
-        np.savetxt(output_path, processed_pc, fmt='%.3f %.3f %.3f %i %i %i %i')
-        np.savetxt(output_path.replace('.txt', '.labels'), labels, fmt='%i')
+        part_outputs = save_processed(output_path, processed_pc, labels, out_format)
+        outputs += part_outputs
+
+        journal['parts'].append(part_outputs)
+        journal['offsets'].append(list(offsets))
+        tmp_path = journal_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(journal, f)
+        os.replace(tmp_path, journal_path)
+
+    if exists(journal_path):
+        os.remove(journal_path)
+    return outputs
+
+def process_file(file_path, out_path, sub_grid_size, args):
+    """Process one raw cloud, splitting it if it exceeds the size limit.
+
+    Returns:
+        Manifest records of the written files.
+    """
+    file_size = Path(file_path).stat().st_size / 1e6  # Size in MB
+
+    if file_size <= args.size_limit:
+        # Small file - process normally
+        output_path = join(out_path, Path(file_path).name)
+        outputs = process_small_file(file_path, output_path, sub_grid_size, args.format)
+    elif args.split_mode == 'voxel':
+        # Large file - subsample the whole station out of core
+        print(f"Subsampling {Path(file_path).name} out of core")
+
+        output_path = join(out_path, Path(file_path).name)
+        outputs = voxel_subsample_file(file_path, output_path, sub_grid_size, args.format,
+                                       args.memory_budget, args.voxel_workers)
+    elif args.split_mode == 'tiles':
+        # Large file - bucket it into overlapping XY tiles
+        print(f"Tiling {Path(file_path).name} into {args.tile_size}m tiles")
+
+        output_prefix = join(out_path, Path(file_path).name.replace('.txt', ''))
+        outputs = process_tiled_file(file_path, output_prefix, sub_grid_size,
+                                     args.tile_size, args.tile_overlap, args.format,
+                                     args.memory_budget)
+    else:
+        # Large file - stream it in parts that fit the memory budget
+        print(f"Splitting {Path(file_path).name} into parts of up to "
+              f"{rows_for_budget(args.memory_budget)} points")
+
+        output_prefix = join(out_path, Path(file_path).name.replace('.txt', ''))
+        outputs = process_large_file(file_path, output_prefix, sub_grid_size, args.format,
+                                     args.memory_budget)
+
+    return [output_record(p, out_path) for p in outputs]
+
+def file_params(file_path, sub_grid_size, args):
+    """Parameters that determine the outputs of one raw cloud."""
+    file_size = Path(file_path).stat().st_size / 1e6  # Size in MB
+
+    params = {'sub_grid_size': sub_grid_size, 'format': args.format, 'split': 'none'}
+    if file_size > args.size_limit:
+        params['split'] = args.split_mode
+        if args.split_mode == 'tiles':
+            params['tile_size'] = args.tile_size
+            params['tile_overlap'] = args.tile_overlap
+            params['tile_index_version'] = TILE_INDEX_VERSION
+        elif args.split_mode == 'rows':
+            params['rows_per_part'] = rows_for_budget(args.memory_budget)
+    return params
+
+def estimate_peak_memory(file_path, args):
+    """Rough peak memory in megabytes needed to process one raw cloud."""
+    file_size = Path(file_path).stat().st_size / 1e6  # Size in MB
+    num_points = file_size * 1e6 / TEXT_BYTES_PER_POINT
+
+    if file_size <= args.size_limit:
+        # pandas keeps its parse buffers alive next to the float32 array
+        return 2 * num_points * BYTES_PER_POINT / 1e6
+    return min(num_points * BYTES_PER_POINT / 1e6, args.memory_budget)
 
 def preprocess(args):
     """Main preprocessing function."""
     dataset_path = args.dataset_path
     out_path = args.out_path
-    size_limit = args.size_limit  # Size in megabytes
     sub_grid_size = 0.01
 
     if out_path is None:
@@ -117,24 +284,42 @@ def preprocess(args):
     ]
 
     # Sort files by size (largest first)
-    train_files.sort(key=lambda x: Path(x).stat().st_size, reverse=False)
+    train_files.sort(key=lambda x: Path(x).stat().st_size, reverse=True)
 
     os.makedirs(out_path, exist_ok=True)
 
-    for file_path in tqdm(train_files):
-        file_size = Path(file_path).stat().st_size / 1e6  # Size in MB
+    manifest = Manifest(out_path)
+    jobs = []
+    pending = {}
+    for file_path in train_files:
+        key = Path(file_path).name
+        params = file_params(file_path, sub_grid_size, args)
+        if not args.force and manifest.is_up_to_date(
+                key, params, args.hash_inputs, args.verify_outputs):
+            continue
+
+        labels_path = file_path.replace('.txt', '.labels')
+        inputs = [input_record(file_path, args.hash_inputs),
+                  input_record(labels_path, args.hash_inputs)]
+        pending[key] = (inputs, params)
+        jobs.append((key, estimate_peak_memory(file_path, args), process_file,
+                     (file_path, out_path, sub_grid_size, args)))
+
+    print(f"{len(train_files) - len(jobs)} of {len(train_files)} files are up to date")
+
+    def record(key, outputs):
+        inputs, params = pending[key]
+        manifest.record(key, inputs, params, outputs)
 
-        if file_size <= size_limit:
-            # Small file - process normally
-            output_path = join(out_path, Path(file_path).name)
-            process_small_file(file_path, output_path, sub_grid_size)
-        else:
-            # Large file - split into parts
-            parts = int(file_size / size_limit) + 1
-            print(f"Splitting {Path(file_path).name} into {parts} parts")
+    run_budgeted(jobs, args.workers, args.max_memory, desc='preprocess',
+                 on_done=record)
 
-            output_prefix = join(out_path, Path(file_path).name.replace('.txt', ''))
-            process_large_file(file_path, output_prefix, parts, sub_grid_size)
+    if args.pyramid_config is not None:
+        # Imported here, it loads torch
+        from src.pyramid import build_pyramids
+        cfg = _ml3d.utils.Config.load_from_file(args.pyramid_config)
+        built = build_pyramids(str(out_path), cfg.model, args.workers, args.max_memory)
+        print(f"Built {built} pyramids for {args.pyramid_config}")
 
 if __name__ == '__main__':
     logging.basicConfig(
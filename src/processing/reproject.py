@@ -0,0 +1,205 @@
+"""Back-projection of predictions to full-resolution raw scans.
+
+Predictions are made on the grid-subsampled clouds written by
+`preprocess_semantic3d.py`, possibly split into `_part_N` or `_tile_i_j`
+files. This stage builds one KD-tree over the subsampled points of a station
+(all of its parts; of tiles only the points each tile owns), streams the raw
+`<station>.txt` in chunks and labels every raw point by its nearest
+neighbour or by an inverse-distance weighted vote of its k nearest
+neighbours. The result is a `<station>.labels` file with one label per raw
+point, as required for submission.
+
+KD-tree queries run on all cores while the next chunk is parsed, and memory
+is bounded by the subsampled station plus a few chunks of the raw scan.
+"""
+import os
+import glob
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from sklearn.neighbors import KDTree
+from tqdm import tqdm
+from src.processing.cloud_io import (cloud_name, find_cloud, iter_xyz, load_xyz,
+                                     read_text_labels, station_name)
+from src.processing.tiling import load_tile_index, owned_mask
+
+# Label 0 (unlabeled) plus the 8 Semantic3D classes
+NUM_LABELS = 9
+
+# Raw points labeled per chunk
+CHUNK_ROWS = 2**20
+
+
+def station_predictions(pred_dir):
+    """Prediction files of every station in `pred_dir`, keyed by station name."""
+    stations = {}
+    for labels_path in sorted(glob.glob(os.path.join(pred_dir, '*.labels'))):
+        stations.setdefault(station_name(labels_path), []).append(labels_path)
+    return stations
+
+
+def load_station_predictions(station, labels_paths, processed_dir):
+    """Subsampled points and predicted labels of all parts of a station.
+
+    Of tiled stations only the points each tile owns are kept, so no
+    subsampled point appears twice.
+
+    Returns:
+        (xyz, labels) with float32 xyz of shape (n, 3) and uint8 labels.
+    """
+    tile_index_path = os.path.join(processed_dir, station + '_tiles.json')
+    tiles = {}
+    tile_size = None
+    if os.path.exists(tile_index_path):
+        tile_index = load_tile_index(tile_index_path)
+        tiles = {entry['name']: entry['tile'] for entry in tile_index['tiles']}
+        tile_size = tile_index['tile_size']
+
+    all_xyz, all_labels = [], []
+    for labels_path in labels_paths:
+        name = cloud_name(labels_path)
+        cloud_path = find_cloud(processed_dir, name)
+        if cloud_path is None:
+            raise FileNotFoundError(f"Subsampled cloud {name} not found in {processed_dir}")
+
+        xyz = np.asarray(load_xyz(cloud_path), dtype=np.float32)
+        labels = read_text_labels(labels_path)
+        if len(xyz) != len(labels):
+            raise ValueError(f"Mismatch: {name} (points: {len(xyz)}, labels: {len(labels)})")
+        if labels.size and (labels.min() < 0 or labels.max() >= NUM_LABELS):
+            raise ValueError(f"Labels of {labels_path} must be in [0, {NUM_LABELS})")
+
+        if name in tiles:
+            mask = owned_mask(xyz, tiles[name], tile_size)
+            xyz, labels = xyz[mask], labels[mask]
+        all_xyz.append(xyz)
+        all_labels.append(labels.astype(np.uint8))
+
+    return np.concatenate(all_xyz), np.concatenate(all_labels)
+
+
+def query(tree, xyz, k=1, workers=-1):
+    """Distances and indices of the k nearest neighbours of query points.
+
+    The queries are split over `workers` threads (-1: all cores); the
+    KD-tree releases the GIL while searching.
+    """
+    if workers < 0:
+        workers = os.cpu_count() or 1
+    chunks = np.array_split(xyz, max(1, min(workers, len(xyz))))
+    if len(chunks) == 1:
+        return tree.query(xyz, k=k)
+    with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+        results = list(executor.map(lambda chunk: tree.query(chunk, k=k), chunks))
+    return (np.concatenate([dist for dist, _ in results]),
+            np.concatenate([idx for _, idx in results]))
+
+
+def vote(tree, labels, xyz, k=1, workers=-1):
+    """Labels of query points from their k nearest subsampled neighbours.
+
+    With k > 1 every neighbour votes with the inverse of its distance.
+    """
+    dist, idx = query(tree, xyz, k, workers)
+    if k == 1:
+        return labels[idx[:, 0]]
+
+    weights = 1.0 / np.maximum(dist, 1e-6)
+    rows = np.arange(len(xyz))[:, None] * NUM_LABELS
+    scores = np.bincount((rows + labels[idx]).ravel(), weights=weights.ravel(),
+                         minlength=len(xyz) * NUM_LABELS)
+    return scores.reshape(len(xyz), NUM_LABELS).argmax(axis=1).astype(np.uint8)
+
+
+def labels_to_text(labels):
+    """Encode single-digit labels as .labels text (one label per line)."""
+    text = np.empty(2 * len(labels), dtype=np.uint8)
+    text[0::2] = labels + ord('0')
+    text[1::2] = ord('\n')
+    return text.tobytes()
+
+
+def reproject_station(raw_path, tree, labels, out_path, k=1, workers=-1,
+                      chunk_rows=CHUNK_ROWS):
+    """Label every point of a raw scan and write `out_path`.
+
+    The raw scan is parsed chunk by chunk; each chunk is queried and written
+    in a background thread while the next one is parsed. The output is
+    written under a temporary name and moved into place once complete.
+
+    Returns:
+        The number of labeled raw points.
+    """
+    num_points = 0
+    tmp_path = out_path + '.tmp'
+
+    def label_chunk(xyz, f):
+        f.write(labels_to_text(vote(tree, labels, xyz, k, workers)))
+
+    try:
+        with open(tmp_path, 'wb') as f, ThreadPoolExecutor(max_workers=1) as executor:
+            pending = None
+            progress = tqdm(desc=os.path.basename(raw_path), unit=' points', unit_scale=True)
+            for xyz in iter_xyz(raw_path, chunk_rows):
+                # Chunks of text clouds are views into a reused buffer
+                xyz = np.array(xyz)
+                if pending is not None:
+                    pending.result()
+                pending = executor.submit(label_chunk, xyz, f)
+                num_points += len(xyz)
+                progress.update(len(xyz))
+            if pending is not None:
+                pending.result()
+            progress.close()
+        os.replace(tmp_path, out_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return num_points
+
+
+def reproject_predictions(raw_dir, processed_dir, pred_dir, out_dir, k=1,
+                          workers=-1, chunk_rows=CHUNK_ROWS):
+    """Back-project the predictions of every station in `pred_dir`.
+
+    Returns:
+        The list of written .labels files.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    outputs = []
+    for station, labels_paths in station_predictions(pred_dir).items():
+        raw_path = os.path.join(raw_dir, station + '.txt')
+        if not os.path.exists(raw_path):
+            print(f"Raw scan {raw_path} not found, skipping {station}...")
+            continue
+
+        xyz, labels = load_station_predictions(station, labels_paths, processed_dir)
+        if not len(xyz):
+            print(f"No predicted points for {station}, skipping...")
+            continue
+        tree = KDTree(xyz)
+        del xyz
+
+        out_path = os.path.join(out_dir, station + '.labels')
+        num_points = reproject_station(raw_path, tree, labels, out_path, k, workers, chunk_rows)
+        print(f"Saved {out_path}: {num_points:,} raw points from {len(labels):,} "
+              f"subsampled points in {len(labels_paths)} file(s)")
+        outputs.append(out_path)
+    return outputs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Back-project predictions on subsampled clouds to the full-resolution raw scans')
+    parser.add_argument('--raw_dir', help='Directory containing the raw <station>.txt scans', default='Semantic3D')
+    parser.add_argument('--processed_dir', help='Directory containing the subsampled clouds', default='Semantic3D/processed')
+    parser.add_argument('--pred_dir', help='Directory containing .labels predictions of the subsampled clouds', default='test/Semantic3D')
+    parser.add_argument('--out_dir', help='Directory to save full-resolution .labels files', default='test/Semantic3D/full_resolution')
+    parser.add_argument('--k', help='Number of nearest neighbours voting for each raw point', type=int, default=1)
+    parser.add_argument('--workers', help='Number of threads used by KD-tree queries (-1: all cores)', type=int, default=-1)
+
+    args = parser.parse_args()
+
+    reproject_predictions(args.raw_dir, args.processed_dir, args.pred_dir, args.out_dir,
+                          args.k, args.workers)
+    print("Finished back-projecting all stations")
@@ -0,0 +1,78 @@
+"""Memory-budgeted process pool for per-file processing jobs."""
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from tqdm import tqdm
+
+log = logging.getLogger(__name__)
+
+
+def available_memory():
+    """Physical memory of the machine in megabytes."""
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1e6
+
+
+def run_budgeted(jobs, workers=1, max_memory=None, desc=None, on_done=None):
+    """Run jobs in parallel while their estimated memory stays within a budget.
+
+    Jobs are started largest first. Whenever a worker frees up, the largest
+    pending job that still fits into the remaining budget is started, so big
+    and small jobs run side by side. A job larger than the whole budget runs
+    alone. Every job writes its own outputs, so results do not depend on the
+    number of workers or on the order in which jobs finish.
+
+    Args:
+        jobs: List of (key, estimated_memory_mb, fn, args) tuples; `fn` must be
+            a picklable module-level function.
+        workers: Number of worker processes; 1 runs everything in-process.
+        max_memory: Memory budget in megabytes, unlimited if None.
+        desc: Progress bar description.
+        on_done: Optional callback `on_done(key, result)`, called in this
+            process as soon as a job finishes.
+
+    Returns:
+        A dict mapping each job key to the return value of its function.
+    """
+    pending = sorted(jobs, key=lambda job: job[1], reverse=True)
+    results = {}
+    progress = tqdm(total=len(pending), desc=desc)
+
+    if workers <= 1:
+        for key, _, fn, args in pending:
+            results[key] = fn(*args)
+            if on_done is not None:
+                on_done(key, results[key])
+            progress.update(1)
+        progress.close()
+        return results
+
+    budget = float('inf') if max_memory is None else max_memory
+    running = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            used = sum(estimate for _, estimate in running.values())
+            while pending and len(running) < workers:
+                fitting = [job for job in pending if used + job[1] <= budget]
+                if fitting:
+                    job = fitting[0]
+                elif not running:
+                    job = pending[0]
+                    log.warning(f"{job[0]} needs ~{job[1]:.0f} MB, more than the "
+                                f"{budget:.0f} MB budget; running it alone")
+                else:
+                    break
+                pending.remove(job)
+                key, estimate, fn, args = job
+                running[executor.submit(fn, *args)] = (key, estimate)
+                used += estimate
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                key, _ = running.pop(future)
+                results[key] = future.result()
+                if on_done is not None:
+                    on_done(key, results[key])
+                progress.update(1)
+
+    progress.close()
+    return results
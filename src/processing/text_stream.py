@@ -0,0 +1,232 @@
+"""Single-pass streaming readers for Semantic3D text clouds and labels."""
+import io
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+# Bytes read from disk per parser call
+DEFAULT_BLOCK_SIZE = 64 * 2**20
+
+# Peak bytes held per point while a part is subsampled: the float32 (7,) row
+# and int32 label buffers plus the copies made by grid_subsampling.
+BYTES_PER_POINT = 96
+
+# Average size of one "x y z i r g b" line of a raw Semantic3D cloud
+TEXT_BYTES_PER_POINT = 40
+
+
+def rows_for_budget(memory_budget):
+    """Number of points per part that fits a memory budget given in megabytes."""
+    return max(1, int(memory_budget * 1e6) // BYTES_PER_POINT)
+
+
+class TextColumnReader(object):
+    """Parse a whitespace separated text file into fixed-width numeric rows.
+
+    The file is read sequentially in fixed-size byte blocks; each block is cut
+    at its last newline and parsed in one vectorized call. Rows parsed but not
+    yet consumed are kept until the next `read_into`.
+    """
+
+    def __init__(self, f, num_columns, dtype=np.float32,
+                 block_size=DEFAULT_BLOCK_SIZE, usecols=None, offset=0):
+        """Initialize the reader.
+
+        Args:
+            f: A binary file object (file, pipe, ...) positioned at the first row.
+            num_columns: Number of values per row that are kept.
+            dtype: dtype of the parsed values.
+            block_size: Number of bytes read per block.
+            usecols: Indices of the columns to keep, all columns if None.
+                The other columns are skipped by the parser.
+            offset: Byte offset of the first row in the file, the base of `tell`.
+        """
+        self._file = f
+        self._num_columns = num_columns
+        self._usecols = usecols
+        self._dtype = np.dtype(dtype)
+        self._block_size = block_size
+        self._tail = b''
+        self._rows = np.empty((0, num_columns), dtype=self._dtype)
+        self._eof = False
+        # Offset of the first byte not yet parsed, and the last parsed block
+        self._offset = offset
+        self._block = b''
+        self._block_start = offset
+        self._block_rows = 0
+
+    def _parse_block(self):
+        block = self._file.read(self._block_size)
+        if block:
+            block = self._tail + block
+            cut = block.rfind(b'\n') + 1
+            block, self._tail = block[:cut], block[cut:]
+        else:
+            self._eof = True
+            block, self._tail = self._tail, b''
+        self._block, self._block_start = block, self._offset
+        self._offset += len(block)
+        self._block_rows = 0
+
+        if not block.strip():
+            return np.empty((0, self._num_columns), dtype=self._dtype)
+
+        rows = pd.read_csv(io.BytesIO(block),
+                           header=None,
+                           sep=r'\s+',
+                           usecols=self._usecols,
+                           dtype=self._dtype).values
+        if rows.shape[1] != self._num_columns:
+            raise ValueError(f"Expected {self._num_columns} columns per row, "
+                             f"found {rows.shape[1]}")
+        self._block_rows = len(rows)
+        return rows
+
+    def tell(self):
+        """Byte offset of the next row `read_into` returns.
+
+        A new reader on the file seeked to this offset (and given it as
+        `offset`) continues with the same rows.
+        """
+        if not len(self._rows):
+            return self._offset
+        return self._block_start + _row_start(self._block, self._block_rows - len(self._rows),
+                                              self._block_rows)
+
+    def read_into(self, out):
+        """Fill `out` with the next rows.
+
+        Args:
+            out: Preallocated array of shape (n, num_columns), or (n,) for a
+                single column.
+
+        Returns:
+            The number of rows written, smaller than n only at end of file.
+        """
+        out = out.reshape(len(out), self._num_columns)
+        filled = 0
+        while filled < len(out):
+            if not len(self._rows):
+                if self._eof:
+                    break
+                self._rows = self._parse_block()
+                continue
+            n = min(len(out) - filled, len(self._rows))
+            out[filled:filled + n] = self._rows[:n]
+            self._rows = self._rows[n:]
+            filled += n
+        return filled
+
+
+def iter_cloud_parts(txt_file, labels_file, rows_per_part,
+                     block_size=DEFAULT_BLOCK_SIZE, start=None, with_offsets=False):
+    """Stream a cloud and its labels together in parts of `rows_per_part` points.
+
+    Both files are read once, sequentially. Each yielded part is a view into
+    buffers that are reused for the next part, so consumers must be done with
+    a part before requesting the next one.
+
+    Args:
+        txt_file: Path or binary file object of the (N, 7) text cloud.
+        labels_file: Path or binary file object of the .labels file, or None.
+        rows_per_part: Maximum number of points per part.
+        block_size: Number of bytes read per block.
+        start: (cloud offset, labels offset) to seek both files to before
+            reading, as yielded with `with_offsets`. Requires seekable files.
+        with_offsets: Also yield the offsets of both files after every part.
+
+    Yields:
+        (points, labels) with float32 points of shape (n, 7) and int32 labels
+        of shape (n,), or None labels when no labels file is given. With
+        `with_offsets`, (points, labels, (cloud offset, labels offset)).
+    """
+    pc_buffer = np.empty((rows_per_part, 7), dtype=np.float32)
+    labels_buffer = np.empty((rows_per_part,), dtype=np.int32)
+    pc_offset, labels_offset = start or (0, 0)
+
+    with _open_binary(txt_file) as pc_f, _open_binary(labels_file) as labels_f:
+        if start is not None:
+            pc_f.seek(pc_offset)
+            if labels_f is not None:
+                labels_f.seek(labels_offset)
+        pc_reader = TextColumnReader(pc_f, 7, np.float32, block_size, offset=pc_offset)
+        labels_reader = None
+        if labels_f is not None:
+            labels_reader = TextColumnReader(labels_f, 1, np.int32, block_size,
+                                             offset=labels_offset)
+
+        while True:
+            num_rows = pc_reader.read_into(pc_buffer)
+            labels = None
+            if labels_reader is not None:
+                num_labels = labels_reader.read_into(labels_buffer[:num_rows])
+                if num_labels != num_rows:
+                    raise ValueError(f"Mismatch: {txt_file} has more points than labels")
+                labels = labels_buffer[:num_rows]
+
+            if num_rows and with_offsets:
+                offsets = (pc_reader.tell(),
+                           labels_reader.tell() if labels_reader is not None else 0)
+                yield pc_buffer[:num_rows], labels, offsets
+            elif num_rows:
+                yield pc_buffer[:num_rows], labels
+            if num_rows < rows_per_part:
+                break
+
+        if labels_reader is not None and labels_reader.read_into(labels_buffer[:1]):
+            raise ValueError(f"Mismatch: {txt_file} has more labels than points")
+
+
+def iter_labels(labels_file, rows_per_chunk, block_size=DEFAULT_BLOCK_SIZE):
+    """Stream a .labels file in chunks of `rows_per_chunk` labels.
+
+    Every chunk but the last is full. Chunks are views into a buffer that is
+    reused for the next chunk.
+
+    Args:
+        labels_file: Path or binary file object of the .labels file.
+        rows_per_chunk: Number of labels per chunk.
+        block_size: Number of bytes read per block.
+
+    Yields:
+        int32 arrays of shape (n,).
+    """
+    buffer = np.empty((rows_per_chunk,), dtype=np.int32)
+    with _open_binary(labels_file) as f:
+        reader = TextColumnReader(f, 1, np.int32, block_size)
+        while True:
+            num_rows = reader.read_into(buffer)
+            if num_rows:
+                yield buffer[:num_rows]
+            if num_rows < rows_per_chunk:
+                break
+
+
+def _row_start(block, row, num_rows):
+    """Offset in `block` of the start of its `row`-th non-blank line."""
+    line_ends = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n'))
+    num_lines = len(line_ends) + (not block.endswith(b'\n'))
+    if num_lines == num_rows:
+        # No blank lines, the common case
+        return 0 if row == 0 else int(line_ends[row - 1]) + 1
+
+    start = 0
+    while start < len(block):
+        end = block.find(b'\n', start)
+        end = len(block) if end < 0 else end
+        if block[start:end].strip():
+            if row == 0:
+                return start
+            row -= 1
+        start = end + 1
+    return len(block)
+
+
+@contextmanager
+def _open_binary(source):
+    """Open a path in binary mode, passing file objects and None through."""
+    if source is None or hasattr(source, 'read'):
+        yield source
+    else:
+        with open(source, 'rb') as f:
+            yield f
@@ -0,0 +1,226 @@
+"""Spatial XY tiling of large Semantic3D scans.
+
+Points are bucketed into square XY tiles of `tile_size` meters on an absolute
+grid, with every tile extended by an `overlap` margin on each side. A tile
+*owns* the points whose xy falls into its core square; points in the margin
+are only context and belong to a neighbouring tile. Ownership is a pure
+function of the coordinates, so predictions of overlapping tiles can be merged
+back into one label per point.
+
+Every tile cloud stores the points it owns first and its margin after them,
+and the tile index records their number (`num_owned`). Statistics, training
+and validation losses and metrics count only these rows (see
+`cloud_io.owned_rows`), so no point of a station is counted twice.
+"""
+import os
+import json
+import shutil
+import argparse
+import numpy as np
+from pathlib import Path
+from open3d.ml.datasets import utils
+from src.processing.cloud_io import (TILE_INDEX_SUFFIX, TILE_INDEX_VERSION,
+                                     find_cloud, read_cloud, is_binary_cloud,
+                                     read_text_cloud, read_text_labels,
+                                     save_processed)
+from src.processing.text_stream import iter_cloud_parts, rows_for_budget
+
+DEFAULT_TILE_SIZE = 50.0
+DEFAULT_TILE_OVERLAP = 2.0
+
+# Record spilled to disk for every (point, tile) membership
+TILE_RECORD = np.dtype([('pc', '<f4', (7,)), ('label', '<i4')])
+
+
+def tile_coords(xy, tile_size):
+    """Integer (i, j) coordinates of the tile whose core contains each point."""
+    return np.floor(np.asarray(xy, dtype=np.float64) / tile_size).astype(np.int64)
+
+
+def tile_memberships(xy, tile_size, overlap):
+    """Assign points to every tile whose extended square contains them.
+
+    Args:
+        xy: (N, 2) point coordinates.
+        tile_size: Edge length of a tile core in meters.
+        overlap: Margin added around each core, smaller than tile_size.
+
+    Returns:
+        (point_idx, tiles) where point_idx are indices into xy and tiles the
+        (M, 2) tile coordinates of each membership.
+    """
+    ij = tile_coords(xy, tile_size)
+    local = np.asarray(xy, dtype=np.float64) - ij * tile_size
+
+    near = {
+        -1: local < overlap,
+        0: np.ones(local.shape, dtype=bool),
+        1: local >= tile_size - overlap
+    }
+    point_idx, tiles = [], []
+    for di in (-1, 0, 1):
+        for dj in (-1, 0, 1):
+            idx = np.flatnonzero(near[di][:, 0] & near[dj][:, 1])
+            point_idx.append(idx)
+            tiles.append(ij[idx] + [di, dj])
+    return np.concatenate(point_idx), np.concatenate(tiles)
+
+
+def owned_mask(xyz, tile, tile_size):
+    """Mask of the points owned by `tile`, i.e. inside its core square."""
+    return np.all(tile_coords(np.asarray(xyz)[:, :2], tile_size) == tile, axis=1)
+
+
+def tile_name(station, tile):
+    return f"{station}_tile_{tile[0]}_{tile[1]}"
+
+
+def process_tiled_file(input_path, output_prefix, sub_grid_size,
+                       tile_size=DEFAULT_TILE_SIZE,
+                       tile_overlap=DEFAULT_TILE_OVERLAP,
+                       out_format='txt',
+                       memory_budget=4000):
+    """Split a cloud into overlapping XY tiles and subsample each tile.
+
+    The cloud is streamed once; every chunk is bucketed into tiles and spilled
+    to per-tile files on disk. Each tile is then subsampled on its own and
+    saved as `<output_prefix>_tile_<i>_<j>`, the points it owns first. An
+    index describing every tile is written to `<output_prefix>_tiles.json`.
+
+    Returns:
+        The list of written files, the tile index last.
+    """
+    if not 0 <= tile_overlap < tile_size:
+        raise ValueError("tile_overlap must be smaller than tile_size")
+
+    station = Path(output_prefix).name
+    spill_dir = f"{output_prefix}_tiles.tmp"
+    shutil.rmtree(spill_dir, ignore_errors=True)
+    os.makedirs(spill_dir)
+
+    rows_per_part = rows_for_budget(memory_budget)
+    labels_path = input_path.replace(".txt", ".labels")
+    for pc_chunk, labels_chunk in iter_cloud_parts(input_path, labels_path, rows_per_part):
+        point_idx, tiles = tile_memberships(pc_chunk[:, :2], tile_size, tile_overlap)
+        order = np.lexsort((tiles[:, 1], tiles[:, 0]))
+        point_idx, tiles = point_idx[order], tiles[order]
+
+        records = np.empty(len(point_idx), dtype=TILE_RECORD)
+        records['pc'] = pc_chunk[point_idx]
+        records['label'] = labels_chunk[point_idx]
+
+        unique_tiles, starts = np.unique(tiles, axis=0, return_index=True)
+        ends = np.append(starts[1:], len(records))
+        for tile, start, end in zip(unique_tiles, starts, ends):
+            spill_path = os.path.join(spill_dir, f"{tile[0]}_{tile[1]}.bin")
+            with open(spill_path, 'ab') as f:
+                records[start:end].tofile(f)
+
+    entries = []
+    outputs = []
+    for spill_file in sorted(os.listdir(spill_dir)):
+        tile = [int(v) for v in spill_file[:-len('.bin')].split('_')]
+        spill_path = os.path.join(spill_dir, spill_file)
+        records = np.fromfile(spill_path, dtype=TILE_RECORD)
+
+        points, feat, labels = utils.DataProcessing.grid_subsampling(
+            records['pc'][:, :3],
+            features=records['pc'][:, 3:],
+            labels=records['label'],
+            grid_size=sub_grid_size)
+        # Owned points first, margin points after them
+        owned = owned_mask(points, tile, tile_size)
+        order = np.argsort(~owned, kind='stable')
+        processed_pc = np.concatenate([points, feat], 1)[order]
+        labels = labels[order]
+
+        name = tile_name(station, tile)
+        output_path = os.path.join(os.path.dirname(output_prefix), name + '.txt')
+        outputs += save_processed(output_path, processed_pc, labels, out_format)
+        os.remove(spill_path)
+
+        core = [tile[0] * tile_size, tile[1] * tile_size,
+                (tile[0] + 1) * tile_size, (tile[1] + 1) * tile_size]
+        entries.append({
+            'name': name,
+            'tile': tile,
+            'core_bounds': core,
+            'bounds': [core[0] - tile_overlap, core[1] - tile_overlap,
+                       core[2] + tile_overlap, core[3] + tile_overlap],
+            'num_points': int(len(points)),
+            'num_owned': int(owned.sum())
+        })
+    os.rmdir(spill_dir)
+
+    index_path = output_prefix + TILE_INDEX_SUFFIX
+    write_tile_index(index_path, {
+        'version': TILE_INDEX_VERSION,
+        'station': station,
+        'tile_size': tile_size,
+        'overlap': tile_overlap,
+        'sub_grid_size': sub_grid_size,
+        'tiles': entries
+    })
+    return outputs + [index_path]
+
+
+def write_tile_index(index_path, index):
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_path, index_path)
+
+
+def load_tile_index(index_path):
+    with open(index_path, 'r') as f:
+        return json.load(f)
+
+
+def merge_tile_predictions(index_path, cloud_dir, labels_dir, out_dir):
+    """Merge per-tile predictions back into one cloud per station.
+
+    Only the points each tile owns are kept, so every subsampled point of the
+    station appears exactly once. Writes `<station>.txt` with the owned points
+    and `<station>.labels` with their predicted labels.
+    """
+    index = load_tile_index(index_path)
+    os.makedirs(out_dir, exist_ok=True)
+
+    merged_pc, merged_labels = [], []
+    for entry in index['tiles']:
+        cloud_path = find_cloud(cloud_dir, entry['name'])
+        labels_path = os.path.join(labels_dir, entry['name'] + '.labels')
+        if cloud_path is None or not os.path.exists(labels_path):
+            raise FileNotFoundError(f"Missing cloud or predictions for tile {entry['name']}")
+
+        if is_binary_cloud(cloud_path):
+            cloud = read_cloud(cloud_path, ['xyz', 'intensity', 'rgb'])
+            pc = np.concatenate([cloud['xyz'], cloud['intensity'][:, None],
+                                 cloud['rgb']], 1).astype(np.float32)
+        else:
+            pc = read_text_cloud(cloud_path)
+        labels = read_text_labels(labels_path)
+        assert len(pc) == len(labels), f"Mismatch: {entry['name']} (points: {len(pc)}, labels: {len(labels)})"
+
+        mask = owned_mask(pc[:, :3], entry['tile'], index['tile_size'])
+        merged_pc.append(pc[mask])
+        merged_labels.append(labels[mask])
+
+    output_path = os.path.join(out_dir, index['station'] + '.txt')
+    np.savetxt(output_path, np.concatenate(merged_pc), fmt='%.3f %.3f %.3f %i %i %i %i')
+    np.savetxt(output_path.replace('.txt', '.labels'), np.concatenate(merged_labels), fmt='%i')
+    return output_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Merge per-tile Semantic3D predictions back into stations')
+    parser.add_argument('index', help='Tile index (<station>_tiles.json)')
+    parser.add_argument('--cloud_dir', help='Directory containing the tile clouds', default='Semantic3D/processed')
+    parser.add_argument('--labels_dir', help='Directory containing per-tile .labels predictions', default='test/Semantic3D')
+    parser.add_argument('--out_dir', help='Directory to save merged station clouds and labels', default='test/Semantic3D/merged')
+
+    args = parser.parse_args()
+
+    output_path = merge_tile_predictions(args.index, args.cloud_dir, args.labels_dir, args.out_dir)
+    print(f"Saved merged predictions: {output_path}")
@@ -0,0 +1,226 @@
+"""Out-of-core voxel grid subsampling of Semantic3D scans.
+
+`grid_subsampling` needs the whole cloud in memory, so large scans used to
+be split into parts that were subsampled independently, leaving duplicated
+points in the voxels cut by part boundaries. Here the cloud is streamed in
+chunks; every point is assigned the key of its voxel on the absolute grid
+`floor(xyz / grid_size)` and spilled to one of several partition files on
+disk, chosen by a hash of the voxel key. All points of a voxel therefore end
+up in the same partition, and each partition is reduced on its own (in
+parallel) to the centroid, the mean features and the majority label of each
+of its voxels. The result has exactly one point per occupied voxel of the
+whole station, like `grid_subsampling` on the full cloud, while memory stays
+within a budget: the number of partitions is chosen so that the partitions
+reduced at the same time fit into it.
+"""
+import os
+import math
+import shutil
+import argparse
+import numpy as np
+from src.processing.cloud_io import save_processed_chunks
+from src.processing.text_stream import (iter_cloud_parts, rows_for_budget,
+                                        TEXT_BYTES_PER_POINT)
+from src.processing.scheduler import run_budgeted
+
+# Bits per axis of a packed voxel key; voxel coordinates must lie within
+# +-2**(KEY_BITS - 1), i.e. +-10 km at a grid size of 1 cm
+KEY_BITS = 21
+KEY_OFFSET = 2**(KEY_BITS - 1)
+
+# Record spilled to disk for every point
+SPILL_RECORD = np.dtype([('key', '<i8'), ('pc', '<f4', (7,)), ('label', 'u1')])
+
+# Record of a subsampled point
+REDUCED_RECORD = np.dtype([('pc', '<f4', (7,)), ('label', '<i4')])
+
+# Peak bytes held per point while a partition is reduced: the spilled record,
+# sort order, sorted keys, float64 copies of the values and inverse indices
+REDUCE_BYTES_PER_POINT = 160
+
+# Multiplier of the Fibonacci hash that spreads voxel keys over partitions
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+# Subsampled points written to the output at once
+WRITE_CHUNK_ROWS = 2**20
+
+
+def voxel_keys(xyz, grid_size):
+    """Packed int64 key of the voxel of every point."""
+    voxels = np.floor(np.asarray(xyz, dtype=np.float64) / grid_size).astype(np.int64)
+    if len(voxels) and (voxels.min() < -KEY_OFFSET or voxels.max() >= KEY_OFFSET):
+        raise ValueError(f"Points span more than {2**KEY_BITS} voxels of {grid_size} m "
+                         f"along an axis, use a larger grid size")
+    voxels += KEY_OFFSET
+    return (voxels[:, 0] << (2 * KEY_BITS)) | (voxels[:, 1] << KEY_BITS) | voxels[:, 2]
+
+
+def partition_of(keys, num_partitions):
+    """Partition of every voxel key."""
+    hashed = keys.astype(np.uint64) * HASH_MULTIPLIER
+    return ((hashed >> np.uint64(32)) % np.uint64(num_partitions)).astype(np.int64)
+
+
+def num_partitions_for(num_points, memory_budget, workers=1):
+    """Number of partitions whose reduction by `workers` processes at once fits
+    a memory budget in megabytes."""
+    partition_budget = memory_budget * 1e6 / max(1, workers)
+    return max(1, math.ceil(num_points * REDUCE_BYTES_PER_POINT / partition_budget))
+
+
+def spill_path(spill_dir, partition):
+    return os.path.join(spill_dir, f"{partition}.bin")
+
+
+def spill_partitions(input_path, labels_path, spill_dir, grid_size, num_partitions,
+                     rows_per_chunk):
+    """Stream a cloud into per-partition spill files.
+
+    Returns:
+        The number of points spilled to every partition.
+    """
+    counts = np.zeros(num_partitions, dtype=np.int64)
+    for pc_chunk, labels_chunk in iter_cloud_parts(input_path, labels_path, rows_per_chunk):
+        keys = voxel_keys(pc_chunk[:, :3], grid_size)
+        partitions = partition_of(keys, num_partitions)
+        order = np.argsort(partitions, kind='stable')
+
+        records = np.empty(len(order), dtype=SPILL_RECORD)
+        records['key'] = keys[order]
+        records['pc'] = pc_chunk[order]
+        records['label'] = labels_chunk[order]
+
+        partition_counts = np.bincount(partitions, minlength=num_partitions)
+        counts += partition_counts
+        ends = np.cumsum(partition_counts)
+        for partition in np.flatnonzero(partition_counts):
+            start = ends[partition] - partition_counts[partition]
+            with open(spill_path(spill_dir, partition), 'ab') as f:
+                records[start:ends[partition]].tofile(f)
+    return counts
+
+
+def reduce_records(records):
+    """One point per voxel of spilled records.
+
+    Returns:
+        A REDUCED_RECORD array with the centroid, the mean features and the
+        majority label (the smallest one on ties) of every voxel.
+    """
+    order = np.argsort(records['key'], kind='stable')
+    keys = records['key'][order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    counts = np.diff(np.r_[starts, len(keys)])
+
+    # Sums in float64, so millions of points per voxel stay exact enough
+    values = records['pc'][order].astype(np.float64)
+    reduced = np.empty(len(starts), dtype=REDUCED_RECORD)
+    reduced['pc'] = np.add.reduceat(values, starts, axis=0) / counts[:, None]
+
+    labels = records['label'][order].astype(np.int64)
+    num_labels = int(labels.max()) + 1 if len(labels) else 1
+    voxel = np.repeat(np.arange(len(starts)), counts)
+    votes = np.bincount(voxel * num_labels + labels, minlength=len(starts) * num_labels)
+    reduced['label'] = votes.reshape(len(starts), num_labels).argmax(axis=1)
+    return reduced
+
+
+def reduce_partition(spill_file, reduced_file):
+    """Reduce one spill file into `reduced_file` and delete it.
+
+    Returns:
+        The number of subsampled points of the partition.
+    """
+    reduced = reduce_records(np.fromfile(spill_file, dtype=SPILL_RECORD))
+    tmp_path = reduced_file + '.tmp'
+    reduced.tofile(tmp_path)
+    os.replace(tmp_path, reduced_file)
+    os.remove(spill_file)
+    return len(reduced)
+
+
+def iter_reduced(reduced_files, chunk_rows=WRITE_CHUNK_ROWS):
+    """Stream the subsampled points of the reduced partitions as (pc, labels) chunks."""
+    for reduced_file in reduced_files:
+        with open(reduced_file, 'rb') as f:
+            while True:
+                chunk = np.fromfile(f, dtype=REDUCED_RECORD, count=chunk_rows)
+                if not len(chunk):
+                    break
+                yield chunk['pc'], chunk['label']
+
+
+def voxel_subsample_file(input_path, output_path, grid_size, out_format='txt',
+                         memory_budget=4000, workers=1, spill_dir=None,
+                         labels_path=None, num_points=None):
+    """Subsample a raw cloud of any size to one point per occupied voxel.
+
+    Args:
+        input_path: Raw `.txt` cloud with a `.labels` sibling.
+        output_path: `.txt` path of the subsampled cloud (a container next to
+            it with out_format 'binary').
+        grid_size: Voxel edge length in meters.
+        out_format: 'txt' or 'binary', see `save_processed`.
+        memory_budget: Memory in megabytes for streaming and for the
+            partitions reduced at the same time.
+        workers: Number of partitions reduced in parallel.
+        spill_dir: Directory of the temporary partition files (default:
+            next to the output), needs about 40 bytes per input point.
+        labels_path: Labels of the cloud, by default the `.labels` sibling
+            of `input_path`. Both may also be binary file objects (pipes),
+            which are read once.
+        num_points: Approximate number of input points, by default
+            estimated from the size of `input_path`.
+
+    Returns:
+        The list of written files.
+    """
+    if labels_path is None:
+        labels_path = input_path.replace(".txt", ".labels")
+    if spill_dir is None:
+        spill_dir = output_path.replace('.txt', '') + '_voxels.tmp'
+    shutil.rmtree(spill_dir, ignore_errors=True)
+    os.makedirs(spill_dir)
+
+    if num_points is None:
+        num_points = os.path.getsize(input_path) / TEXT_BYTES_PER_POINT
+    num_partitions = num_partitions_for(num_points, memory_budget, workers)
+    counts = spill_partitions(input_path, labels_path, spill_dir, grid_size, num_partitions,
+                              rows_for_budget(memory_budget))
+
+    jobs = []
+    for partition in np.flatnonzero(counts):
+        spill_file = spill_path(spill_dir, partition)
+        size = counts[partition] * REDUCE_BYTES_PER_POINT / 1e6
+        jobs.append((int(partition), size, reduce_partition,
+                     (spill_file, os.path.join(spill_dir, f"{partition}.reduced"))))
+    sizes = run_budgeted(jobs, workers, memory_budget, desc='reduce voxels')
+
+    reduced_files = [os.path.join(spill_dir, f"{partition}.reduced") for partition in sorted(sizes)]
+    outputs = save_processed_chunks(output_path, int(sum(sizes.values())),
+                                    iter_reduced(reduced_files), out_format)
+    shutil.rmtree(spill_dir)
+    return outputs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Subsample a raw Semantic3D cloud of any size to one point per voxel')
+    parser.add_argument('input_path', help='Raw .txt cloud with a .labels sibling')
+    parser.add_argument('output_path', help='Path of the subsampled .txt cloud')
+    parser.add_argument('--grid_size', type=float, default=0.01, help='Voxel size in meters')
+    parser.add_argument('--format', choices=['txt', 'binary'], default='txt',
+                        help='Output format of the subsampled cloud')
+    parser.add_argument('--memory_budget', type=int, default=4000,
+                        help='Memory budget in megabytes')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of partitions reduced in parallel')
+    parser.add_argument('--spill_dir', default=None,
+                        help='Directory of the temporary partition files')
+
+    args = parser.parse_args()
+
+    outputs = voxel_subsample_file(args.input_path, args.output_path, args.grid_size,
+                                   args.format, args.memory_budget, args.workers,
+                                   args.spill_dir)
+    print(f"Saved {', '.join(outputs)}")
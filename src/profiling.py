@@ -0,0 +1,497 @@
+"""Opt-in per-step profiling of training and inference.
+
+With `--profile`, `train.py` and `test_inference.py` time the phases of
+every step (waiting for data, forward, loss, backward, optimizer, crop
+preparation, checkpoints), sample the RSS and CPU utilisation of the process
+and its data loader workers, and append one JSON line per step to
+`<profile_dir>/<name>_<timestamp>.jsonl`. At the end a summary with count,
+total, mean, p50, p95 and max of every phase is logged and written next to
+it as `.summary.json`.
+
+`--profile_steps START:END` additionally records steps START..END-1 with
+cProfile (`.prof`, e.g. for `snakeviz` or `pstats`) or by attaching py-spy
+(`--profile_dump py-spy`, speedscope output).
+
+Without `--profile` a `NullProfiler` is used: its timers are a shared no-op
+context manager, and no hooks are installed into the model, the optimizer or
+the data loader.
+"""
+import os
+import sys
+import json
+import time
+import signal
+import shutil
+import cProfile
+import logging
+import resource
+import subprocess
+import contextlib
+from datetime import datetime
+import numpy as np
+
+DUMP_FORMATS = ('cprofile', 'py-spy')
+
+# Keys added to a crop's attr by the profiled TorchDataloader.__getitem__
+WORKER_PHASES = ('load', 'sample')
+
+log = logging.getLogger(__name__)
+
+
+def add_profile_arguments(parser):
+    """Add the profiling options to an argument parser."""
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='Record per-step timings, RSS and CPU utilisation as JSON lines'
+    )
+    parser.add_argument(
+        '--profile_dir',
+        type=str,
+        default='./logs/profile',
+        help='Directory of the profiling output'
+    )
+    parser.add_argument(
+        '--profile_steps',
+        type=str,
+        default=None,
+        help='Step range START:END to dump with --profile_dump (requires --profile)'
+    )
+    parser.add_argument(
+        '--profile_dump',
+        type=str,
+        default='cprofile',
+        choices=DUMP_FORMATS,
+        help='Profiler of the --profile_steps range: cProfile .prof or py-spy speedscope'
+    )
+
+
+def parse_step_range(steps):
+    """(start, end) of a 'START:END' step range, None if not given."""
+    if not steps:
+        return None
+    start, end = steps.split(':')
+    start, end = int(start or 0), int(end)
+    if end <= start:
+        raise ValueError(f"Empty step range {steps}")
+    return start, end
+
+
+def make_profiler(args, name):
+    """Profiler configured by the options of `add_profile_arguments`."""
+    if not args.profile:
+        return NullProfiler()
+    return Profiler(args.profile_dir, name, parse_step_range(args.profile_steps),
+                    args.profile_dump)
+
+
+def child_pids(pid):
+    """Pids of the processes started by `pid` and their descendants."""
+    pids = []
+    try:
+        tasks = os.listdir(f'/proc/{pid}/task')
+    except OSError:
+        return pids
+    for task in tasks:
+        try:
+            with open(f'/proc/{pid}/task/{task}/children', 'r') as f:
+                children = [int(child) for child in f.read().split()]
+        except OSError:
+            continue
+        for child in children:
+            pids += [child] + child_pids(child)
+    return pids
+
+
+def read_proc_stat(pid):
+    """(cpu_seconds, rss_bytes) of a process from /proc, None if it is gone."""
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            # Fields after the parenthesized command name, starting with state
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    rss_bytes = int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+    return cpu_seconds, rss_bytes
+
+
+class ResourceSampler(object):
+    """RSS and CPU utilisation of this process and its children since the last sample.
+
+    On Linux the children (e.g. data loader workers) are found in /proc; the
+    RSS of the tree double counts pages shared after fork. Elsewhere only
+    this process is sampled, with its peak RSS.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.proc = os.path.exists(f'/proc/{self.pid}/stat')
+        self.last_wall = time.perf_counter()
+        self.last_cpu, self.last_tree_cpu, _, _ = self.usage()
+
+    def usage(self):
+        """(cpu_seconds, tree_cpu_seconds, rss_bytes, tree_rss_bytes) of this
+        process and of it together with its children."""
+        if not self.proc:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+            cpu = usage.ru_utime + usage.ru_stime
+            return cpu, cpu, rss, rss
+        cpu, rss = read_proc_stat(self.pid) or (0.0, 0)
+        tree_cpu, tree_rss = cpu, rss
+        for pid in child_pids(self.pid):
+            stat = read_proc_stat(pid)
+            if stat is not None:
+                tree_cpu += stat[0]
+                tree_rss += stat[1]
+        return cpu, tree_cpu, rss, tree_rss
+
+    def sample(self):
+        wall = time.perf_counter()
+        cpu, tree_cpu, rss, tree_rss = self.usage()
+        elapsed = max(wall - self.last_wall, 1e-9)
+        sample = {
+            'rss_mb': rss / 1e6,
+            'tree_rss_mb': tree_rss / 1e6,
+            # Percent of one core; above 100 when several cores are busy
+            'cpu_percent': 100 * (cpu - self.last_cpu) / elapsed
+        }
+        # Workers that exited since the last sample take their CPU time along
+        if tree_cpu >= self.last_tree_cpu:
+            sample['tree_cpu_percent'] = 100 * (tree_cpu - self.last_tree_cpu) / elapsed
+        self.last_wall, self.last_cpu, self.last_tree_cpu = wall, cpu, tree_cpu
+        return sample
+
+
+class StepRangeDump(object):
+    """cProfile or py-spy recording of a range of steps."""
+
+    def __init__(self, path_prefix, step_range, dump='cprofile'):
+        self.start, self.end = step_range
+        self.dump = dump
+        self.path = f'{path_prefix}_steps_{self.start}-{self.end}' + (
+            '.prof' if dump == 'cprofile' else '.speedscope.json')
+        self.profile = None
+        self.process = None
+
+    def begin(self):
+        if self.dump == 'cprofile':
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            return
+        if shutil.which('py-spy') is None:
+            log.warning("py-spy is not installed, not recording steps "
+                        f"{self.start}-{self.end}")
+            return
+        self.process = subprocess.Popen(
+            ['py-spy', 'record', '--pid', str(os.getpid()), '--subprocesses',
+             '--format', 'speedscope', '--output', self.path],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def finish(self):
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.path)
+            self.profile = None
+        elif self.process is not None:
+            # py-spy writes its output when interrupted
+            self.process.send_signal(signal.SIGINT)
+            self.process.wait()
+            self.process = None
+        else:
+            return
+        log.info(f"Saved profile of steps {self.start}-{self.end} to {self.path}")
+
+
+class Profiler(object):
+    """Per-step phase timings and resource samples written as JSON lines."""
+
+    enabled = True
+
+    def __init__(self, profile_dir, name, step_range=None, dump='cprofile'):
+        os.makedirs(profile_dir, exist_ok=True)
+        timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+        prefix = os.path.join(profile_dir, f'{name}_{timestamp}')
+        self.path = prefix + '.jsonl'
+        self.summary_path = prefix + '.summary.json'
+        self.file = open(self.path, 'a')
+        self.range_dump = StepRangeDump(prefix, step_range, dump) if step_range else None
+
+        self.resources = ResourceSampler()
+        self.start = time.perf_counter()
+        self.step = 0
+        self.kind = None
+        self.step_start = None
+        self.phases = {}
+        self.workers = {}
+        self.history = {}
+        self.events = {}
+        self.peak_tree_rss_mb = 0.0
+        log.info(f"Profiling to {self.path}")
+
+    @property
+    def in_step(self):
+        return self.step_start is not None
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start)
+
+    def add(self, phase, seconds):
+        """Add `seconds` to a phase of the current step."""
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def add_worker(self, phase, seconds):
+        """Add time spent by data loader workers on the current step's inputs."""
+        self.workers[phase] = self.workers.get(phase, 0.0) + seconds
+
+    def begin_step(self, kind='step', start=None):
+        """Open a step; `start` backdates it, e.g. to include the wait for its data."""
+        if self.in_step:
+            self.end_step()
+        if self.range_dump is not None and self.step == self.range_dump.start:
+            self.range_dump.begin()
+        self.kind = kind
+        self.step_start = start if start is not None else time.perf_counter()
+
+    def end_step(self, **extra):
+        """Write the record of the current step."""
+        if not self.in_step:
+            return
+        now = time.perf_counter()
+        record = {
+            'step': self.step,
+            'kind': self.kind,
+            'time': now - self.start,
+            'seconds': now - self.step_start,
+            'phases': self.phases
+        }
+        if self.workers:
+            record['workers'] = self.workers
+        record.update(self.resources.sample())
+        record.update(extra)
+        self.file.write(json.dumps(record) + '\n')
+
+        history = self.history.setdefault(self.kind, {})
+        history.setdefault('step', []).append(record['seconds'])
+        for phase, seconds in list(self.phases.items()) + [
+                (f'worker_{phase}', seconds) for phase, seconds in self.workers.items()]:
+            history.setdefault(phase, []).append(seconds)
+        self.peak_tree_rss_mb = max(self.peak_tree_rss_mb, record['tree_rss_mb'])
+
+        self.step += 1
+        if self.range_dump is not None and self.step == self.range_dump.end:
+            self.range_dump.finish()
+        self.step_start = None
+        self.phases = {}
+        self.workers = {}
+
+    def event(self, name, seconds, **extra):
+        """Record something outside of the steps, e.g. writing a checkpoint."""
+        self.file.write(json.dumps(dict({'event': name, 'step': self.step,
+                                         'time': time.perf_counter() - self.start,
+                                         'seconds': seconds}, **extra)) + '\n')
+        self.events.setdefault(name, []).append(seconds)
+
+    @contextlib.contextmanager
+    def timed_event(self, name, **extra):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.event(name, time.perf_counter() - start, **extra)
+
+    def summary(self):
+        def describe(values):
+            values = np.asarray(values)
+            return {
+                'count': len(values),
+                'total_s': float(values.sum()),
+                'mean_ms': float(values.mean() * 1e3),
+                'p50_ms': float(np.percentile(values, 50) * 1e3),
+                'p95_ms': float(np.percentile(values, 95) * 1e3),
+                'max_ms': float(values.max() * 1e3)
+            }
+
+        return {
+            'wall_s': time.perf_counter() - self.start,
+            'steps': self.step,
+            'peak_tree_rss_mb': self.peak_tree_rss_mb,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (
+                1e6 if sys.platform == 'darwin' else 1e3),
+            'kinds': {kind: {phase: describe(values) for phase, values in phases.items()}
+                      for kind, phases in self.history.items()},
+            'events': {name: describe(values) for name, values in self.events.items()}
+        }
+
+    def close(self):
+        """Finish the open step and write and log the summary."""
+        self.end_step()
+        if self.range_dump is not None:
+            self.range_dump.finish()
+        self.file.close()
+
+        summary = self.summary()
+        tmp_path = self.summary_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(summary, f, indent=2)
+        os.replace(tmp_path, self.summary_path)
+
+        log.info(f"Profile of {summary['steps']} steps in {summary['wall_s']:.1f} s, "
+                 f"peak RSS {summary['peak_rss_mb']:,.0f} MB "
+                 f"({summary['peak_tree_rss_mb']:,.0f} MB with workers):")
+        for kind, phases in summary['kinds'].items():
+            step_total = phases['step']['total_s']
+            for phase, stats in phases.items():
+                if phase == 'step':
+                    continue
+                # Worker phases overlap the steps, their share can exceed 100%
+                log.info(f"  {kind:>6} {phase:<16} {stats['total_s']:9.2f} s "
+                         f"({stats['total_s'] / max(step_total, 1e-9):6.1%}), "
+                         f"mean {stats['mean_ms']:8.1f} ms, p95 {stats['p95_ms']:8.1f} ms")
+        for name, stats in summary['events'].items():
+            log.info(f"  {name:<23} {stats['total_s']:9.2f} s in {stats['count']} calls")
+        log.info(f"Saved profile summary to {self.summary_path}")
+
+
+class NullProfiler(object):
+    """Profiler doing nothing, used without --profile."""
+
+    enabled = False
+    in_step = False
+
+    _null = contextlib.nullcontext()
+
+    def timer(self, phase):
+        return self._null
+
+    def timed_event(self, name, **extra):
+        return self._null
+
+    def add(self, phase, seconds):
+        pass
+
+    def add_worker(self, phase, seconds):
+        pass
+
+    def begin_step(self, kind='step', start=None):
+        pass
+
+    def end_step(self, **extra):
+        pass
+
+    def event(self, name, seconds, **extra):
+        pass
+
+    def close(self):
+        pass
+
+
+def profiled_getitem(self, index):
+    """TorchDataloader.__getitem__ recording the time spent loading the
+    preprocessed cloud and sampling the crop (KNN, transform) in its attr."""
+    start = time.perf_counter()
+    dataset = self.dataset
+    index = index % len(dataset)
+
+    attr = dataset.get_attr(index)
+    if self.cache_convert:
+        data = self.cache_convert(attr['name'])
+    elif self.preprocess:
+        data = self.preprocess(dataset.get_data(index), attr)
+    else:
+        data = dataset.get_data(index)
+    loaded = time.perf_counter()
+
+    if self.transform is not None:
+        data = self.transform(data, attr)
+
+    attr = dict(attr, load=loaded - start, sample=time.perf_counter() - loaded)
+    return {'data': data, 'attr': attr}
+
+
+def instrument_training(pipeline, profiler):
+    """Hook the profiler into `pipeline.run_train()`.
+
+    A step is one forward pass (training or validation). Its phases are the
+    wait for the next batch, forward, loss, backward (from the loss to the
+    optimizer step) and optimizer step; the load and sample times of the
+    batch's crops are taken from the data loader workers. Checkpoints are
+    recorded as events.
+    """
+    import torch
+    from torch.optim.optimizer import (register_optimizer_step_post_hook,
+                                       register_optimizer_step_pre_hook)
+    from open3d._ml3d.torch.dataloaders.torch_dataloader import TorchDataloader
+
+    model = pipeline.model
+    sync = pipeline.device.type == 'cuda'
+    marks = {'last': time.perf_counter()}
+
+    def now():
+        # Kernels run asynchronously; wait for them so time is not
+        # attributed to the next phase that blocks
+        if sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def before_forward(module, args):
+        t = now()
+        profiler.begin_step('train' if module.training else 'valid', marks['last'])
+        profiler.add('data_wait', t - marks['last'])
+        marks['forward'] = t
+
+    def after_forward(module, args, output):
+        t = now()
+        profiler.add('forward', t - marks['forward'])
+        marks['last'] = t
+
+    get_loss = model.get_loss
+
+    def profiled_get_loss(Loss, results, inputs, device):
+        start = time.perf_counter()
+        loss = get_loss(Loss, results, inputs, device)
+        t = now()
+        profiler.add('loss', t - start)
+        attr = inputs.get('attr', {})
+        for phase in WORKER_PHASES:
+            if isinstance(attr, dict) and phase in attr:
+                profiler.add_worker(phase, float(np.sum(np.asarray(attr[phase]))))
+        marks['last'] = marks['loss'] = t
+        if not model.training:
+            profiler.end_step()
+        return loss
+
+    def before_optimizer_step(optimizer, args, kwargs):
+        t = now()
+        profiler.add('backward', t - marks.get('loss', t))
+        marks['optimizer'] = t
+
+    def after_optimizer_step(optimizer, args, kwargs):
+        t = now()
+        profiler.add('optimizer', t - marks['optimizer'])
+        marks['last'] = t
+        profiler.end_step()
+
+    save_ckpt = pipeline.save_ckpt
+
+    def profiled_save_ckpt(*args, **kwargs):
+        profiler.end_step()
+        with profiler.timed_event('checkpoint'):
+            result = save_ckpt(*args, **kwargs)
+        marks['last'] = time.perf_counter()
+        return result
+
+    TorchDataloader.__getitem__ = profiled_getitem
+    model.register_forward_pre_hook(before_forward)
+    model.register_forward_hook(after_forward)
+    model.get_loss = profiled_get_loss
+    register_optimizer_step_pre_hook(before_optimizer_step)
+    register_optimizer_step_post_hook(after_optimizer_step)
+    pipeline.save_ckpt = profiled_save_ckpt
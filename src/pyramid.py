@@ -0,0 +1,538 @@
+"""Precomputed multi-resolution point pyramids for RandLANet.
+
+For every crop RandLANet's `transform` runs `num_layers` KNN searches: at
+each layer the `num_neighbors` nearest points of every crop point, and the
+nearest point of the next, `sub_sampling_ratio` times smaller layer. The
+crop points are shuffled, so the next layer is a random prefix of the
+current one.
+
+A pyramid does this once per cloud. The cloud is subsampled at `grid_size`
+as by `RandLANet.preprocess` and its points are put in a fixed random order,
+so that layer j of the whole cloud is the prefix of its first m_j points
+(m_0 the whole cloud, m_{j+1} = m_j // sub_sampling_ratio[j]). For each of
+the first `pyramid_layers` layers the neighbours of its points among the
+layer and their nearest point of the next layer are stored as memory-mapped
+`.npy` arrays.
+
+A crop then only needs the query of its points around the centre: sorted by
+their index, i.e. by that random order, the prefix of the first n_j crop
+points takes the place of the random prefix, and the stored neighbours and
+up-sampling indices of those points are mapped to positions in the crop.
+Neighbours outside the crop are replaced by the point itself, and the
+nearest point of the next layer is searched within the crop when the stored
+one is not in it. The layers are therefore close to, but not the same as,
+those a search within the crop finds. The difference grows with depth: the
+prefix of a crop only approximates the crop's share of a cloud layer, and
+the sparser a layer, the more of its stored neighbours lie outside the crop. Only the first `pyramid_layers` layers (default 1, which
+holds most of the search time) are therefore taken from the pyramid; the
+coarser layers are searched within the crop as before.
+
+Pyramids live in `<dataset_path>/pyramids/<config hash>/<cloud name>/`;
+the hash covers the model fields they depend on, and every pyramid records
+the state of the processed cloud it was built from. Missing or stale
+pyramids are reported, and their clouds are processed as before. Set
+`use_pyramid: true` in the model config and build them with:
+
+    python src/pyramid.py --dataset_path Semantic3D/processed --workers 4
+"""
+import os
+import json
+import zlib
+import shutil
+import hashlib
+import logging
+import argparse
+import types
+import numpy as np
+import torch
+from sklearn.neighbors import KDTree
+from open3d.ml.datasets import utils
+from src.processing.cloud_io import (cloud_name, is_binary_cloud, read_cloud, read_header,
+                                     read_text_cloud, read_text_labels)
+from src.processing.text_stream import TEXT_BYTES_PER_POINT
+from src.processing.dataset_stats import list_clouds, labels_path_of
+from src.processing.scheduler import run_budgeted, available_memory
+from src.preprocess_cache import input_paths, input_state
+
+# Bump when the layout of a pyramid or the way it is built changes
+PYRAMID_VERSION = 2
+
+# Model config fields a pyramid depends on
+CONFIG_FIELDS = ('name', 'grid_size', 'num_neighbors', 'num_layers', 'sub_sampling_ratio',
+                 'pyramid_layers')
+
+PYRAMID_DIR = 'pyramids'
+META_NAME = 'meta.json'
+CONFIG_NAME = 'config.json'
+
+# Peak bytes per processed point while a pyramid is built: the parsed cloud,
+# the subsampled copies and the neighbour arrays of the first layer
+BUILD_BYTES_PER_POINT = 200
+
+# Layers of a crop taken from its pyramid (`pyramid_layers` in the model
+# config); the deeper ones are searched within the crop. The first layer
+# holds most points of a crop and most of the search time, while the stored
+# neighbours of the sparser deeper layers increasingly lie outside the crop.
+PYRAMID_LAYERS = 1
+
+log = logging.getLogger(__name__)
+
+
+def pyramid_key(model_cfg):
+    """Hash of the model config fields (and version) a pyramid depends on.
+
+    Returns:
+        (key, fields) with the 16 hex digit key and the hashed fields.
+    """
+    fields = {field: model_cfg.get(field) for field in CONFIG_FIELDS}
+    fields['sub_sampling_ratio'] = list(fields['sub_sampling_ratio'] or [])
+    fields['pyramid_layers'] = stored_layers(model_cfg)
+    fields['version'] = PYRAMID_VERSION
+    digest = hashlib.sha1(json.dumps(fields, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()[:16], fields
+
+
+def stored_layers(model_cfg):
+    """Number of layers a pyramid stores for a model config."""
+    layers = model_cfg.get('pyramid_layers')
+    layers = PYRAMID_LAYERS if layers is None else layers
+    return min(layers, model_cfg.get('num_layers'))
+
+
+def pyramid_root(dataset_path, model_cfg):
+    """Directory of the pyramids of a dataset built for a model config."""
+    key, _ = pyramid_key(model_cfg)
+    return os.path.join(dataset_path, PYRAMID_DIR, key)
+
+
+def level_sizes(num_points, sub_sampling_ratio, num_layers):
+    """Number of points of every layer, from the full cloud to the coarsest."""
+    sizes = [num_points]
+    for ratio in sub_sampling_ratio[:num_layers]:
+        sizes.append(sizes[-1] // ratio)
+    return sizes
+
+
+def read_cloud_arrays(cloud_path):
+    """Points, colors and labels of a processed cloud, as read by the dataset.
+
+    Returns:
+        (points, feat, labels) with float32 xyz, float32 rgb and int32
+        labels (zeros for unlabeled clouds).
+    """
+    if is_binary_cloud(cloud_path):
+        cloud = read_cloud(cloud_path)
+        points = np.asarray(cloud['xyz'], dtype=np.float32)
+        feat = np.asarray(cloud['rgb'], dtype=np.float32)
+        labels = cloud.get('labels')
+    else:
+        pc = read_text_cloud(cloud_path)
+        points = np.ascontiguousarray(pc[:, 0:3])
+        feat = np.ascontiguousarray(pc[:, 4:7])
+        labels_path = labels_path_of(cloud_path)
+        labels = read_text_labels(labels_path) if labels_path is not None else None
+    if labels is None:
+        labels = np.zeros((len(points),), dtype=np.int32)
+    return points, feat, np.asarray(labels, dtype=np.int32)
+
+
+def num_points_of(cloud_path):
+    """Number of points of a processed cloud, estimated for text clouds."""
+    if is_binary_cloud(cloud_path):
+        return read_header(cloud_path)['columns']['xyz']['shape'][0]
+    return os.path.getsize(cloud_path) / TEXT_BYTES_PER_POINT
+
+
+def build_levels(points, num_neighbors, sub_sampling_ratio, num_layers):
+    """Neighbour and up-sampling indices of every layer of ordered points.
+
+    Returns:
+        A dict with `neighbors_<j>` (m_j, num_neighbors) and `up_<j>` (m_j,)
+        int32 arrays for j < num_layers.
+    """
+    sizes = level_sizes(len(points), sub_sampling_ratio, num_layers)
+    levels = {}
+    for j in range(num_layers):
+        support = points[:sizes[j]]
+        levels[f'neighbors_{j}'] = utils.DataProcessing.knn_search(support, support, num_neighbors)
+        levels[f'up_{j}'] = utils.DataProcessing.knn_search(points[:sizes[j + 1]], support, 1)[:, 0]
+    return levels
+
+
+def build_pyramid(cloud_path, root, model_cfg):
+    """Build the pyramid of one processed cloud into `root/<cloud name>`.
+
+    Returns:
+        The pyramid directory, or None if the subsampled cloud is smaller
+        than a crop (its crops repeat points and are always searched).
+    """
+    name = cloud_name(cloud_path)
+    points, feat, labels = read_cloud_arrays(cloud_path)
+    sub_points, sub_feat, sub_labels = utils.DataProcessing.grid_subsampling(
+        points, features=feat, labels=labels, grid_size=model_cfg['grid_size'])
+    if len(sub_points) < model_cfg['num_points']:
+        return None
+
+    # Fixed per cloud, so rebuilding an unchanged cloud gives the same pyramid
+    order = np.random.default_rng(zlib.crc32(name.encode('utf-8'))).permutation(len(sub_points))
+    arrays = {
+        'point': np.ascontiguousarray(sub_points[order], dtype=np.float32),
+        'feat': np.ascontiguousarray(sub_feat[order], dtype=np.float32),
+        'label': np.ascontiguousarray(sub_labels[order], dtype=np.int32),
+    }
+    layers = stored_layers(model_cfg)
+    arrays.update(build_levels(arrays['point'], model_cfg['num_neighbors'],
+                               model_cfg['sub_sampling_ratio'], layers))
+
+    pyramid_dir = os.path.join(root, name)
+    tmp_dir = f'{pyramid_dir}.tmp-{os.getpid()}'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for key, value in arrays.items():
+        np.save(os.path.join(tmp_dir, key + '.npy'), value)
+    inputs = input_state(input_paths(cloud_path))
+    with open(os.path.join(tmp_dir, META_NAME), 'w') as f:
+        json.dump({
+            'name': name,
+            'inputs': inputs,
+            'id': hashlib.sha1(json.dumps(inputs).encode('utf-8')).hexdigest()[:16],
+            'sizes': level_sizes(len(order), model_cfg['sub_sampling_ratio'], layers)
+        }, f)
+    shutil.rmtree(pyramid_dir, ignore_errors=True)
+    os.rename(tmp_dir, pyramid_dir)
+    return pyramid_dir
+
+
+def is_up_to_date(pyramid_dir, cloud_path):
+    """Whether a pyramid was built from the current state of its cloud."""
+    meta_path = os.path.join(pyramid_dir, META_NAME)
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    return meta['inputs'] == input_state(input_paths(cloud_path))
+
+
+def build_pyramids(dataset_path, model_cfg, workers=1, max_memory=None, force=False):
+    """Build the missing or stale pyramids of every processed cloud of a dataset.
+
+    Returns:
+        The number of pyramids built.
+    """
+    key, fields = pyramid_key(model_cfg)
+    root = os.path.join(dataset_path, PYRAMID_DIR, key)
+    os.makedirs(root, exist_ok=True)
+    config_path = os.path.join(root, CONFIG_NAME)
+    if not os.path.exists(config_path):
+        tmp_path = f'{config_path}.tmp-{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump(fields, f, indent=2, default=str)
+        os.replace(tmp_path, config_path)
+
+    model_cfg = {field: model_cfg.get(field) for field in CONFIG_FIELDS + ('num_points',)}
+    jobs = []
+    for cloud_path in list_clouds(dataset_path):
+        name = cloud_name(cloud_path)
+        if not force and is_up_to_date(os.path.join(root, name), cloud_path):
+            continue
+        estimate = num_points_of(cloud_path) * BUILD_BYTES_PER_POINT / 1e6
+        jobs.append((name, estimate, build_pyramid, (cloud_path, root, model_cfg)))
+
+    results = run_budgeted(jobs, workers, max_memory, desc='pyramids')
+    skipped = sorted(name for name, pyramid_dir in results.items() if pyramid_dir is None)
+    if skipped:
+        print(f"No pyramid for {', '.join(skipped)}: fewer points than a crop")
+    return len(results) - len(skipped)
+
+
+class PyramidStore(object):
+    """Finds and memory-maps the pyramids of a dataset for one model config."""
+
+    def __init__(self, dataset_path, model_cfg):
+        self.dataset_path = str(dataset_path)
+        self.root = pyramid_root(self.dataset_path, model_cfg)
+        self._arrays = {}
+        self._lookups = {}
+        self._reported = set()
+
+        if not os.path.isdir(self.root):
+            other = os.path.join(self.dataset_path, PYRAMID_DIR)
+            if os.path.isdir(other) and os.listdir(other):
+                log.warning(f"The pyramids in {other} were built for another model config; "
+                            f"re-run src/pyramid.py with the current one")
+            else:
+                log.warning(f"No pyramids in {other}, searching neighbours per crop; "
+                            f"build them with src/pyramid.py")
+
+    def pyramid_dir(self, name):
+        return os.path.join(self.root, name)
+
+    def input_paths(self, name):
+        """Files a preprocessed cloud depends on through its pyramid."""
+        meta_path = os.path.join(self.pyramid_dir(name), META_NAME)
+        return [meta_path] if os.path.exists(meta_path) else []
+
+    def find(self, name, cloud_path):
+        """Meta of the current pyramid of a cloud, None if it is missing or stale."""
+        pyramid_dir = self.pyramid_dir(name)
+        if cloud_path is not None and is_up_to_date(pyramid_dir, cloud_path):
+            with open(os.path.join(pyramid_dir, META_NAME), 'r') as f:
+                return json.load(f)
+        if name not in self._reported and os.path.isdir(self.root):
+            self._reported.add(name)
+            state = 'is stale' if os.path.exists(pyramid_dir) else 'is missing'
+            log.warning(f"The pyramid of {name} {state}, searching its neighbours per crop")
+        return None
+
+    def arrays(self, pyramid):
+        """Memory-mapped arrays of a pyramid referenced by preprocessed data,
+        None if it was rebuilt since."""
+        pyramid_dir = pyramid['dir']
+        if pyramid_dir not in self._arrays:
+            meta_path = os.path.join(pyramid_dir, META_NAME)
+            if not os.path.exists(meta_path):
+                return None
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            arrays = {'meta': meta}
+            for j in range(len(meta['sizes']) - 1):
+                for key in (f'neighbors_{j}', f'up_{j}'):
+                    arrays[key] = np.load(os.path.join(pyramid_dir, key + '.npy'), mmap_mode='r')
+            self._arrays[pyramid_dir] = arrays
+        arrays = self._arrays[pyramid_dir]
+        return arrays if arrays['meta']['id'] == pyramid['id'] else None
+
+    def lookup(self, pyramid_dir, num_points):
+        """Cloud index -> crop position table of a pyramid, all -1 between uses."""
+        if pyramid_dir not in self._lookups:
+            self._lookups[pyramid_dir] = np.full(num_points, -1, dtype=np.int32)
+        return self._lookups[pyramid_dir]
+
+
+def crop_levels(arrays, lookup, idxs, pc, sub_sampling_ratio, num_layers):
+    """Neighbour, pooling and up-sampling indices of the layers of a crop.
+
+    Args:
+        arrays: Pyramid arrays from `PyramidStore.arrays`.
+        lookup: Table from `PyramidStore.lookup`, left all -1.
+        idxs: Cloud indices of the crop points, sorted and unique.
+        pc: Coordinates of the crop points, in the order of `idxs`.
+
+    Returns:
+        (neighbors, pools, up_samples): lists of int64 arrays per layer, as
+        computed by `RandLANet.transform`.
+    """
+    sizes = np.asarray(arrays['meta']['sizes'])
+    # Deepest layer every crop point belongs to
+    depth = (idxs[:, None] < sizes[None, 1:num_layers]).sum(axis=1)
+
+    neighbors, pools, up_samples = [], [], []
+    n = len(idxs)
+    for j in range(num_layers):
+        cloud_idxs = idxs[:n]
+        rows = np.arange(n, dtype=np.int32)
+        n_next = n // sub_sampling_ratio[j]
+        lookup[cloud_idxs] = rows
+
+        # Points the crop prefix holds beyond layer j use their neighbours
+        # of the deepest layer they belong to
+        level = np.minimum(depth[:n], j)
+        neighbor_idx = np.empty((n, arrays['neighbors_0'].shape[1]), dtype=np.int32)
+        for u in np.unique(level):
+            selected = level == u
+            neighbor_idx[selected] = arrays[f'neighbors_{u}'][cloud_idxs[selected]]
+        neighbor_idx = lookup[neighbor_idx]
+        outside = neighbor_idx < 0
+        neighbor_idx[outside] = np.broadcast_to(rows[:, None], outside.shape)[outside]
+
+        # Points of the next layer are their own nearest point of it
+        up_i = np.full(n, -1, dtype=np.int32)
+        in_layer = level == j
+        up_i[in_layer] = lookup[arrays[f'up_{j}'][cloud_idxs[in_layer]]]
+        up_i[:n_next] = rows[:n_next]
+        missing = (up_i < 0) | (up_i >= n_next)
+        if missing.any():
+            # Stored nearest point outside the crop's next layer
+            up_i[missing] = utils.DataProcessing.knn_search(
+                pc[:n_next], np.ascontiguousarray(pc[:n][missing]), 1)[:, 0]
+        lookup[cloud_idxs] = -1
+
+        neighbors.append(neighbor_idx.astype(np.int64))
+        pools.append(neighbor_idx[:n_next].astype(np.int64))
+        up_samples.append(up_i[:, None].astype(np.int64))
+        n = n_next
+    return neighbors, pools, up_samples
+
+
+def search_levels(pc, num_neighbors, sub_sampling_ratio, num_layers):
+    """The KNN searches of `RandLANet.transform` for crops without a pyramid."""
+    neighbors, pools, up_samples = [], [], []
+    for j in range(num_layers):
+        neighbour_idx = utils.DataProcessing.knn_search(pc, pc, num_neighbors)
+        sub_points = pc[:pc.shape[0] // sub_sampling_ratio[j], :]
+        neighbors.append(neighbour_idx.astype(np.int64))
+        pools.append(neighbour_idx[:len(sub_points)].astype(np.int64))
+        up_samples.append(utils.DataProcessing.knn_search(sub_points, pc, 1).astype(np.int64))
+        pc = sub_points
+    return neighbors, pools, up_samples
+
+
+def pyramid_preprocess(self, data, attr):
+    """`RandLANet.preprocess` reading the subsampled cloud from its pyramid."""
+    meta = self.pyramids.find(attr['name'], attr.get('path'))
+    if meta is None:
+        return type(self).preprocess(self, data, attr)
+
+    pyramid_dir = self.pyramids.pyramid_dir(attr['name'])
+    points = np.load(os.path.join(pyramid_dir, 'point.npy'), mmap_mode='r')
+    search_tree = KDTree(points)
+    proc = {
+        'point': points,
+        'feat': np.load(os.path.join(pyramid_dir, 'feat.npy'), mmap_mode='r'),
+        'label': np.load(os.path.join(pyramid_dir, 'label.npy'), mmap_mode='r'),
+        'search_tree': search_tree,
+        'pyramid': {'dir': pyramid_dir, 'id': meta['id']}
+    }
+    if attr['split'] in ["test", "testing"]:
+        proc['label'] = np.zeros((len(points),), dtype=np.int32)
+        proj_inds = np.squeeze(search_tree.query(
+            np.asarray(data['point'][:, 0:3], dtype=np.float32), return_distance=False))
+        proc['proj_inds'] = proj_inds.astype(np.int32)
+    return proc
+
+
+def pyramid_transform(self, data, attr, min_possibility_idx=None):
+    """`RandLANet.transform` taking the layers of a crop from its pyramid.
+
+    Mirrors the original: sampling, augmentation and the returned inputs are
+    the same, but the crop points are ordered by their cloud index instead
+    of randomly, and the KNN searches of the first `pyramid_layers` layers
+    are replaced by `crop_levels`.
+    """
+    arrays = self.pyramids.arrays(data['pyramid']) if 'pyramid' in data else None
+    if arrays is None:
+        return type(self).transform(self, data, attr, min_possibility_idx)
+
+    if torch.utils.data.get_worker_info():
+        seedseq = np.random.SeedSequence(
+            torch.utils.data.get_worker_info().seed +
+            torch.utils.data.get_worker_info().id)
+        rng = np.random.default_rng(seedseq.spawn(1)[0])
+    else:
+        rng = self.rng
+
+    cfg = self.cfg
+    inputs = dict()
+
+    pc = np.array(data['point'])
+    label = np.array(data['label'])
+    feat = np.array(data['feat']) if data['feat'] is not None else None
+    tree = data['search_tree']
+
+    pc, selected_idxs, center_point = self.trans_point_sampler(
+        pc=pc,
+        feat=feat,
+        label=label,
+        search_tree=tree,
+        num_points=self.cfg.num_points)
+
+    # The order of the points decides the layers they belong to
+    order = np.argsort(selected_idxs, kind='stable')
+    pc = pc[order]
+    selected_idxs = np.asarray(selected_idxs)[order]
+    unique = len(selected_idxs) < 2 or bool(np.all(selected_idxs[1:] != selected_idxs[:-1]))
+
+    label = label[selected_idxs]
+
+    if feat is not None:
+        feat = feat[selected_idxs]
+
+    augment_cfg = self.cfg.get('augment', {}).copy()
+    val_augment_cfg = {}
+    if 'recenter' in augment_cfg:
+        val_augment_cfg['recenter'] = augment_cfg.pop('recenter')
+    if 'normalize' in augment_cfg:
+        val_augment_cfg['normalize'] = augment_cfg.pop('normalize')
+
+    self.augmenter.augment(pc, feat, label, val_augment_cfg, seed=rng)
+
+    if attr['split'] in ['training', 'train']:
+        pc, feat, label = self.augmenter.augment(pc,
+                                                 feat,
+                                                 label,
+                                                 augment_cfg,
+                                                 seed=rng)
+
+    if feat is None:
+        feat = pc.copy()
+    else:
+        feat = np.concatenate([pc, feat], axis=1)
+
+    if cfg.in_channels != feat.shape[1]:
+        raise RuntimeError(
+            "Wrong feature dimension, please update in_channels(3 + feature_dimension) in config"
+        )
+
+    if unique:
+        stored = stored_layers(cfg)
+        lookup = self.pyramids.lookup(data['pyramid']['dir'], len(data['point']))
+        neighbors, pools, up_samples = crop_levels(arrays, lookup, selected_idxs, pc,
+                                                   cfg.sub_sampling_ratio, stored)
+        coarse_pc = pc
+        for j in range(stored):
+            coarse_pc = coarse_pc[:coarse_pc.shape[0] // cfg.sub_sampling_ratio[j], :]
+        searched = search_levels(coarse_pc, cfg.num_neighbors,
+                                 cfg.sub_sampling_ratio[stored:], cfg.num_layers - stored)
+        neighbors += searched[0]
+        pools += searched[1]
+        up_samples += searched[2]
+    else:
+        # Crops of clouds smaller than a crop repeat points
+        neighbors, pools, up_samples = search_levels(pc, cfg.num_neighbors,
+                                                     cfg.sub_sampling_ratio, cfg.num_layers)
+
+    input_points = []
+    for j in range(cfg.num_layers):
+        input_points.append(pc)
+        pc = pc[:pc.shape[0] // cfg.sub_sampling_ratio[j], :]
+
+    inputs['coords'] = input_points
+    inputs['neighbor_indices'] = neighbors
+    inputs['sub_idx'] = pools
+    inputs['interp_idx'] = up_samples
+    inputs['features'] = feat
+    inputs['point_inds'] = selected_idxs
+    inputs['labels'] = label.astype(np.int64)
+
+    return inputs
+
+
+def install_pyramid(model, dataset_path):
+    """Make `model` take subsampled clouds and crop layers from the pyramids
+    of `dataset_path`, where they are up to date."""
+    if model.cfg.get('name') != 'RandLANet':
+        raise ValueError(f"Pyramids are built for RandLANet, not {model.cfg.get('name')}")
+    model.pyramids = PyramidStore(dataset_path, model.cfg)
+    model.preprocess = types.MethodType(pyramid_preprocess, model)
+    model.transform = types.MethodType(pyramid_transform, model)
+
+
+if __name__ == '__main__':
+    import open3d.ml as _ml3d
+
+    parser = argparse.ArgumentParser(description='Build the point pyramids of a processed dataset')
+    parser.add_argument('--dataset_path', help='Directory of the processed clouds',
+                        default='Semantic3D/processed')
+    parser.add_argument('--config', help='Config of the model the pyramids are built for',
+                        default='configs/randlanet_semantic3d.yml')
+    parser.add_argument('--workers', type=int, default=1, help='Clouds processed in parallel')
+    parser.add_argument('--max_memory', type=int, default=int(0.8 * available_memory()),
+                        help='Memory budget in megabytes shared by all workers')
+    parser.add_argument('--force', action='store_true', help='Rebuild up-to-date pyramids')
+
+    args = parser.parse_args()
+
+    cfg = _ml3d.utils.Config.load_from_file(args.config)
+    built = build_pyramids(args.dataset_path, cfg.model, args.workers, args.max_memory,
+                           args.force)
+    print(f"Built {built} pyramids in {pyramid_root(args.dataset_path, cfg.model)}")
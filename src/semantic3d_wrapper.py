@@ -1,8 +1,17 @@
 from open3d.ml.torch.datasets import Semantic3D
+from open3d._ml3d.datasets.base_dataset import BaseDataset
+from open3d._ml3d.datasets.semantic3d import Semantic3DSplit
+import os
+import logging
 import numpy as np
 from pathlib import Path
-import glob
-from os.path import exists
+from src.processing.cloud_io import cloud_name, is_binary_cloud, owned_rows, read_cloud
+from src.processing.dataset_stats import (STATS_NAME, cloud_files, load_cloud_index,
+                                          resolve_class_weights, scan_clouds)
+from src.preprocess_cache import install_preprocess_cache, max_bytes_of
+from src.class_sampler import ClassBalancedSampler  # registers the sampler with Open3D-ML
+
+log = logging.getLogger(__name__)
 
 class Semantic3DForEval(Semantic3D):
     """ Semantic3D dataset wrapper for evaluation with val set assigned to test set.
@@ -14,16 +23,14 @@ class Semantic3DForEval(Semantic3D):
                  cache_dir='./logs/cache',
                  use_cache=False,
                  num_points=65536,
-                 class_weights=[
-                     5181602, 5012952, 6830086, 1311528, 10476365, 946982,
-                     334860, 269353
-                 ],
+                 class_weights=STATS_NAME,
                  ignored_label_inds=[0],
                  val_files=[
                      'bildstein_station3_xyz_intensity_rgb',
                      'sg27_station2_intensity_rgb'
                  ],
                  test_result_folder='./test',
+                 cache_max_gb=None,
                  **kwargs):
         """Initialize the function by passing the dataset and other details.
 
@@ -33,26 +40,41 @@ class Semantic3DForEval(Semantic3D):
             cache_dir: The directory where the cache is stored.
             use_cache: Indicates if the dataset should be cached.
             num_points: The maximum number of points to use when splitting the dataset.
-            class_weights: The class weights to use in the dataset.
+            class_weights: The class weights to use in the dataset, or the
+                path of a dataset statistics file (relative to dataset_path)
+                providing them.
             ignored_label_inds: A list of labels that should be ignored in the dataset.
-            val_files: The files with the data.
+            val_files: Stations of the val split, matched exactly by
+                station name (all parts and tiles of a station).
             test_result_folder: The folder where the test results should be stored.
+            cache_max_gb: Size cap of the preprocessing cache in GB; least
+                recently used entries are evicted beyond it.
 
         Returns:
             class: The corresponding class.
         """
-        super().__init__(dataset_path=dataset_path,
-                         name=name,
-                         cache_dir=cache_dir,
-                         use_cache=use_cache,
-                         class_weights=class_weights,
-                         num_points=num_points,
-                         ignored_label_inds=ignored_label_inds,
-                         val_files=val_files,
-                         test_result_folder=test_result_folder,
-                         **kwargs)
-
-        cfg = self.cfg
+        class_weights = resolve_class_weights(class_weights, dataset_path,
+                                              val_files)
+
+        # Semantic3D.__init__ scans the dataset directory; the file lists
+        # are built lazily by this class instead
+        BaseDataset.__init__(self,
+                             dataset_path=dataset_path,
+                             name=name,
+                             cache_dir=cache_dir,
+                             use_cache=use_cache,
+                             class_weights=class_weights,
+                             num_points=num_points,
+                             ignored_label_inds=ignored_label_inds,
+                             val_files=val_files,
+                             test_result_folder=test_result_folder,
+                             cache_max_gb=cache_max_gb,
+                             **kwargs)
+
+        # Preprocessed clouds are cached by content and config (see
+        # src/preprocess_cache.py) instead of by name only
+        if use_cache:
+            install_preprocess_cache(dataset_path, max_bytes_of(cache_max_gb))
 
         self.label_to_names = self.get_label_to_names()
         self.num_classes = len(self.label_to_names)
@@ -60,23 +82,98 @@ class Semantic3DForEval(Semantic3D):
         self.label_to_idx = {l: i for i, l in enumerate(self.label_values)}
         self.ignored_labels = np.array([0])
 
-        self.all_files = glob.glob(str(Path(self.cfg.dataset_path) / '*.txt'))
+        # Split file lists are built on first use
+        self._splits = None
+        self.clouds = None
+
+    def _index(self):
+        """Cloud records of the dataset: from dataset_stats.json when it is
+        current, else from a scan of the dataset directory."""
+        dataset_path = self.cfg.dataset_path
+        clouds = load_cloud_index(dataset_path)
+        listing = os.listdir(dataset_path)
+        if clouds is not None and set(clouds) != cloud_files(listing):
+            log.warning(f"The clouds in {dataset_path} changed since {STATS_NAME} was "
+                        f"computed, scanning the directory; re-run src/processing/dataset_stats.py")
+            clouds = None
+        if clouds is None:
+            clouds = scan_clouds(dataset_path)
+        return clouds
+
+    def _split_files(self):
+        if self._splits is None:
+            self.clouds = self._index()
+            val_stations = set(self.cfg.val_files)
+            splits = {'train': [], 'val': []}
+            for file_name, cloud in sorted(self.clouds.items()):
+                if not cloud['labeled']:
+                    continue
+                path = str(Path(self.cfg.dataset_path) / file_name)
+                splits['val' if cloud['station'] in val_stations else 'train'].append(path)
+            self._splits = splits
+        return self._splits
+
+    @property
+    def train_files(self):
+        return self._split_files()['train']
+
+    @property
+    def val_files(self):
+        return self._split_files()['val']
+
+    @property
+    def test_files(self):
+        # The val clouds are the test split
+        return self._split_files()['val']
+
+    def get_split(self, split):
+        return Semantic3DForEvalSplit(self, split=split)
+
+
+class Semantic3DForEvalSplit(Semantic3DSplit):
+    """ Semantic3D split that also reads binary cloud containers.
+
+    The overlap margin of a tile is kept as context but labeled 0 (ignored),
+    so losses, validation metrics and class balanced crop centers count each
+    point only with the tile that owns it.
+    """
+
+    def get_data(self, idx):
+        data = self._read_data(idx)
+        owned = owned_rows(self.path_list[idx])
+        if owned is not None and self.split != 'test':
+            data['label'][owned:] = 0
+        return data
+
+    def _read_data(self, idx):
+        pc_path = self.path_list[idx]
+        if not is_binary_cloud(pc_path):
+            return super().get_data(idx)
 
-        self.train_files = [
-            f for f in self.all_files if exists(
-                str(Path(f).parent / Path(f).name.replace('.txt', '.labels')))
-        ]
+        cloud = read_cloud(pc_path)
+        points = cloud['xyz']
+        feat = cloud['rgb'].astype(np.float32)
+        intensity = cloud['intensity'].astype(np.float32)
 
-        self.train_files = np.sort(self.train_files)
-        self.val_files = []
-        self.test_files = []
+        if self.split != 'test' and 'labels' in cloud:
+            labels = cloud['labels'].astype(np.int32)
+        else:
+            labels = np.zeros((points.shape[0],), dtype=np.int32)
 
-        for i, file_path in enumerate(self.train_files):
-            for val_file in cfg.val_files:
-                if val_file in file_path:
-                    self.val_files.append(file_path)
-                    self.test_files.append(file_path)
-                    break
+        data = {
+            'point': points,
+            'feat': feat,
+            'intensity': intensity,
+            'label': labels
+        }
+        return data
 
-        self.train_files = np.sort(
-            [f for f in self.train_files if f not in self.val_files])
\ No newline at end of file
+    def get_attr(self, idx):
+        pc_path = str(self.path_list[idx])
+        attr = {
+            'idx': idx,
+            'name': cloud_name(pc_path),
+            'path': pc_path,
+            'split': self.split
+        }
+        return attr
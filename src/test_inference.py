@@ -1,23 +1,560 @@
+"""Batched, resumable inference on the test split.
+
+Every test cloud is covered the same way `pipeline.run_test()` does it:
+crops of `num_points` points are taken around the least visited point
+(optionally jittered with `--center_noise`, which `run_test()` does not do) and
+their softmax outputs are smoothed into per-point probabilities until every
+point has been visited. Here several crops are stacked into one forward pass,
+the accumulated probabilities of the current cloud are checkpointed every few
+batches so a killed job resumes where it stopped, and each `.labels` file is
+written atomically once its cloud is complete. Clouds with an existing output
+are skipped.
+
+With `--metrics` the predictions are counted against the ground truth of
+the (validation) clouds as they are produced, and the metrics of every
+cloud and of all clouds so far are logged and saved as JSON in the format of
+`src/eval.py`; with `--no_labels` no `.labels` files are written at all.
+"""
 import os
+import time
+import random
+import fnmatch
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
 import open3d.ml as _ml3d
 import open3d.ml.torch as ml3d
-import logging
 from src.semantic3d_wrapper import Semantic3DForEval
+from src.export_model import ExportedModel
+from src.eval import StreamingMetrics, log_metrics
+from src.processing.cloud_io import load_labels
+from src.preprocess_cache import PreprocessCache, max_bytes_of
+from src.prob_accumulator import DTYPES, ProbabilityAccumulator
+from src.processing.reproject import labels_to_text
+from src.profiling import NullProfiler, add_profile_arguments, make_profiler
+from src.pyramid import install_pyramid
+
+# A point is done once its possibility exceeds this (as in run_test)
+MIN_POSSIBILITY = 0.5
+
+# Progress of unfinished clouds is kept under <output_dir>/<PROGRESS_DIR>
+PROGRESS_DIR = '.progress'
+PROGRESS_VERSION = 3
+
+log = logging.getLogger(__name__)
+
+
+def configure_logging():
+    """Configure logging format and level"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(levelname)s - %(asctime)s - %(module)s - %(message)s',
+    )
+
+def parse_arguments():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description='Batched, resumable inference on the Semantic3D test split')
+    parser.add_argument(
+        '--config',
+        type=str,
+        default='configs/randlanet_semantic3d.yml',
+        help='Path to config file (default: randlanet_semantic3d.yml)'
+    )
+    parser.add_argument(
+        '--dataset_path',
+        type=str,
+        default=None,
+        help='Path to the dataset directory (default: dataset_path of the config)'
+    )
+    parser.add_argument(
+        '--ckpt_path',
+        type=str,
+        default=None,
+        help='Checkpoint to load (default: ckpt_path of the config, else the latest checkpoint in the logs)'
+    )
+    parser.add_argument(
+        '--model_path',
+        type=str,
+        default=None,
+        help='TorchScript/ONNX model written by src/export_model.py, run instead of the eager model'
+    )
+    parser.add_argument(
+        '--files',
+        type=str,
+        nargs='+',
+        default=None,
+        help='Cloud names or glob patterns of the test clouds to predict (default: all)'
+    )
+    parser.add_argument(
+        '--batch_size',
+        type=int,
+        default=4,
+        help='Number of crops per forward pass'
+    )
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=None,
+        help='Number of CPU threads used by torch (default: torch default)'
+    )
+    parser.add_argument(
+        '--device',
+        type=str,
+        default='cuda',
+        help='Device to run on, falls back to cpu when cuda is unavailable (always cpu with --model_path)'
+    )
+    parser.add_argument(
+        '--output_dir',
+        type=str,
+        default=None,
+        help='Directory for the .labels files (default: test_result_folder of the config)'
+    )
+    parser.add_argument(
+        '--checkpoint_every',
+        type=int,
+        default=20,
+        help='Save the progress of the current cloud every N batches'
+    )
+    parser.add_argument(
+        '--prob_dtype',
+        type=str,
+        default='float16',
+        choices=DTYPES,
+        help='Storage of the accumulated probabilities (uint8: quantized to 1/255)'
+    )
+    parser.add_argument(
+        '--prob_memmap',
+        action='store_true',
+        help='Keep the accumulated probabilities in a memmap file instead of RAM'
+    )
+    parser.add_argument(
+        '--min_visits',
+        type=int,
+        default=None,
+        help='Also finish a cloud once every point was covered by this many crops'
+    )
+    parser.add_argument(
+        '--overwrite',
+        action='store_true',
+        help='Predict clouds again even if their .labels file exists'
+    )
+    parser.add_argument(
+        '--metrics',
+        action='store_true',
+        help='Count the predictions against the ground truth while predicting and log IoU/mIoU/OA'
+    )
+    parser.add_argument(
+        '--metrics_json',
+        type=str,
+        default=None,
+        help='Where --metrics saves its JSON (default: eval_metrics.json next to the .labels files)'
+    )
+    parser.add_argument(
+        '--metrics_mode',
+        type=str,
+        default='global',
+        choices=['global', 'file_mean'],
+        help='global: metrics of the summed confusion matrix; file_mean: per-file metrics averaged over files'
+    )
+    parser.add_argument(
+        '--no_labels',
+        action='store_true',
+        help='Do not write .labels files, only the metrics (requires --metrics)'
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=None,
+        help='Seed of the crop sampling'
+    )
+    parser.add_argument(
+        '--center_noise',
+        type=float,
+        default=0.0,
+        help='Standard deviation in meters of Gaussian noise added to crop centers, as the TF '
+        'RandLA-Net does with noise_init / 10 = 0.35 (default: 0, like pipeline.run_test())'
+    )
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    if args.no_labels and not args.metrics:
+        parser.error('--no_labels requires --metrics')
+    return args
+
+
+def select_files(split, patterns=None):
+    """Indices of the clouds in `split` whose name matches one of `patterns`."""
+    selected = []
+    for idx in range(len(split)):
+        name = split.get_attr(idx)['name']
+        if patterns is None or any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+            selected.append(idx)
+    return selected
+
+
+def output_path(output_dir, dataset_name, name):
+    """Where the predictions of a cloud go, as written by `save_test_result`."""
+    return os.path.join(output_dir, dataset_name, name + '.labels')
+
+
+def progress_path(output_dir, name):
+    return os.path.join(output_dir, PROGRESS_DIR, name + '.npz')
+
+
+class CropSampler(object):
+    """Crops of `num_points` points centered on the least visited point.
+
+    Mirrors the sampler of `SemSegSpatiallyRegularSampler` for one cloud:
+    points of a crop gain possibility the closer they are to its center.
+    With `noise` > 0 the center is moved by Gaussian noise of that standard
+    deviation, drawn from `rng`, as in the TF RandLA-Net; Open3D's sampler
+    has no such noise.
+    """
+
+    def __init__(self, possibility, rng, noise=0.0):
+        self.possibility = possibility
+        self.rng = rng
+        self.noise = noise
+
+    def __call__(self, pc=None, num_points=None, search_tree=None, **kwargs):
+        center_id = np.argmin(self.possibility)
+        center_point = pc[center_id, :].reshape(1, -1)
+        pick_point = center_point
+        if self.noise > 0:
+            noise = self.rng.normal(scale=self.noise, size=center_point.shape)
+            pick_point = center_point + noise.astype(center_point.dtype)
+
+        if len(pc) < num_points:
+            idxs = np.concatenate([np.arange(len(pc)),
+                                   self.rng.integers(0, len(pc), num_points - len(pc))])
+        else:
+            idxs = search_tree.query(pick_point, k=num_points)[1][0]
+
+        self.rng.shuffle(idxs)
+        pc = pc[idxs]
+        dists = np.sum(np.square((pc - pick_point).astype(np.float32)), axis=1)
+        delta = np.square(1 - dists / max(np.max(dists), 1e-12))
+        self.possibility[idxs] += delta
+        return pc, idxs, pick_point
+
+
+def preprocess_cloud(model, split, idx, cache=None):
+    """`model.preprocess` output of a test cloud, from `cache` if given.
+
+    Cache entries written by a training run lack the `proj_inds` of the
+    test split; they are computed from the raw cloud then.
+    """
+    attr = split.get_attr(idx)
+    if cache is None:
+        return model.preprocess(split.get_data(idx), attr)
+
+    data = None
+    if cache.find(attr['name'], attr['path']) is None:
+        data = split.get_data(idx)
+        proc = cache(attr['name'], data, attr)
+    else:
+        proc = cache(attr['name'])
+    if 'proj_inds' not in proc:
+        data = data if data is not None else split.get_data(idx)
+        proj_inds = proc['search_tree'].query(np.asarray(data['point'][:, :3], dtype=np.float32),
+                                              return_distance=False)
+        proc = dict(proc, proj_inds=np.squeeze(proj_inds).astype(np.int32))
+    return proc
+
+
+def load_progress(path, num_points, ckpt_path, prob_dtype, prob_memmap, pyramid_id=None):
+    """Saved state of an unfinished cloud, None if missing or unusable.
+
+    `pyramid_id` identifies the pyramid (see src/pyramid.py) whose point
+    order the possibility and probabilities follow, None without one.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as progress:
+            if (int(progress['version']) != PROGRESS_VERSION or
+                    str(progress['ckpt_path']) != str(ckpt_path) or
+                    str(progress['prob_dtype']) != prob_dtype or
+                    bool(progress['prob_memmap']) != prob_memmap or
+                    str(progress['pyramid_id']) != (pyramid_id or '') or
+                    progress['possibility'].shape != (num_points,)):
+                log.warning(f"Ignoring {path}: it was saved for another checkpoint, cloud, "
+                            f"pyramid or storage")
+                return None
+            return {key: progress[key] for key in progress.files}
+    except (OSError, ValueError, KeyError) as e:
+        log.warning(f"Ignoring unreadable progress file {path}: {e}")
+        return None
+
+
+def save_progress(path, possibility, accumulator, batches, ckpt_path, pyramid_id=None):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f,
+                 version=PROGRESS_VERSION,
+                 ckpt_path=str(ckpt_path),
+                 pyramid_id=pyramid_id or '',
+                 prob_dtype=accumulator.dtype.name,
+                 prob_memmap=accumulator.path is not None,
+                 possibility=possibility,
+                 batches=batches,
+                 **accumulator.state(batches))
+    os.replace(tmp_path, path)
+    # Snapshots of earlier checkpoints are only needed until this one is in place
+    accumulator.remove_snapshots(keep=batches)
+
+
+def write_labels(path, labels):
+    """Write predicted labels (1..8) as a .labels file, atomically."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(labels_to_text(labels.astype(np.uint8)))
+    os.replace(tmp_path, path)
+
+
+def predict_file(model, batcher, split, idx, out_path, progress_file, ckpt_path,
+                 batch_size=4, checkpoint_every=20, rng=None, prob_dtype='float16',
+                 prob_memmap=False, min_visits=None, forward=None, cache=None,
+                 profiler=None, metrics=None, center_noise=0.0):
+    """Predict one cloud of `split` and write its .labels file.
+
+    Args:
+        prob_dtype: Storage of the accumulated probabilities, 'float16' or
+            'uint8' (see `ProbabilityAccumulator`).
+        prob_memmap: Keep the probabilities in a memmap file next to the
+            progress file instead of in RAM.
+        min_visits: Also stop once every point was covered by this many
+            crops, even if some possibilities are still low.
+        forward: Callable run on collated batches instead of `model`, e.g.
+            an `ExportedModel`.
+        cache: `PreprocessCache` of preprocessed clouds, None to preprocess.
+        profiler: `Profiler` recording every batch as a step.
+        metrics: `StreamingMetrics` the predicted labels are counted in.
+        center_noise: Standard deviation of the noise added to crop
+            centers (see `CropSampler`).
+
+    `out_path` may be None to only count the labels in `metrics`.
+
+    Returns:
+        The number of forward passes run for the cloud in this call.
+    """
+    rng = rng or np.random.default_rng()
+    profiler = profiler or NullProfiler()
+    attr = split.get_attr(idx)
+    name = attr['name']
+    with profiler.timed_event('preprocess', cloud=name):
+        proc = preprocess_cloud(model, split, idx, cache)
+    num_points = len(proc['point'])
+    num_classes = model.cfg.num_classes
+
+    # Clouds from a pyramid are in its point order
+    pyramid_id = proc['pyramid']['id'] if 'pyramid' in proc else None
+    progress = load_progress(progress_file, num_points, ckpt_path, prob_dtype, prob_memmap,
+                             pyramid_id)
+    memmap_path = progress_file[:-len('.npz')] + '.probs' if prob_memmap else None
+    # Stochastic rounding of uint8 probabilities follows the seeded rng too
+    accumulator = ProbabilityAccumulator(num_points, num_classes, prob_dtype, memmap_path,
+                                         seed=int(rng.integers(2**32)))
+    if progress is not None:
+        try:
+            accumulator.restore(progress)
+        except (ValueError, KeyError) as e:
+            log.warning(f"Cannot restore the probabilities of {name}, starting over: {e}")
+            progress = None
+
+    if progress is not None:
+        possibility = progress['possibility']
+        done_batches = int(progress['batches'])
+        log.info(f"Resuming {name} after {done_batches} batches "
+                 f"({np.mean(possibility > MIN_POSSIBILITY):.1%} of points visited)")
+    else:
+        accumulator.remove_snapshots()
+        possibility = rng.random(num_points, dtype=np.float32) * 1e-3
+        done_batches = 0
+
+    def done():
+        if min_visits and accumulator.converged(min_visits):
+            return True
+        return possibility.min() > MIN_POSSIBILITY
+
+    def next_batch():
+        start = time.perf_counter()
+        crops = [{'data': model.transform(proc, attr), 'attr': attr}
+                 for _ in range(batch_size)]
+        return batcher.collate_fn(crops), time.perf_counter() - start
+
+    model.trans_point_sampler = CropSampler(possibility, rng, center_noise)
+    forward = forward or model
+    batches = 0
+    start = time.perf_counter()
+    # Crops of the next batch (sampling, KNN, subsampling) are prepared in a
+    # background thread while the current batch runs through the model. Before
+    # a checkpoint nothing is prefetched, so the saved possibility only counts
+    # crops whose probabilities were accumulated.
+    with torch.no_grad(), ThreadPoolExecutor(max_workers=1) as executor:
+        pending = executor.submit(next_batch) if not done() else None
+        while pending is not None:
+            profiler.begin_step('predict')
+            with profiler.timer('data_wait'):
+                inputs, prepare_seconds = pending.result()
+            # Prepared in the background, mostly overlapping the previous batch
+            profiler.add_worker('sample', prepare_seconds)
+            checkpoint = checkpoint_every and (batches + 1) % checkpoint_every == 0
+            pending = None
+            if not checkpoint and not done():
+                pending = executor.submit(next_batch)
+
+            with profiler.timer('forward'):
+                results = forward(inputs['data'])
+                # Same softmax as RandLANet.update_probs, blended by the accumulator
+                probs = torch.softmax(results.reshape(batch_size, -1, num_classes), dim=-1)
+                probs = probs.cpu().numpy()
+            with profiler.timer('accumulate'):
+                point_inds = np.asarray(inputs['data']['point_inds'])
+                for b in range(batch_size):
+                    accumulator.update(point_inds[b], probs[b])
+            batches += 1
+
+            if checkpoint:
+                with profiler.timer('checkpoint'):
+                    save_progress(progress_file, possibility, accumulator,
+                                  done_batches + batches, ckpt_path, pyramid_id)
+                log.info(f"{name}: {done_batches + batches} batches, "
+                         f"{np.mean(possibility > MIN_POSSIBILITY):.1%} of points visited, "
+                         f"min visits {accumulator.min_visits()}")
+                if not done():
+                    pending = executor.submit(next_batch)
+            profiler.end_step(cloud=name)
+    elapsed = time.perf_counter() - start
+
+    labels = accumulator.labels(proc['proj_inds']) + 1
+    if out_path is not None:
+        with profiler.timed_event('write_labels', cloud=name):
+            write_labels(out_path, labels)
+    if metrics is not None:
+        with profiler.timed_event('metrics', cloud=name):
+            metrics.update(name, labels)
+    accumulator.close(remove=True)
+    if os.path.exists(progress_file):
+        os.remove(progress_file)
+    crop_points = batches * batch_size * model.cfg.num_points
+    log.info(f"Predicted {name}{f' into {out_path}' if out_path else ''} "
+             f"({done_batches + batches} batches, "
+             f"{crop_points / max(elapsed, 1e-9):,.0f} points/s)")
+    if metrics is not None:
+        log.info(metrics.summary(name))
+    return batches
+
+
+def main():
+    configure_logging()
+    args = parse_arguments()
+
+    cfg = _ml3d.utils.Config.load_from_file(args.config)
+    if args.dataset_path:
+        cfg.dataset['dataset_path'] = args.dataset_path
+    ckpt_path = args.ckpt_path or cfg.model.get('ckpt_path')
+    output_dir = args.output_dir or cfg.dataset.get('test_result_folder', './test')
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.seed is not None:
+        random.seed(args.seed)
+        torch.manual_seed(args.seed)
+
+    Pipeline = _ml3d.utils.get_module("pipeline", cfg.pipeline.name, "torch")
+    Model = _ml3d.utils.get_module("model", cfg.model.name, "torch")
+
+    dataset = Semantic3DForEval(cfg.dataset.pop('dataset_path', None), **cfg.dataset)
+    model = Model(**cfg.model)
+    if cfg.model.get('use_pyramid'):
+        install_pyramid(model, dataset.cfg.dataset_path)
+
+    forward = None
+    if args.model_path:
+        # The exported model replaces the weights; the eager model only
+        # prepares the crops
+        forward = ExportedModel(args.model_path, args.threads)
+        if forward.meta['num_points'] != model.cfg.num_points:
+            raise ValueError(f"{args.model_path} was exported for {forward.meta['num_points']} "
+                             f"points per crop, the config uses {model.cfg.num_points}")
+        if forward.meta['batch_size'] != args.batch_size:
+            raise ValueError(f"{args.model_path} was exported for {forward.meta['batch_size']} "
+                             f"crops per batch, --batch_size is {args.batch_size}")
+        # Exported models run on the cpu, so the batches are collated there
+        if args.device != 'cpu':
+            log.info(f"Running the exported model on cpu instead of {args.device}")
+            args.device = 'cpu'
+    pipeline = Pipeline(model, dataset, device=args.device, **cfg.pipeline)
+
+    if forward is not None:
+        ckpt_path = os.path.abspath(args.model_path)
+        log.info(f"Running {forward.format} model {args.model_path}")
+    else:
+        pipeline.load_ckpt(ckpt_path)
+    model.device = pipeline.device
+    model.to(pipeline.device)
+    model.eval()
+    batcher = pipeline.get_batcher(pipeline.device)
+
+    cache = None
+    if dataset.cfg.get('use_cache'):
+        cache = PreprocessCache(model.preprocess, dataset.cfg.cache_dir,
+                                dataset_path=dataset.cfg.dataset_path,
+                                max_bytes=max_bytes_of(dataset.cfg.get('cache_max_gb')))
+
+    split = dataset.get_split('test')
+    indices = select_files(split, args.files)
+    if not indices:
+        raise ValueError(f"No test clouds match {args.files}")
+
+    os.makedirs(os.path.join(output_dir, dataset.name), exist_ok=True)
+    os.makedirs(os.path.join(output_dir, PROGRESS_DIR), exist_ok=True)
+    rng = np.random.default_rng(args.seed)
+    profiler = make_profiler(args, 'inference')
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(levelname)s - %(asctime)s - %(module)s - %(message)s',
-)
+    metrics = None
+    if args.metrics:
+        gt_dir = dataset.cfg.dataset_path
+        metrics = StreamingMetrics(gt_dir, args.metrics_mode,
+                                   cache_dir=os.path.join(gt_dir, '.label_cache'))
+        metrics_json = args.metrics_json or os.path.join(output_dir, dataset.name,
+                                                         'eval_metrics.json')
+        if not args.overwrite and metrics.restore(metrics_json):
+            log.info(f"Restored the metrics of {len(metrics.file_cms)} clouds from {metrics_json}")
 
-framework = "torch" # or tf
-cfg_file = "configs/randlanet_semantic3d.yml"
-cfg = _ml3d.utils.Config.load_from_file(cfg_file)
+    log.info(f"Predicting {len(indices)} clouds on {pipeline.device} "
+             f"with {args.batch_size} crops per batch, {torch.get_num_threads()} threads")
+    for idx in indices:
+        name = split.get_attr(idx)['name']
+        out_path = output_path(output_dir, dataset.name, name)
+        if not args.overwrite and (metrics is None or name in metrics):
+            if args.no_labels and metrics is not None:
+                log.info(f"{name} is in {metrics_json}, skipping it")
+                continue
+            if os.path.exists(out_path):
+                log.info(f"{out_path} exists, skipping {name}")
+                continue
+        if metrics is not None and not args.overwrite and os.path.exists(out_path):
+            # Predicted by an earlier run without metrics
+            metrics.update(name, load_labels(out_path))
+            log.info(f"Counted the existing {out_path}; {metrics.summary(name)}")
+        else:
+            predict_file(model, batcher, split, idx, None if args.no_labels else out_path,
+                         progress_path(output_dir, name), ckpt_path,
+                         args.batch_size, args.checkpoint_every, rng, args.prob_dtype,
+                         args.prob_memmap, args.min_visits, forward, cache, profiler,
+                         metrics, args.center_noise)
+        if metrics is not None:
+            metrics.save(metrics_json, run=os.path.dirname(metrics_json))
+    profiler.close()
 
-Pipeline = _ml3d.utils.get_module("pipeline", cfg.pipeline.name, framework)
-Model = _ml3d.utils.get_module("model", cfg.model.name, framework)
+    if metrics is not None:
+        log_metrics(metrics.metrics(), args.metrics_mode)
+        log.info(f"Saved the metrics to {metrics_json}")
 
-dataset = Semantic3DForEval(cfg.dataset.pop('dataset_path', None), **cfg.dataset)
-model = Model(**cfg.model)
-pipeline = Pipeline(model, dataset, **cfg.pipeline)
+    log.info("Inference completed successfully")
 
-pipeline.run_test()
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,10 @@ import argparse
 import logging
 import open3d.ml as _ml3d
 import open3d.ml.torch as ml3d
+from src.semantic3d_wrapper import Semantic3DForEval
+from src.class_sampler import ClassBalancedSampler  # registers the sampler with Open3D-ML
+from src.profiling import add_profile_arguments, instrument_training, make_profiler
+from src.pyramid import install_pyramid
 
 
 def configure_logging():
@@ -40,6 +44,7 @@ def parse_arguments():
         choices=['torch', 'tf'],
         help='Deep learning framework to use (default: torch)'
     )
+    add_profile_arguments(parser)
     return parser.parse_args()
 
 def main():
@@ -70,14 +75,30 @@ def main():
         # Initialize components
         Pipeline = _ml3d.utils.get_module("pipeline", cfg.pipeline.name, args.framework)
         Model = _ml3d.utils.get_module("model", cfg.model.name, args.framework)
-        Dataset = _ml3d.utils.get_module("dataset", cfg.dataset.name)
+        if cfg.dataset.name == 'Semantic3D':
+            # Reads binary clouds too, resolves the class weights from the
+            # dataset statistics file and installs the preprocessing cache
+            Dataset = Semantic3DForEval
+        else:
+            Dataset = _ml3d.utils.get_module("dataset", cfg.dataset.name)
 
         # Create instances
         dataset = Dataset(cfg.dataset.pop('dataset_path', None), **cfg.dataset)
         model = Model(**cfg.model)
+        if cfg.model.get('use_pyramid'):
+            # Subsampled clouds and crop layers from src/pyramid.py
+            install_pyramid(model, args.dataset_path)
         pipeline = Pipeline(model, dataset, **cfg.pipeline)
 
-        pipeline.run_train()
+        # Per-step timings and resource usage, only hooked in with --profile
+        profiler = make_profiler(args, 'train')
+        if profiler.enabled:
+            instrument_training(pipeline, profiler)
+
+        try:
+            pipeline.run_train()
+        finally:
+            profiler.close()
 
         logging.info("Training completed successfully")
 